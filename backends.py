@@ -0,0 +1,762 @@
+# -*- coding: utf-8 -*-
+"""上游API客户端
+
+旧版 (yuewen.cn) 与新版 (stepfun.com) 共用同一套传输层：HTTP会话、凭证、
+Connect 分帧和令牌失效重试都在这里实现，两个具体后端只负责各自的
+端点、请求头和数据格式。
+"""
+import asyncio
+import random
+import struct
+import time
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+
+import aiohttp
+from loguru import logger
+
+from . import codec, context, hotlog
+
+# Connect 协议帧头: Flag(1字节) + Length(大端4字节)
+CONNECT_FRAME_HEADER = struct.Struct('>BI')
+CONNECT_FLAG_END_STREAM = 0x02
+
+_poll_log = hotlog.get('poll')
+
+BASE_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'zh-CN,zh;q=0.9',
+    'cache-control': 'no-cache',
+    'origin': '',  # 将在请求时动态设置
+    'pragma': 'no-cache',
+    'priority': 'u=1, i',
+    'referer': '',  # 将在请求时动态设置
+    'sec-ch-ua': '"Not/A)Brand";v="99", "Microsoft Edge";v="127", "Chromium";v="127"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36 Edg/127.0.0.0',
+    'x-waf-client-type': 'fetch_sdk'
+}
+
+# 与浏览器curl一致的 Chromium 136 指纹，上传/分享等接口需要
+BROWSER_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
+    'oasis-appid': '10200',
+    'oasis-platform': 'web',
+    'priority': 'u=1, i',
+    'sec-ch-ua': '"Chromium";v="136", "Microsoft Edge";v="136", "Not.A/Brand";v="99"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0',
+    'x-waf-client-type': 'fetch_sdk'
+}
+
+
+def encode_frame(payload, flags=0):
+    """将payload编码为Connect协议帧"""
+    encoded = codec.dumps(payload)
+    return CONNECT_FRAME_HEADER.pack(flags, len(encoded)) + encoded
+
+
+class FrameDecoder:
+    """Connect协议流式解帧器，可跨分块累积数据"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """追加数据并返回所有完整帧 [(flags, payload_bytes), ...]"""
+        if chunk:
+            self._buffer.extend(chunk)
+        frames = []
+        buffer = self._buffer
+        offset = 0
+        while len(buffer) - offset >= CONNECT_FRAME_HEADER.size:
+            flags, length = CONNECT_FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + CONNECT_FRAME_HEADER.size + length
+            if len(buffer) < end:
+                break
+            frames.append((flags, bytes(buffer[offset + CONNECT_FRAME_HEADER.size:end])))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+
+class UpstreamTransport:
+    """两个后端共享的传输层：HTTP会话、凭证和失效重试"""
+
+    def __init__(self, plugin, max_attempts=2):
+        self._plugin = plugin
+        self.max_attempts = max_attempts
+        self._cookies = None  # (凭证, Cookie字典)
+
+    @property
+    def session(self):
+        """获取共享HTTP会话，不存在或已关闭时重新创建"""
+        plugin = self._plugin
+        if not plugin.http_session or plugin.http_session.closed:
+            plugin.http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=60),
+                connector=aiohttp.TCPConnector(ssl=False)
+            )
+            plugin.login_handler.set_http_session(plugin.http_session)
+        return plugin.http_session
+
+    def credentials(self):
+        """返回当前会话所分配账号的 (token, webid)"""
+        account = self._plugin.current_account
+        return account.token, account.webid
+
+    def cookies(self):
+        """与浏览器一致的Cookie字典（按凭证缓存，只读）"""
+        credentials = self.credentials()
+        cached = self._cookies
+        if cached is None or cached[0] != credentials:
+            token, webid = credentials
+            cached = self._cookies = (credentials, MappingProxyType({
+                'Oasis-Webid': webid,
+                'Oasis-Token': token,
+                'i18next': 'zh',
+                '_tea_utm_cache_20002086': '{%22utm_source%22:%22share%22%2C%22utm_content%22:%22web_image_share%22}',
+                'sidebar_state': 'false'
+            }))
+        return cached[1]
+
+    async def refresh_credentials(self, force=False):
+        """刷新令牌"""
+        return await self._plugin.login_handler.refresh_token(force=force, account=self._plugin.current_account)
+
+    @asynccontextmanager
+    async def open(self, method, url, headers_factory, *, timeout=None, attempts=None, data=None, **kwargs):
+        """发送请求，遇到401或网络错误时刷新令牌后重试
+
+        Args:
+            headers_factory: 每次尝试时调用以获取最新请求头（令牌刷新后会变化）
+            timeout: 总超时秒数，不会超过当前消息剩余的处理时限
+            attempts: 最大尝试次数，默认使用 max_attempts
+            data: 请求体；若为可调用对象则每次尝试时重新生成（如multipart表单）
+        """
+        attempts = attempts or self.max_attempts
+        response = None
+        for attempt in range(attempts):
+            total = context.current().clamp_timeout(timeout)
+            client_timeout = aiohttp.ClientTimeout(total=total) if total else None
+            last_attempt = attempt == attempts - 1
+            body = data() if callable(data) else data
+            try:
+                response = await self.session.request(
+                    method, url,
+                    headers=headers_factory(),
+                    data=body,
+                    timeout=client_timeout,
+                    **kwargs
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                logger.warning(f"[Yuewen] 请求异常，刷新令牌后重试: {url}, {e}")
+                await self.refresh_credentials()
+                continue
+
+            if response.status == 401 and not last_attempt:
+                logger.warning(f"[Yuewen] 令牌无效(401)，尝试刷新后重试: {url}")
+                if await self.refresh_credentials():
+                    response.release()
+                    continue
+            break
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def request_json(self, method, url, headers_factory, **kwargs):
+        """发送请求并解析JSON响应
+
+        Returns:
+            tuple: (状态码, JSON数据或None, 原始文本)
+        """
+        async with self.open(method, url, headers_factory, **kwargs) as response:
+            text = await response.text()
+            try:
+                data = codec.loads(text) if text else None
+            except codec.DecodeError:
+                data = None
+            return response.status, data, text
+
+
+class UpstreamBackend:
+    """上游后端基类
+
+    子类实现 create_session / stream_message / upload_image / poll_creation，
+    并通过 _build_template(kind) 提供各端点的请求头模板。
+    """
+
+    name = None
+    log_prefix = "[Yuewen]"
+
+    def __init__(self, transport, base_url):
+        self.transport = transport
+        self.base_url = base_url
+        self._templates = {}  # (kind, webid, token) -> 只读请求头模板
+
+    def _common_headers(self, token, webid):
+        cookie_parts = []
+        if webid:
+            cookie_parts.append(f"Oasis-Webid={webid}")
+        if token:
+            cookie_parts.append(f"Oasis-Token={token}")
+
+        headers = dict(BASE_HEADERS)
+        headers.update({
+            'Cookie': "; ".join(cookie_parts),
+            'oasis-webid': webid,
+            'origin': self.base_url,
+            'referer': f'{self.base_url}/',
+            'oasis-appid': '10200',
+            'oasis-platform': 'web',
+            'oasis-language': 'zh',
+            'connect-protocol-version': '1',
+            'canary': 'false',
+            'priority': 'u=1, i',
+            'x-waf-client-type': 'fetch_sdk'
+        })
+        return headers
+
+    def _build_template(self, kind, token, webid):
+        """构建指定端点类型的静态请求头（不含每次请求都变化的字段）"""
+        return self._common_headers(token, webid)
+
+    def _dynamic_headers(self, kind):
+        """每次请求都需要重新生成的请求头，默认没有"""
+        return None
+
+    def _template(self, kind):
+        """获取请求头模板，凭证（token/webid）变化时才重新构建"""
+        token, webid = self.transport.credentials()
+        key = (kind, webid, token)
+        template = self._templates.get(key)
+        if template is None:
+            # 同一账号(webid)的旧令牌模板作废
+            for stale in [k for k in self._templates if k[0] == kind and k[1] == webid]:
+                del self._templates[stale]
+            template = self._templates[key] = MappingProxyType(self._build_template(kind, token, webid))
+        return template
+
+    def headers(self, kind='default', **overrides):
+        """获取指定端点类型的请求头：复制模板后叠加动态字段和调用方覆盖的字段"""
+        headers = dict(self._template(kind))
+        dynamic = self._dynamic_headers(kind)
+        if dynamic:
+            headers.update(dynamic)
+        if overrides:
+            headers.update(overrides)
+        return headers
+
+    def build_message_packet(self, session_id, content, attachments=None, model_id=None, network_mode=True):
+        raise NotImplementedError
+
+    def build_attachment(self, image_info):
+        """根据上传结果构建消息附件"""
+        raise NotImplementedError
+
+    async def create_session(self):
+        """创建上游会话，返回会话ID，失败返回None"""
+        raise NotImplementedError
+
+    def stream_message(self, session_id, content, attachments=None, model_id=None, network_mode=True):
+        """发送消息并返回流式响应的异步上下文管理器"""
+        raise NotImplementedError
+
+    async def upload_image(self, image, session_id=None):
+        """上传图片
+
+        Args:
+            image: ImageBuffer，请求体按需从中打开，分块发送
+
+        Returns:
+            tuple: (file_id, 服务器响应数据, 错误信息)
+        """
+        raise NotImplementedError
+
+    async def poll_creation(self, creation_id, record_id):
+        """轮询创作（图片生成）结果
+
+        Returns:
+            tuple: (url, error_message)
+        """
+        return None, "当前API版本不支持图片生成"
+
+
+class YuewenBackend(UpstreamBackend):
+    """旧版API (yuewen.cn)"""
+
+    name = 'old'
+    log_prefix = "[Yuewen][Old API]"
+
+    def _build_template(self, kind, token, webid):
+        if kind == 'share':
+            # 分享接口完全按照浏览器请求构建，Cookie通过cookies参数单独传递
+            headers = dict(BROWSER_HEADERS)
+            headers.update({
+                'canary': 'false',
+                'connect-protocol-version': '1',
+                'content-type': 'application/json',
+                'oasis-mode': '2',
+                'oasis-webid': webid,
+                'origin': self.base_url,
+            })
+            return headers
+
+        headers = self._common_headers(token, webid)
+        headers['oasis-mode'] = '2'
+        if kind == 'json':
+            headers['Content-Type'] = 'application/json'
+        elif kind == 'settings':
+            headers.update({'Content-Type': 'application/json', 'oasis-mode': '1'})
+        elif kind == 'connect':
+            headers['content-type'] = 'application/connect+json'
+        elif kind == 'upload':
+            headers.update({
+                'content-type': 'image/jpeg',
+                'sec-fetch-dest': 'empty',
+                'sec-fetch-mode': 'cors',
+                'sec-fetch-site': 'same-origin',
+            })
+        return headers
+
+    def _dynamic_headers(self, kind):
+        if kind == 'share':
+            return None
+        return {
+            'x-rum-traceparent': self._generate_traceparent(),
+            'x-rum-tracestate': self._generate_tracestate(),
+        }
+
+    @staticmethod
+    def _generate_traceparent():
+        """生成跟踪父ID - 跃问服务器请求需要"""
+        return f"00-{random.getrandbits(128):032x}-{random.getrandbits(64):016x}-01"
+
+    @staticmethod
+    def _generate_tracestate():
+        """生成跟踪状态 - 跃问服务器请求需要"""
+        return f"yuewen@rsid={random.getrandbits(64):016x}"
+
+    def _chat_referer(self, chat_id):
+        return f'{self.base_url}/chats/{chat_id or ""}'
+
+    def build_message_packet(self, session_id, content, attachments=None, model_id=None, network_mode=True):
+        payload = {
+            "chatId": session_id,
+            "messageInfo": {
+                "text": content,
+                "author": {"role": "user"}
+            },
+            "messageMode": "SEND_MESSAGE",
+            "modelId": model_id  # 旧API使用modelId
+        }
+        if attachments:
+            payload["messageInfo"]["attachments"] = attachments
+        return encode_frame(payload)
+
+    def build_attachment(self, image_info):
+        return {
+            "fileId": image_info['file_id'],
+            "type": "image/jpeg",
+            "width": image_info['width'],
+            "height": image_info['height'],
+            "size": image_info['size']
+        }
+
+    async def create_session(self):
+        url = f"{self.base_url}/api/proto.chat.v1.ChatService/CreateChat"
+        try:
+            status, result, text = await self.transport.request_json(
+                'POST', url, lambda: self.headers('json'),
+                json={"chatName": "新会话"}, timeout=30
+            )
+        except Exception as e:
+            logger.error(f"{self.log_prefix} 创建会话请求异常: {e}", exc_info=True)
+            return None
+
+        if status != 200 or not isinstance(result, dict):
+            logger.error(f"{self.log_prefix} 创建会话失败: {status}, {text[:200]}")
+            return None
+
+        chat_id = result.get('id') or result.get('chatId')
+        if not chat_id:
+            logger.error(f"{self.log_prefix} 创建会话失败: 响应缺少id字段 - {result}")
+            return None
+
+        logger.info(f"{self.log_prefix} 创建会话成功: {chat_id}")
+        return chat_id
+
+    def stream_message(self, session_id, content, attachments=None, model_id=None, network_mode=True):
+        url = f"{self.base_url}/api/proto.chat.v1.ChatMessageService/SendMessageStream"
+        packet = self.build_message_packet(session_id, content, attachments, model_id, network_mode)
+        return self.transport.open(
+            'POST', url, lambda: self.headers('connect'),
+            data=packet, timeout=120
+        )
+
+    async def _post_setting(self, path, payload, chat_id, label):
+        """调用用户设置类接口（模型、联网、深度思考）"""
+        url = f"{self.base_url}/api/proto.user.v1.UserService/{path}"
+        try:
+            status, result, text = await self.transport.request_json(
+                'POST', url,
+                lambda: self.headers('settings', referer=self._chat_referer(chat_id)),
+                json=payload
+            )
+        except Exception as e:
+            logger.error(f"[Yuewen] 设置{label}请求异常: {e}", exc_info=True)
+            return False
+
+        if status == 200 and isinstance(result, dict) and result.get("result") == "RESULT_CODE_SUCCESS":
+            logger.info(f"[Yuewen] {label}设置成功: {payload}")
+            return True
+
+        logger.error(f"[Yuewen] 设置{label}失败: {status}, {text}")
+        return False
+
+    async def set_model(self, chat_id, model_id):
+        return await self._post_setting("SetModelInUse", {"modelId": model_id}, chat_id, "模型")
+
+    async def enable_search(self, chat_id, enable=True):
+        return await self._post_setting("EnableSearch", {"enable": enable}, chat_id, "网络搜索")
+
+    async def enable_deep_thinking(self, chat_id):
+        return await self._post_setting("EnableLlmDeepThinking", {"enable": True}, chat_id, "深度思考模式")
+
+    async def upload_image(self, image, session_id=None):
+        if not image:
+            logger.error(f"{self.log_prefix} 图片数据为空")
+            return None, None, "图片数据为空"
+
+        file_size = len(image)
+        file_name = f"n_v{random.getrandbits(128):032x}.jpg"
+        upload_url = f'{self.base_url}/api/storage?file_name={file_name}'
+        logger.debug(f"{self.log_prefix} 开始上传图片到: {upload_url}, 大小: {file_size} 字节")
+
+        def upload_headers():
+            return self.headers(
+                'upload',
+                referer=self._chat_referer(session_id),
+                **{'content-length': str(file_size), 'stepchat-meta-size': str(file_size)}
+            )
+
+        try:
+            status, result, text = await self.transport.request_json(
+                'PUT', upload_url, upload_headers, data=image.open, timeout=45
+            )
+        except Exception as e:
+            logger.error(f"{self.log_prefix} 上传图片失败: {e}", exc_info=True)
+            return None, None, f"上传异常: {e}"
+
+        if status != 200:
+            logger.error(f"{self.log_prefix} 上传失败: HTTP {status} - {text[:200]}")
+            return None, None, f"HTTP {status}"
+
+        file_id = result.get('id') if isinstance(result, dict) else None
+        if not file_id:
+            logger.error(f"{self.log_prefix} 上传成功但响应中没有文件ID: {result}")
+            return None, result, "服务器返回数据不完整"
+
+        # 旧版上传成功后需要检查文件状态
+        if not await self.check_file_status(file_id):
+            logger.error(f"{self.log_prefix} 文件状态检查失败: {file_id}")
+            return None, result, "文件状态检查失败"
+
+        logger.info(f"{self.log_prefix} 图片上传成功，ID: {file_id}")
+        return file_id, result, None
+
+    async def check_file_status(self, file_id, max_retries=5, retry_interval=0.5):
+        """轮询文件处理状态"""
+        url = f'{self.base_url}/api/proto.file.v1.FileService/GetFileStatus'
+        for i in range(max_retries):
+            try:
+                status, data, _ = await self.transport.request_json(
+                    'POST', url, lambda: self.headers('json'),
+                    json={"id": file_id}, timeout=10
+                )
+                if status == 200 and isinstance(data, dict):
+                    if data.get("fileStatus") == 1:  # 1表示成功
+                        return True
+                    if not data.get("needFurtherCall", True):  # 如果不需要继续查询
+                        return False
+                elif status == 401:
+                    return False
+            except Exception as e:
+                logger.error(f"[Yuewen] 检查文件状态失败: {str(e)}")
+            if i < max_retries - 1:
+                await asyncio.sleep(retry_interval)
+        return False
+
+
+class StepFunBackend(UpstreamBackend):
+    """新版API (stepfun.com)"""
+
+    name = 'new'
+    log_prefix = "[Yuewen][New API]"
+
+    def _build_template(self, kind, token, webid):
+        if kind == 'upload':
+            # 上传接口完全按照浏览器请求构建，Cookie通过cookies参数单独传递
+            headers = dict(BROWSER_HEADERS)
+            headers.update({
+                'origin': self.base_url,
+                'referer': f'{self.base_url}/chats/new',
+            })
+            return headers
+
+        headers = self._common_headers(token, webid)
+        if kind == 'json':
+            headers['Content-Type'] = 'application/json'
+        elif kind == 'connect':
+            headers.update({
+                'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
+                'content-type': 'application/connect+json',
+            })
+        return headers
+
+    def build_message_packet(self, session_id, content, attachments=None, model_id=None, network_mode=True):
+        qa = {"content": content or ""}
+        if attachments:
+            qa["attachments"] = attachments
+        payload = {
+            "message": {
+                "chatSessionId": session_id,
+                "content": {
+                    "userMessage": {
+                        "qa": qa
+                    }
+                }
+            },
+            "config": {
+                # 新版 API 使用模型名称字符串
+                "model": "deepseek-r1",
+                "enableReasoning": True,
+                "enableSearch": network_mode
+            }
+        }
+        return encode_frame(payload)
+
+    def build_attachment(self, image_info):
+        response_data = image_info.get('response_data')
+        if response_data:
+            # 使用服务器返回的完整元数据
+            rid = response_data.get('rid')
+            return {
+                "resource": {
+                    "image": {
+                        "rid": rid,
+                        "url": response_data.get('url'),
+                        "meta": response_data.get('meta', {"width": image_info['width'], "height": image_info['height']}),
+                        "mimeType": response_data.get('mimeType', "image/jpeg")
+                    },
+                    "rid": rid
+                }
+            }
+
+        file_id = image_info['file_id']
+        return {
+            "resource": {
+                "image": {
+                    "rid": file_id,
+                    "url": f"https://chat-image.stepfun.com/tos-cn-i-9xxiciwj9y/{file_id}~tplv-9xxiciwj9y-image.webp",
+                    "meta": {
+                        "width": image_info['width'],
+                        "height": image_info['height']
+                    },
+                    "mimeType": "image/jpeg"
+                },
+                "rid": file_id
+            }
+        }
+
+    async def create_session(self):
+        url = f'{self.base_url}/api/agent/capy.agent.v1.AgentService/CreateChatSession'
+        logger.info(f"{self.log_prefix} 尝试创建会话: {url}")
+        try:
+            status, data, text = await self.transport.request_json(
+                'POST', url, lambda: self.headers('json'), json={}
+            )
+        except Exception as e:
+            logger.error(f"{self.log_prefix} 创建会话失败: {str(e)}", exc_info=True)
+            return None
+
+        if status != 200:
+            logger.error(f"{self.log_prefix} 创建会话失败: HTTP {status} - {text}")
+            return None
+
+        session_data = data.get('chatSession') if isinstance(data, dict) else None
+        if not session_data or not session_data.get('chatSessionId'):
+            logger.error(f"{self.log_prefix} 创建会话失败: 响应中缺少 chatSessionId - {text}")
+            return None
+
+        session_id = session_data['chatSessionId']
+        logger.info(f"{self.log_prefix} 新建会话成功 SessionID: {session_id}")
+        return session_id
+
+    def stream_message(self, session_id, content, attachments=None, model_id=None, network_mode=True):
+        url = f"{self.base_url}/api/agent/capy.agent.v1.AgentService/ChatStream"
+        packet = self.build_message_packet(session_id, content, attachments, model_id, network_mode)
+        return self.transport.open(
+            'POST', url, lambda: self.headers('connect'),
+            data=packet, timeout=120
+        )
+
+    async def upload_image(self, image, session_id=None, max_retries=3, retry_delay=1.0):
+        if not image:
+            logger.error(f"{self.log_prefix} Image data is empty for upload.")
+            return None, None, "图片数据为空"
+
+        token, _ = self.transport.credentials()
+        if not token:
+            logger.error(f"{self.log_prefix} 配置中未找到令牌")
+            return None, None, "未找到访问令牌"
+
+        upload_url = f'{self.base_url}/api/resource/image'
+        file_name = f"upload_{int(time.time() * 1000)}.jpg"
+        mime_type = 'image/jpeg'
+
+        def form():
+            # multipart表单每次请求需要重新生成
+            data = aiohttp.FormData()
+            data.add_field('file', image.open(), filename=file_name, content_type=mime_type)
+            data.add_field('scene_id', 'image')
+            data.add_field('mime_type', mime_type)
+            return data
+
+        def upload_headers():
+            return self.headers('upload', referer=f'{self.base_url}/chats/{session_id or "new"}')
+
+        error = None
+        for retry in range(max_retries):
+            if retry > 0:
+                logger.warning(f"{self.log_prefix} 上传图片重试 ({retry}/{max_retries})")
+                await asyncio.sleep(retry_delay * retry)
+            try:
+                async with self.transport.open(
+                    'POST', upload_url, upload_headers,
+                    data=form, cookies=self.transport.cookies(), timeout=30, attempts=1
+                ) as response:
+                    status = response.status
+                    text = await response.text()
+            except Exception as e:
+                logger.error(f"{self.log_prefix} 上传图片时发生异常: {e}")
+                error = f"上传异常: {str(e)}"
+                continue
+
+            if status == 200:
+                try:
+                    result = codec.loads(text)
+                except codec.DecodeError as e:
+                    logger.error(f"{self.log_prefix} 解析上传响应失败: {e}")
+                    error = "解析响应失败"
+                    continue
+                if result and result.get('rid'):
+                    logger.info(f"{self.log_prefix} 图片上传成功，rid: {result['rid']}")
+                    return result['rid'], result, None
+                logger.warning(f"{self.log_prefix} 上传成功但找不到图片ID: {result}")
+                error = "服务器返回数据不完整"
+                continue
+
+            logger.error(f"{self.log_prefix} 上传失败: HTTP {status}")
+            logger.debug(f"{self.log_prefix} 响应内容: {text[:200]}")
+            if "token is illegal" in text or status == 401:
+                error = "令牌被服务器拒绝" if status != 401 else "未授权 (401)"
+                if await self.transport.refresh_credentials():
+                    logger.info(f"{self.log_prefix} 令牌已刷新，将在下次重试")
+                else:
+                    logger.error(f"{self.log_prefix} 令牌刷新失败")
+                    error = "令牌刷新失败"
+            else:
+                error = f"HTTP {status}"
+
+        logger.error(f"{self.log_prefix} 图片上传失败，重试次数用尽")
+        return None, None, error or "上传失败，请稍后重试"
+
+    async def poll_creation(self, creation_id, record_id):
+        if not creation_id or not record_id:
+            logger.error(f"{self.log_prefix} 缺少必要的创建ID或记录ID")
+            return None, "缺少必要的创建ID或记录ID"
+
+        logger.info(f"{self.log_prefix} 开始轮询图片生成状态: creation_id={creation_id}, record_id={record_id}")
+        poll_url = f"{self.base_url}/api/capy.creation.v1.CreationService/GetCreationRecordResultStream"
+        request_data = encode_frame({"creationId": creation_id, "creationRecordId": record_id})
+        cookies = self.transport.cookies()
+
+        try:
+            async with self.transport.open(
+                'POST', poll_url, lambda: self.headers('connect'),
+                data=request_data, cookies=cookies, timeout=180  # 3分钟超时
+            ) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"{self.log_prefix} 图片轮询请求失败: HTTP {response.status}, {error_text}")
+                    return None, f"图片轮询请求失败: HTTP {response.status}, {error_text}"
+
+                decoder = FrameDecoder()
+                async for chunk in response.content.iter_any():
+                    for flags, frame_data in decoder.feed(chunk):
+                        if frame_data:
+                            try:
+                                frame_json = codec.CREATION_FRAME.decode(frame_data)
+                            except codec.DecodeError:
+                                logger.warning(f"{self.log_prefix} 解析JSON帧失败: {frame_data[:100]}...")
+                                continue
+                            _poll_log.sampled(
+                                'frame', "{} 收到图片轮询响应帧: {}...",
+                                lambda: self.log_prefix, lambda: str(frame_json)[:100]
+                            )
+
+                            record = frame_json.get('body', {}).get('record', {})
+                            state = record.get('state')
+                            if state == 'CREATION_RECORD_STATE_SUCCESS':
+                                resources = record.get('result', {}).get('genImage', {}).get('resources', [])
+                                if resources:
+                                    image_url = resources[0].get('resource', {}).get('image', {}).get('url')
+                                    if image_url:
+                                        logger.info(f"{self.log_prefix} 成功获取图片URL: {image_url}")
+                                        return image_url, None
+                            elif state in ['CREATION_RECORD_STATE_FAILED', 'CREATION_RECORD_STATE_REJECTED', 'CREATION_RECORD_STATE_CANCELED']:
+                                reason = record.get('failedReason') or record.get('rejectReason') or "未知原因"
+                                logger.error(f"{self.log_prefix} 图片生成失败: {state}, 原因: {reason}")
+                                return None, f"图片生成失败: {state}, 原因: {reason}"
+
+                        if flags & CONNECT_FLAG_END_STREAM:
+                            # 结束帧之后不会再有结果，不再等待连接关闭
+                            logger.info(f"{self.log_prefix} 收到结束帧")
+                            return None, "图片生成已结束，但未找到图片URL"
+
+                logger.warning(f"{self.log_prefix} 处理完所有响应帧，但未找到图片URL")
+                return None, "处理完所有响应帧，但未找到图片URL"
+
+        except asyncio.TimeoutError:
+            logger.error(f"{self.log_prefix} 图片轮询请求超时")
+            return None, "图片轮询请求超时"
+        except aiohttp.ClientError as e:
+            logger.error(f"{self.log_prefix} 图片轮询请求客户端错误: {e}")
+            return None, f"图片轮询请求客户端错误: {e}"
+        except Exception as e:
+            logger.error(f"{self.log_prefix} 图片轮询请求异常: {e}", exc_info=True)
+            return None, f"图片轮询请求异常: {e}"
+
+
+def create_backends(plugin, base_urls):
+    """创建共享同一传输层的两个后端"""
+    transport = UpstreamTransport(plugin)
+    return {
+        'old': YuewenBackend(transport, base_urls['old']),
+        'new': StepFunBackend(transport, base_urls['new']),
+    }
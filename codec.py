@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""JSON编解码
+
+Connect 帧和上游响应统一从这里编解码。按 orjson > msgspec > 标准库 的顺序
+选择可用的实现（均为可选依赖），直接对 bytes 解码，不经过中间 str；
+编码结果为紧凑的 UTF-8 bytes，可以直接写入帧。
+
+对结构已知的高频帧提供 Schema：安装了 msgspec 时只解码声明的字段，
+其余字段在解析阶段直接跳过；否则退化为完整解码，返回值同样是 dict。
+"""
+import json
+from typing import Any, TypedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+    loads = msgspec.json.Decoder().decode
+    dumps = msgspec.json.Encoder().encode
+
+else:
+    BACKEND = 'json'
+    loads = json.loads
+    _encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+# 解码失败时可能抛出的异常
+DecodeError = (ValueError, msgspec.DecodeError) if msgspec is not None else (ValueError,)
+
+
+class Schema:
+    """已知结构的帧解码器"""
+
+    def __init__(self, name, shape):
+        self.name = name
+        self._decoder = msgspec.json.Decoder(shape) if msgspec is not None else None
+
+    def decode(self, data):
+        if self._decoder is not None:
+            return self._decoder.decode(data)
+        return loads(data)
+
+
+# ---- 旧版API SendMessageStream 帧 ----
+
+class _TextEvent(TypedDict, total=False):
+    stage: Any
+    text: Any
+
+
+class _StartEvent(TypedDict, total=False):
+    messageId: Any
+    parentMessageId: Any
+
+
+class _OldStreamFrame(TypedDict, total=False):
+    textEvent: _TextEvent
+    startEvent: _StartEvent
+    doneEvent: Any
+
+
+# ---- 新版API GetCreationRecordResultStream 帧 ----
+
+class _CreationRecord(TypedDict, total=False):
+    state: Any
+    result: Any
+    failedReason: Any
+    rejectReason: Any
+
+
+class _CreationBody(TypedDict, total=False):
+    record: _CreationRecord
+
+
+class _CreationFrame(TypedDict, total=False):
+    body: _CreationBody
+
+
+OLD_STREAM_FRAME = Schema('old_stream_frame', _OldStreamFrame)
+CREATION_FRAME = Schema('creation_frame', _CreationFrame)
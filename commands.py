@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""命令路由
+
+所有命令别名在插件加载时构建为一棵前缀树，消息只需按字符扫描一遍即可
+找到对应的命令，与命令数量无关。参数解析使用预编译的正则表达式。
+
+命令通过装饰器声明::
+
+    @command("联网", "开启联网")
+    async def _cmd_enable_network(self, call):
+        return "✅ 已开启联网模式"
+
+    @command("切换模型", "模型", "model", prefix=True, parser=r'\\s*(\\d+)?.*')
+    async def _cmd_switch_model(self, call):
+        model_num = call.args.group(1)
+
+- 普通命令要求内容与别名完全相同；prefix=True 时别名之后的内容作为参数
+- parser 对参数部分做 fullmatch，结果保存在 call.args；不匹配时视为没有命中该命令，
+  继续尝试更短的别名
+- 处理函数返回字符串时作为回复发送；返回 PASS 表示不处理，消息按普通对话继续；
+  返回 None 表示已经自行回复
+"""
+import re
+
+# 处理函数返回 PASS 时消息继续按普通对话处理
+PASS = object()
+
+_COMMAND_ATTR = '_yuewen_command'
+_END = '\0'
+
+
+class Command:
+    """一条已注册的命令"""
+
+    __slots__ = ('name', 'aliases', 'handler', 'prefix', 'parser', 'requires_login')
+
+    def __init__(self, aliases, handler, prefix=False, parser=None, requires_login=True, name=None):
+        self.aliases = tuple(aliases)
+        self.handler = handler
+        self.prefix = prefix
+        self.requires_login = requires_login
+        self.name = name or getattr(handler, '__name__', self.aliases[0])
+        if isinstance(parser, str):
+            parser = re.compile(parser, re.DOTALL).fullmatch
+        self.parser = parser
+
+    def parse(self, rest):
+        """解析别名之后的内容，返回参数；不符合该命令格式时返回 None"""
+        if not self.prefix:
+            return '' if not rest else None
+        if self.parser is None:
+            return rest.strip()
+        return self.parser(rest)
+
+
+class CommandCall:
+    """一次命令调用"""
+
+    __slots__ = ('command', 'alias', 'args', 'bot', 'message', 'from_wxid', 'user_id')
+
+    def __init__(self, command, alias, args, bot=None, message=None, from_wxid=None, user_id=None):
+        self.command = command
+        self.alias = alias
+        self.args = args
+        self.bot = bot
+        self.message = message
+        self.from_wxid = from_wxid
+        self.user_id = user_id
+
+
+def command(*aliases, prefix=False, parser=None, requires_login=True):
+    """把方法声明为命令，由 CommandRouter.collect 收集"""
+    def decorator(func):
+        setattr(func, _COMMAND_ATTR, dict(
+            aliases=aliases, prefix=prefix, parser=parser, requires_login=requires_login
+        ))
+        return func
+    return decorator
+
+
+class CommandRouter:
+    """基于前缀树的命令路由"""
+
+    def __init__(self):
+        self._root = {}
+        self.commands = []
+
+    def register(self, aliases, handler, **options):
+        cmd = Command(aliases, handler, **options)
+        for alias in cmd.aliases:
+            node = self._root
+            for ch in alias:
+                node = node.setdefault(ch, {})
+            if _END in node:
+                raise ValueError(f"命令别名重复: {alias}")
+            node[_END] = (alias, cmd)
+        self.commands.append(cmd)
+        return cmd
+
+    def collect(self, obj):
+        """注册对象上所有用 @command 声明的方法"""
+        for name in dir(type(obj)):
+            func = getattr(type(obj), name, None)
+            spec = getattr(func, _COMMAND_ATTR, None)
+            if spec is not None:
+                self.register(spec['aliases'], getattr(obj, name), name=name, **{
+                    k: v for k, v in spec.items() if k != 'aliases'
+                })
+        return self
+
+    def match(self, content, **context):
+        """查找命令，返回 CommandCall；没有命中任何命令时返回 None
+
+        沿前缀树扫描一遍内容，记录沿途经过的别名，从最长的别名开始尝试。
+        """
+        node = self._root
+        candidates = []
+        for index, ch in enumerate(content):
+            if _END in node:
+                candidates.append((index, node[_END]))
+            node = node.get(ch)
+            if node is None:
+                break
+        else:
+            if _END in node:
+                candidates.append((len(content), node[_END]))
+
+        for index, (alias, cmd) in reversed(candidates):
+            args = cmd.parse(content[index:])
+            if args is not None:
+                return CommandCall(cmd, alias, args, **context)
+        return None
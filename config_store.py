@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""配置持久化
+
+内存中的配置字典是权威状态，写文件只是它的持久化：
+
+- 保存请求会被防抖，一段时间内的多次更新合并为一次写入
+- 写入前与上次写入的内容比较，没有变化时不写文件
+- 在工作线程中先写临时文件再原子替换，不阻塞事件循环，也不会留下写了一半的配置
+- 没有运行中的事件循环时（如插件初始化阶段）同步写入
+"""
+import asyncio
+import copy
+import os
+import time
+import uuid
+
+from loguru import logger
+
+DEFAULT_DEBOUNCE = 1.0
+WRITE_ATTEMPTS = 3
+
+
+def toml_document(config):
+    """把扁平的配置字典转换为 [yuewen] 下的TOML文档结构（深拷贝）"""
+    document = {"yuewen": {k: copy.deepcopy(v) for k, v in config.items() if k != "image_config"}}
+    if "image_config" in config:
+        document["yuewen"]["image_config"] = copy.deepcopy(config.get("image_config", {}))
+    return document
+
+
+def _write_atomic(path, document):
+    """写入临时文件后原子替换目标文件（在工作线程中执行）"""
+    import toml
+
+    directory = os.path.dirname(path)
+    for attempt in range(WRITE_ATTEMPTS):
+        temp_path = os.path.join(directory, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                toml.dump(document, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            return True
+        except OSError as e:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            if attempt == WRITE_ATTEMPTS - 1:
+                logger.error(f"[Yuewen] 保存TOML配置失败，已达最大重试次数: {e}")
+                return False
+            # 文件可能被其他进程占用，稍后重试
+            logger.warning(f"[Yuewen] 保存TOML配置失败 (尝试 {attempt + 1}/{WRITE_ATTEMPTS}): {e}")
+            time.sleep(0.2 * (attempt + 1))
+    return False
+
+
+class ConfigStore:
+    """防抖、原子写入的配置文件存储
+
+    Args:
+        path: 配置文件路径
+        snapshot: 无参函数，返回当前要写入的TOML文档
+        debounce: 合并写入的时间窗口（秒）
+    """
+
+    def __init__(self, path, snapshot, debounce=DEFAULT_DEBOUNCE):
+        self.path = path
+        self._snapshot = snapshot
+        self.debounce = debounce
+        self._last_written = None
+        self._dirty = False
+        self._flush_task = None
+        self._lock = None
+
+    def mark_clean(self):
+        """当前内容与文件一致（如刚从文件加载），之后没有变化时不写文件"""
+        self._last_written = self._snapshot()
+
+    def save(self):
+        """请求保存配置，返回是否已接受保存请求"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self._flush_sync()
+
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+        return True
+
+    async def _flush_later(self):
+        # 写入期间到达的保存请求会在下一轮写入
+        while self._dirty:
+            await asyncio.sleep(self.debounce)
+            self._dirty = False
+            await self.flush()
+
+    async def flush(self):
+        """立即写入尚未保存的变化"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            document = self._snapshot()
+            if document == self._last_written:
+                return True
+            if not await asyncio.to_thread(_write_atomic, self.path, document):
+                return False
+            self._last_written = document
+            logger.debug(f"[Yuewen] 配置已保存到TOML文件: {self.path}")
+            return True
+
+    def _flush_sync(self):
+        document = self._snapshot()
+        if document == self._last_written:
+            return True
+        if not _write_atomic(self.path, document):
+            return False
+        self._last_written = document
+        logger.info(f"[Yuewen] 配置已保存到TOML文件: {self.path}")
+        return True
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""请求上下文
+
+一条消息从进入 handle_text / handle_image 到回复完成期间的状态（bot、消息、
+回复对象、图片是否已直接发送等）保存在 contextvars 中，而不是插件实例上。
+并发处理多条消息时每条消息（以及它派生出的子任务）只看到自己的上下文。
+
+每条消息还带有处理时限，所有上游请求的超时都不会超过剩余时间。
+
+用法::
+
+    ctx = context.begin(bot, message, reply_to=from_wxid, user_id=user_id)
+    ...
+    context.current().image_sent = True
+"""
+import asyncio
+import contextvars
+import time
+
+# 单条消息的默认处理时限（秒），包括流式回答和图片生成轮询
+DEFAULT_DEADLINE = 300
+
+
+class RequestContext:
+    """单条消息的处理状态"""
+
+    __slots__ = (
+        'bot', 'message', 'reply_to', 'user_id', 'image_sent', 'image_error',
+        'deadline', 'route', 'first_text', 'first_text_at', 'on_text', '_held_text',
+    )
+
+    def __init__(self, bot=None, message=None, reply_to=None, user_id=None, deadline=None):
+        self.bot = bot
+        self.message = message
+        self.reply_to = reply_to        # 回复发送到的wxid（群聊时为群ID）
+        self.user_id = user_id
+        self.image_sent = False         # 生成的图片是否已直接发送给用户
+        self.image_error = None         # 最近一次图片生成的错误信息
+        self.deadline = deadline        # 处理时限（time.monotonic()），None 表示不限
+        self.route = None               # 自适应路由选择的 (API版本, 模型ID, 是否联网)，None 表示按会话设置
+        self.first_text = None          # 收到首个文本时触发的 asyncio.Event（对冲请求使用）
+        self.first_text_at = None       # 收到首个文本的时间（time.monotonic()）
+        self.on_text = None             # 流式输出的回调，参数为新收到的文本片段（HTTP网关使用）
+        self._held_text = None          # 暂存的流式输出，None 表示直接输出
+
+    @property
+    def can_reply(self):
+        return self.bot is not None and bool(self.reply_to)
+
+    def mark_first_text(self):
+        """记录首个文本到达的时间，只记录第一次"""
+        if self.first_text_at is None:
+            self.first_text_at = time.monotonic()
+            if self.first_text is not None:
+                self.first_text.set()
+
+    def stream_text(self, text):
+        """把新收到的回答文本交给流式输出的订阅者"""
+        if self.on_text is not None and text:
+            if self._held_text is not None:
+                self._held_text.append(text)
+            else:
+                self.on_text(text)
+
+    def release_text(self):
+        """输出暂存的流式文本，之后收到的文本直接输出"""
+        held, self._held_text = self._held_text, None
+        if held:
+            self.on_text(''.join(held))
+
+    def remaining(self):
+        """距离处理时限的剩余秒数，没有时限时返回 None"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def clamp_timeout(self, timeout):
+        """把请求超时限制在剩余时间内，已超过时限时抛出 asyncio.TimeoutError"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise asyncio.TimeoutError("已超过本条消息的处理时限")
+        return min(timeout, remaining) if timeout else remaining
+
+
+_current = contextvars.ContextVar('yuewen_request_context', default=None)
+
+
+def begin(bot, message, reply_to=None, user_id=None, deadline=DEFAULT_DEADLINE):
+    """开始处理一条消息，返回新的请求上下文
+
+    Args:
+        deadline: 处理时限（秒），None 表示不限
+    """
+    expires_at = time.monotonic() + deadline if deadline else None
+    ctx = RequestContext(bot, message, reply_to or message.get("FromWxid"), user_id, expires_at)
+    _current.set(ctx)
+    return ctx
+
+
+def fork(first_text=None):
+    """复制一份当前的请求上下文，在子任务中用 use() 设为当前上下文
+
+    同一条消息并发发出多路请求（如对冲请求）时，每一路使用自己的副本，
+    图片发送状态、首个文本时间等各自记录，处理时限保持不变。各路的流式输出
+    先暂存，由调用方对选中的一路调用 release_text()，避免订阅者收到交错的回答。
+    """
+    parent = current()
+    ctx = RequestContext(parent.bot, parent.message, parent.reply_to, parent.user_id, parent.deadline)
+    ctx.route = parent.route
+    ctx.on_text = parent.on_text
+    ctx.first_text = first_text
+    if ctx.on_text is not None:
+        ctx._held_text = []
+    return ctx
+
+
+def use(ctx):
+    """把请求上下文设为当前任务的上下文"""
+    _current.set(ctx)
+    return ctx
+
+
+def current():
+    """当前请求上下文；不在消息处理中时（如后台任务）返回一个空上下文"""
+    ctx = _current.get()
+    if ctx is None:
+        ctx = RequestContext()
+        _current.set(ctx)
+    return ctx
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Connect 帧预分类
+
+深度思考模型的回答中大部分帧是思考过程（新版API的 reasoningEvent、旧版API
+stage 为 TEXT_STAGE_THINKING 的 textEvent），另外还有心跳帧。这些帧不需要参与
+回答的拼接，完整解码后再丢弃是浪费。
+
+这里只检查帧负载开头的字节来识别事件类型：
+
+- 上游返回的是紧凑JSON，事件字段名紧跟在固定前缀之后，可以直接截取
+- 字符串值中的引号一定被转义，因此结构性的片段（如 "stage":"..."）不会出现在
+  文本内容里，字节查找不会误判
+- 前缀不符时返回 None，调用方照常完整解码
+
+需要保留思考过程时，帧以原始字节保存在 ReasoningTrace 中，只有用户查看
+（yw思考过程）时才解码。
+"""
+from . import codec
+
+# 新版API帧: {"data":{"event":{"<事件名>":{...}}}}
+_NEW_EVENT_PREFIX = b'{"data":{"event":{"'
+_MAX_EVENT_NAME = 48
+
+# 旧版API帧: {"textEvent":{"stage":"...","text":"..."}}
+_OLD_TEXT_PREFIX = b'{"textEvent":{'
+_THINKING_STAGE = b'"stage":"TEXT_STAGE_THINKING"'
+
+REASONING_EVENT = b'reasoningEvent'
+HEARTBEAT_EVENT = b'heartBeatEvent'
+
+# 单次回答保留的思考过程原始帧上限（字节）
+MAX_TRACE_BYTES = 512 * 1024
+
+
+def new_event_name(payload):
+    """新版API帧的事件字段名（bytes），无法从开头识别时返回 None"""
+    if not payload.startswith(_NEW_EVENT_PREFIX):
+        return None
+    start = len(_NEW_EVENT_PREFIX)
+    end = payload.find(b'"', start, start + _MAX_EVENT_NAME)
+    if end < 0:
+        return None
+    return payload[start:end]
+
+
+def is_old_thinking(payload):
+    """旧版API帧是否为思考阶段的文本"""
+    return payload.startswith(_OLD_TEXT_PREFIX) and _THINKING_STAGE in payload
+
+
+def _new_reasoning_text(frame):
+    event = frame.get('data', {}).get('event', {}).get('reasoningEvent') or {}
+    return event.get('text') or event.get('content') or ''
+
+
+def _old_thinking_text(frame):
+    return (frame.get('textEvent') or {}).get('text') or ''
+
+
+class ReasoningTrace:
+    """一次回答的思考过程，保存原始帧，需要时才解码"""
+
+    __slots__ = ('_frames', '_extract', 'size', 'truncated')
+
+    def __init__(self, extract):
+        self._frames = []
+        self._extract = extract
+        self.size = 0
+        self.truncated = False
+
+    @classmethod
+    def new_api(cls):
+        return cls(_new_reasoning_text)
+
+    @classmethod
+    def old_api(cls):
+        return cls(_old_thinking_text)
+
+    def add(self, payload):
+        if self.size + len(payload) > MAX_TRACE_BYTES:
+            self.truncated = True
+            return
+        self._frames.append(payload)
+        self.size += len(payload)
+
+    def __bool__(self):
+        return bool(self._frames)
+
+    def text(self):
+        """解码保存的帧，拼接思考过程文本"""
+        parts = []
+        for payload in self._frames:
+            try:
+                parts.append(self._extract(codec.loads(payload)))
+            except codec.DecodeError:
+                continue
+        return ''.join(parts)
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""本地HTTP/SSE网关
+
+可选的内嵌aiohttp服务（默认关闭），把插件的会话管理、上游连接、账号池和限流开放给
+本机的其他服务，不必各自维护一套登录和抓取逻辑。网关的请求与微信消息走同一条处理路径：
+同样的会话状态、令牌刷新、账号分配、上传缓存和处理时限。
+
+接口（JSON，配置了 token 时需要 Authorization: Bearer <token>）：
+
+- POST /v1/chat
+  {"conversation": "名称", "message": "问题", "images": ["图片ID"], "stream": true}
+  默认以SSE流式返回：job（任务ID）、delta（新收到的文本）、done（完整回答）或
+  error 事件；stream 为 false 时在后台执行，立即返回任务ID。
+  同一会话的新问题会取消进行中的回答，SSE客户端断开时回答也会停止。
+- POST /v1/images?conversation=名称
+  请求体为图片数据（或 multipart 表单的 file 字段），在该会话的账号下上传，返回图片ID
+- GET /v1/jobs/{id}      查询任务状态和结果
+- DELETE /v1/jobs/{id}   取消进行中的任务
+
+网关的会话与微信会话相互独立（会话ID带 gateway: 前缀）。
+"""
+import asyncio
+import hmac
+import time
+import uuid
+from collections import OrderedDict
+
+from aiohttp import web
+from loguru import logger
+
+from . import codec, context
+from .image_buffer import ImageBuffer
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_JOBS = 256          # 保留状态的任务数上限
+DEFAULT_MAX_UPLOAD = 20 * 1024 * 1024
+DEFAULT_IMAGE_TTL = 1800        # 上传的图片在该时间（秒）内可以引用
+
+MAX_IMAGES = 256
+MAX_CONVERSATION_NAME = 64
+CONVERSATION_PREFIX = 'gateway:'
+KEEPALIVE_INTERVAL = 15         # SSE 空闲时发送注释行的间隔（秒），也用于发现客户端断开
+
+_LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+
+class GatewayError(Exception):
+    """请求无法处理，转换为对应状态码的JSON错误"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Job:
+    """一次问答任务的状态和事件订阅"""
+
+    __slots__ = (
+        'id', 'conversation', 'status', 'text', 'error',
+        'created_at', 'finished_at', 'task', '_listeners',
+    )
+
+    def __init__(self, conversation):
+        self.id = uuid.uuid4().hex
+        self.conversation = conversation
+        self.status = 'running'         # running / done / failed / cancelled
+        self.text = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+        self._listeners = []
+
+    @property
+    def finished(self):
+        return self.status != 'running'
+
+    def listen(self):
+        queue = asyncio.Queue()
+        self._listeners.append(queue)
+        return queue
+
+    def unlisten(self, queue):
+        if queue in self._listeners:
+            self._listeners.remove(queue)
+
+    def publish(self, event, data):
+        for queue in self._listeners:
+            queue.put_nowait((event, data))
+
+    def finish(self, status, text=None, error=None):
+        self.status = status
+        self.text = text
+        self.error = error
+        self.finished_at = time.time()
+        if status == 'done':
+            self.publish('done', {'id': self.id, 'text': text})
+        else:
+            self.publish('error', {'id': self.id, 'status': status, 'error': error})
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'conversation': self.conversation[len(CONVERSATION_PREFIX):],
+            'status': self.status,
+            'text': self.text,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+
+
+def _json(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda obj: codec.dumps(obj).decode('utf-8'))
+
+
+def _sse(event, data):
+    return b'event: ' + event.encode() + b'\ndata: ' + codec.dumps(data) + b'\n\n'
+
+
+class Gateway:
+    """内嵌的HTTP/SSE服务"""
+
+    def __init__(self, plugin, enabled=False, host=DEFAULT_HOST, port=DEFAULT_PORT, token=None,
+                 max_jobs=DEFAULT_MAX_JOBS, max_upload=DEFAULT_MAX_UPLOAD, image_ttl=DEFAULT_IMAGE_TTL):
+        self.plugin = plugin
+        self.enabled = enabled
+        self.host = host
+        self.port = port
+        self.token = token
+        self.max_jobs = max_jobs
+        self.max_upload = max_upload
+        self.image_ttl = image_ttl
+        self.jobs = OrderedDict()       # 任务ID -> Job
+        self.images = OrderedDict()     # 图片ID -> 上传记录
+        self._runner = None
+
+    @classmethod
+    def from_config(cls, plugin, config):
+        config = config or {}
+        return cls(
+            plugin,
+            enabled=bool(config.get('enabled', False)),
+            host=config.get('host', DEFAULT_HOST),
+            port=int(config.get('port', DEFAULT_PORT)),
+            token=config.get('token') or None,
+            max_jobs=int(config.get('max_jobs', DEFAULT_MAX_JOBS)),
+            max_upload=int(config.get('max_upload', DEFAULT_MAX_UPLOAD)),
+            image_ttl=float(config.get('image_ttl', DEFAULT_IMAGE_TTL)),
+        )
+
+    # ---- 启动与停止 ----
+
+    async def start(self):
+        if not self.enabled or self._runner is not None:
+            return
+        if self.host not in _LOOPBACK_HOSTS and not self.token:
+            logger.warning(f"[Yuewen] HTTP网关监听 {self.host} 但没有配置token，任何能访问该地址的人都可以使用账号")
+
+        app = web.Application(client_max_size=self.max_upload, middlewares=[self._middleware])
+        app.router.add_post('/v1/chat', self._handle_chat)
+        app.router.add_post('/v1/images', self._handle_upload)
+        app.router.add_get('/v1/jobs/{job_id}', self._handle_job)
+        app.router.add_delete('/v1/jobs/{job_id}', self._handle_cancel)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            await runner.cleanup()
+            logger.error(f"[Yuewen] HTTP网关启动失败 {self.host}:{self.port}: {e}")
+            return
+        self._runner = runner
+        logger.info(f"[Yuewen] HTTP网关已启动: http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner is None:
+            return
+        for job in self.jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+        await self._runner.cleanup()
+        self._runner = None
+        logger.info("[Yuewen] HTTP网关已停止")
+
+    # ---- 通用处理 ----
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        if self.token and not hmac.compare_digest(
+                request.headers.get('Authorization', ''), f"Bearer {self.token}"):
+            return _json({'error': '未授权'}, status=401)
+        try:
+            return await handler(request)
+        except GatewayError as e:
+            return _json({'error': e.message}, status=e.status)
+
+    @staticmethod
+    def _conversation_id(name):
+        name = 'default' if name is None else name
+        if not isinstance(name, str) or not name or len(name) > MAX_CONVERSATION_NAME:
+            raise GatewayError(400, f"conversation 必须是不超过{MAX_CONVERSATION_NAME}个字符的字符串")
+        return CONVERSATION_PREFIX + name
+
+    def _begin(self, conversation):
+        """在当前任务中激活会话和请求上下文，之后的调用与微信消息走同一条路径"""
+        plugin = self.plugin
+        if not plugin.enable:
+            raise GatewayError(503, "插件未启用")
+        plugin._activate_conversation(conversation)
+        return context.begin(None, {}, None, conversation, deadline=plugin.generation_deadline)
+
+    async def _ensure_login(self):
+        if await self.plugin._check_login_status_async():
+            raise GatewayError(503, "跃问账号未登录或已失效，请先在微信中发送\"yw登录\"")
+
+    # ---- 图片上传 ----
+
+    async def _read_image(self, request):
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            while True:
+                part = await reader.next()
+                if part is None:
+                    return None
+                if part.name == 'file':
+                    return await part.read(decode=False)
+        return await request.read()
+
+    async def _handle_upload(self, request):
+        conversation = self._conversation_id(request.query.get('conversation'))
+        data = await self._read_image(request)
+        if not data:
+            raise GatewayError(400, "图片数据为空")
+
+        self._begin(conversation)
+        await self._ensure_login()
+        image = await ImageBuffer.create(data, spill_dir=self.plugin.temp_dir)
+        with image:
+            image_info, error_detail = await self.plugin._upload_image_async(image)
+        if not image_info:
+            raise GatewayError(502, f"图片上传失败{error_detail}")
+
+        image_id = uuid.uuid4().hex
+        conversation_state = self.plugin.conversation
+        self.images[image_id] = {
+            'conversation': conversation,
+            'api_version': conversation_state['api_version'],
+            'account': conversation_state['account'],
+            'info': image_info,
+            'expires_at': time.time() + self.image_ttl,
+        }
+        while len(self.images) > MAX_IMAGES:
+            self.images.popitem(last=False)
+        return _json({
+            'id': image_id,
+            'width': image_info['width'],
+            'height': image_info['height'],
+            'size': image_info['size'],
+        })
+
+    def _resolve_images(self, conversation, image_ids):
+        """把图片ID换成上传结果；图片只能在上传时的会话、API版本和账号下使用"""
+        if not image_ids:
+            return []
+        if not isinstance(image_ids, list):
+            raise GatewayError(400, "images 必须是图片ID列表")
+        state = self.plugin.conversation
+        images = []
+        for image_id in image_ids:
+            record = self.images.get(image_id) if isinstance(image_id, str) else None
+            if record is None or record['expires_at'] <= time.time() or record['conversation'] != conversation:
+                raise GatewayError(404, f"图片不存在或已过期: {image_id}")
+            if record['api_version'] != state['api_version'] or record['account'] != state['account']:
+                raise GatewayError(409, f"会话的后端或账号已变化，请重新上传图片: {image_id}")
+            images.append(record['info'])
+        return images
+
+    # ---- 问答 ----
+
+    async def _handle_chat(self, request):
+        try:
+            body = await request.json(loads=codec.loads)
+        except codec.DecodeError:
+            raise GatewayError(400, "请求体不是有效的JSON")
+        if not isinstance(body, dict):
+            raise GatewayError(400, "请求体必须是JSON对象")
+        message = body.get('message')
+        if not isinstance(message, str) or not message.strip():
+            raise GatewayError(400, "message 不能为空")
+        conversation = self._conversation_id(body.get('conversation'))
+
+        self._begin(conversation)
+        images = self._resolve_images(conversation, body.get('images'))
+        await self._ensure_login()
+
+        job = self._create_job(conversation)
+        if body.get('stream', True) is False:
+            self._start(job, message.strip(), images)
+            return _json(job.to_dict(), status=202)
+
+        queue = job.listen()
+        self._start(job, message.strip(), images)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream; charset=utf-8',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        try:
+            await response.prepare(request)
+            await response.write(_sse('job', {'id': job.id}))
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await response.write(b': ping\n\n')
+                    continue
+                await response.write(_sse(event, data))
+                if event != 'delta':
+                    break
+        except ConnectionResetError:
+            # 客户端断开，停止生成
+            logger.info(f"[Yuewen] HTTP网关客户端断开，取消任务 {job.id}")
+            job.task.cancel()
+        except asyncio.CancelledError:
+            job.task.cancel()
+            raise
+        finally:
+            job.unlisten(queue)
+        return response
+
+    def _start(self, job, message, images):
+        job.task = asyncio.create_task(self._run(job, message, images))
+        # 任务开始执行前就被取消时 _run 不会运行，在这里补记状态
+        job.task.add_done_callback(lambda _: job.finished or job.finish('cancelled', error="任务已取消"))
+
+    async def _run(self, job, message, images):
+        plugin = self.plugin
+        ctx = self._begin(job.conversation)
+        ctx.on_text = lambda text: job.publish('delta', {'text': text})
+        try:
+            attachments = [plugin.backend.build_attachment(image) for image in images] or None
+            cancelled, result = await plugin._run_generation(plugin.send_message_async(message, attachments))
+        except asyncio.CancelledError:
+            job.finish('cancelled', error="任务已取消")
+            raise
+        except Exception as e:
+            logger.error(f"[Yuewen] HTTP网关任务 {job.id} 异常: {e}", exc_info=True)
+            job.finish('failed', error=str(e))
+            return
+
+        if cancelled:
+            job.finish('cancelled', error="被同一会话的新问题取消")
+            return
+        # 两版API都返回回答文本，错误时为提示文本；图片直接发送时只有 image_sent 标记
+        if ctx.image_sent:
+            job.finish('done', text=result or "[图片已发送]")
+        elif isinstance(result, str) and plugin._is_successful_response(result):
+            job.finish('done', text=result)
+        else:
+            job.finish('failed', error=result if isinstance(result, str) and result else "未获得有效回复")
+
+    def _create_job(self, conversation):
+        job = Job(conversation)
+        self.jobs[job.id] = job
+        # 超出上限时丢弃最早完成的任务，进行中的任务保留
+        if len(self.jobs) > self.max_jobs:
+            for job_id in [j.id for j in self.jobs.values() if j.finished][:len(self.jobs) - self.max_jobs]:
+                del self.jobs[job_id]
+        return job
+
+    # ---- 任务查询 ----
+
+    def _get_job(self, request):
+        job = self.jobs.get(request.match_info['job_id'])
+        if job is None:
+            raise GatewayError(404, "任务不存在")
+        return job
+
+    async def _handle_job(self, request):
+        return _json(self._get_job(request).to_dict())
+
+    async def _handle_cancel(self, request):
+        job = self._get_job(request)
+        if not job.finished and job.task is not None:
+            job.task.cancel()
+            # 等待任务处理取消并记录状态
+            await asyncio.wait({job.task})
+        return _json(job.to_dict())
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""热路径日志
+
+流式解析、帧轮询、图片下载等高频路径上的调试日志。每个子系统可以在运行时
+单独开关（默认关闭，可通过 "yw日志" 管理命令切换）：
+
+- 关闭时调用直接返回，不做任何字符串格式化
+- 开启后通过 loguru 的 lazy 模式输出，参数必须是无参函数，只有日志级别
+  实际放行时才会求值
+- 高频消息可以按 key 采样，每 N 条只输出 1 条
+
+用法::
+
+    _log = hotlog.get('stream')
+    _log.debug("收到文本: {}", lambda: text[:20])
+    _log.sampled('frame', "收到帧: {}", lambda: str(frame)[:100])
+"""
+from loguru import logger
+
+# 子系统 -> 说明
+SUBSYSTEMS = {
+    'stream': '流式响应解析',
+    'poll': '图片生成轮询',
+    'download': '图片下载',
+    'upload': '图片上传',
+}
+
+DEFAULT_SAMPLE_EVERY = 20
+
+_enabled = dict.fromkeys(SUBSYSTEMS, False)
+_loggers = {}
+
+
+class HotLogger:
+    """单个子系统的热路径日志"""
+
+    __slots__ = ('subsystem', '_counters')
+
+    def __init__(self, subsystem):
+        self.subsystem = subsystem
+        self._counters = {}
+
+    @property
+    def enabled(self):
+        return _enabled.get(self.subsystem, False)
+
+    def debug(self, message, *args):
+        if _enabled.get(self.subsystem):
+            logger.opt(lazy=True, depth=1).debug(message, *args)
+
+    def sampled(self, key, message, *args, every=DEFAULT_SAMPLE_EVERY):
+        """同一 key 的消息每 every 条只输出第一条"""
+        if not _enabled.get(self.subsystem):
+            return
+        count = self._counters.get(key, 0)
+        self._counters[key] = count + 1
+        if count % every == 0:
+            logger.opt(lazy=True, depth=1).debug(
+                message + " [采样 1/{}, 累计{}条]", *args, lambda: every, lambda: count + 1
+            )
+
+
+def get(subsystem):
+    """获取子系统的热路径日志"""
+    hot_logger = _loggers.get(subsystem)
+    if hot_logger is None:
+        if subsystem not in SUBSYSTEMS:
+            raise ValueError(f"未知的日志子系统: {subsystem}")
+        hot_logger = _loggers[subsystem] = HotLogger(subsystem)
+    return hot_logger
+
+
+def set_enabled(subsystem, enabled):
+    """开关子系统的热路径日志，subsystem 为 None 时作用于全部子系统"""
+    names = list(SUBSYSTEMS) if subsystem is None else [subsystem]
+    for name in names:
+        if name not in SUBSYSTEMS:
+            raise ValueError(f"未知的日志子系统: {name}")
+        _enabled[name] = bool(enabled)
+        if name in _loggers:
+            _loggers[name]._counters.clear()
+
+
+def status():
+    """返回 {子系统: 是否开启}"""
+    return dict(_enabled)
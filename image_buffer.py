@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""图片数据缓冲
+
+识图流程中的图片数据统一由 ImageBuffer 持有，避免在各环节之间反复复制：
+
+- 已经在磁盘上的图片（md5文件、系统缓存路径）直接引用文件，不读入内存
+- 内存中的图片超过单张阈值，或所有缓冲占用的内存超过全局上限时，写入临时文件
+- 上传时按需打开文件对象（BytesIO 与原 bytes 共享内存），由 aiohttp 分块发送，
+  不再生成完整的请求体副本
+- 统计当前缓冲在内存中的字节数
+
+用法::
+
+    buffer = await ImageBuffer.create(image_data, spill_dir=temp_dir)
+    with buffer:
+        await backend.upload_image(buffer)
+"""
+import asyncio
+import hashlib
+import io
+import os
+import uuid
+
+from loguru import logger
+
+# 单张图片超过该大小时写入临时文件
+SPILL_THRESHOLD = 4 * 1024 * 1024
+# 所有缓冲在内存中占用的总字节数上限，超出时新的图片写入临时文件
+MEMORY_CAP = 48 * 1024 * 1024
+
+_memory_bytes = 0
+
+
+def memory_bytes():
+    """当前所有缓冲在内存中占用的字节数"""
+    return _memory_bytes
+
+
+class ImageBuffer:
+    """单张图片的数据，保存在内存或文件中"""
+
+    __slots__ = ('_data', 'path', 'size', '_owns_file', '_closed', '_digest')
+
+    def __init__(self, data=None, path=None, size=0, owns_file=False):
+        global _memory_bytes
+        self._data = data
+        self.path = path
+        self.size = size
+        self._owns_file = owns_file
+        self._closed = False
+        self._digest = None
+        if data is not None:
+            _memory_bytes += size
+
+    @classmethod
+    async def create(cls, data, spill_dir=None):
+        """从内存中的图片数据创建缓冲，必要时写入 spill_dir 下的临时文件"""
+        size = len(data)
+        if spill_dir and (size > SPILL_THRESHOLD or _memory_bytes + size > MEMORY_CAP):
+            path = os.path.join(spill_dir, f"img_{uuid.uuid4().hex}.bin")
+            try:
+                await asyncio.to_thread(_write_file, path, data)
+                logger.debug(f"[Yuewen] 图片({size}字节)写入临时文件，当前内存占用 {_memory_bytes} 字节")
+                return cls(path=path, size=size, owns_file=True)
+            except OSError as e:
+                logger.warning(f"[Yuewen] 图片写入临时文件失败，保留在内存中: {e}")
+        elif _memory_bytes + size > MEMORY_CAP:
+            logger.warning(f"[Yuewen] 图片缓冲超过内存上限且没有临时目录，当前内存占用 {_memory_bytes} 字节")
+        return cls(data=bytes(data), size=size)
+
+    @classmethod
+    def from_file(cls, path):
+        """引用已经在磁盘上的图片，不读入内存"""
+        return cls(path=path, size=os.path.getsize(path))
+
+    @property
+    def in_memory(self):
+        return self._data is not None
+
+    def open(self):
+        """返回新的只读文件对象，每次上传（包括重试）各自打开"""
+        if self._closed:
+            raise ValueError("图片缓冲已释放")
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        return open(self.path, 'rb')
+
+    async def read(self):
+        """读取完整数据（发送接口只接受 bytes 时使用）"""
+        if self._data is not None:
+            return self._data
+        return await asyncio.to_thread(_read_file, self.path)
+
+    async def digest(self):
+        """图片内容的SHA-1（十六进制），用作上传缓存的key；文件在线程中计算"""
+        if self._digest is None:
+            if self._data is not None:
+                self._digest = hashlib.sha1(self._data).hexdigest()
+            else:
+                self._digest = await asyncio.to_thread(_file_digest, self.path)
+        return self._digest
+
+    def dimensions(self, default=(800, 600)):
+        """读取图片尺寸，只解析文件头"""
+        try:
+            from PIL import Image
+            with self.open() as f, Image.open(f) as img:
+                return img.size
+        except Exception as e:
+            logger.error(f"[Yuewen] 获取图片尺寸失败: {e}")
+            return default
+
+    def close(self):
+        """释放内存计数并删除自己创建的临时文件"""
+        global _memory_bytes
+        if self._closed:
+            return
+        self._closed = True
+        if self._data is not None:
+            _memory_bytes -= self.size
+            self._data = None
+        if self._owns_file:
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logger.warning(f"[Yuewen] 删除图片临时文件失败: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""图片获取策略
+
+收到图片消息后有多种获取图片数据的方法：本地的（md5文件、ImgBuf、缓存路径等）
+代价很小，远程的（CDN下载、按MsgId拉取）可能很慢甚至卡住。
+
+- 本地方法立即依次执行
+- 本地方法全部失败后并发竞速远程方法：最常成功的远程方法先启动，领先一小段
+  时间后其余方法也加入竞速，任一方法成功即取消其他方法；每个方法有独立超时
+- 记录每个方法的成功次数，之后按成功次数排序，当前部署最常成功的方法最先尝试
+"""
+import asyncio
+import time
+
+from loguru import logger
+
+from . import hotlog
+
+# 最常成功的远程方法领先其他方法启动的秒数
+REMOTE_HEAD_START = 1.0
+
+_log = hotlog.get('download')
+
+
+class Strategy:
+    """一种获取图片的方法
+
+    func(*args) 返回 (图片路径, 图片数据)，图片在磁盘上时可以只返回路径，
+    失败返回 None 或 (None, None)。
+    """
+
+    __slots__ = ('name', 'func', 'remote', 'timeout')
+
+    def __init__(self, name, func, remote=False, timeout=None):
+        self.name = name
+        self.func = func
+        self.remote = remote
+        self.timeout = timeout
+
+
+class ImageDownloader:
+    """按成功率排序并竞速执行的图片获取策略"""
+
+    def __init__(self, strategies, head_start=REMOTE_HEAD_START):
+        self.strategies = list(strategies)
+        self.head_start = head_start
+        self.stats = {s.name: {'success': 0, 'failure': 0, 'timeout': 0} for s in self.strategies}
+
+    def _ranked(self, remote):
+        """按成功次数排序，次数相同时保持注册顺序"""
+        candidates = [s for s in self.strategies if s.remote == remote]
+        return sorted(candidates, key=lambda s: -self.stats[s.name]['success'])
+
+    async def _run(self, strategy, args):
+        started = time.monotonic()
+        try:
+            if strategy.timeout:
+                result = await asyncio.wait_for(strategy.func(*args), strategy.timeout)
+            else:
+                result = await strategy.func(*args)
+        except asyncio.TimeoutError:
+            self.stats[strategy.name]['timeout'] += 1
+            logger.warning(f"[Yuewen] 图片获取方法 {strategy.name} 超时({strategy.timeout}秒)")
+            return None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats[strategy.name]['failure'] += 1
+            logger.warning(f"[Yuewen] 图片获取方法 {strategy.name} 失败: {e}")
+            return None
+
+        if not result or not (result[0] or result[1]):
+            self.stats[strategy.name]['failure'] += 1
+            return None
+
+        self.stats[strategy.name]['success'] += 1
+        _log.debug(
+            "[Yuewen] 图片获取方法 {} 成功，耗时{:.2f}秒",
+            lambda: strategy.name, lambda: time.monotonic() - started
+        )
+        return result
+
+    async def _race(self, remotes, args):
+        """竞速执行远程方法，返回第一个成功的结果"""
+        first, rest = remotes[0], remotes[1:]
+        tasks = {asyncio.create_task(self._run(first, args)): first}
+        rest_started = not rest
+
+        try:
+            while tasks:
+                timeout = None if rest_started else self.head_start
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del tasks[task]
+                    result = task.result()
+                    if result:
+                        return result
+                if not rest_started and (not done or not tasks):
+                    # 领先时间已到或领先的方法已失败，其余方法加入竞速
+                    _log.debug("[Yuewen] 启动其余远程图片获取方法: {}", lambda: [s.name for s in rest])
+                    for strategy in rest:
+                        tasks[asyncio.create_task(self._run(strategy, args))] = strategy
+                    rest_started = True
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch(self, *args):
+        """获取图片，返回 (图片路径, 图片数据)，全部失败时返回 (None, None)"""
+        for strategy in self._ranked(remote=False):
+            result = await self._run(strategy, args)
+            if result:
+                return result
+
+        remotes = self._ranked(remote=True)
+        if remotes:
+            result = await self._race(remotes, args)
+            if result:
+                return result
+        return None, None
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""延迟统计与自适应路由
+
+按 key 记录真实请求最近若干次的耗时和成败，用于估计分位数（如p95）和失败率。
+
+自适应路由（默认关闭）在简短问题或高负载时，根据统计把请求改派到更快的
+(模型, 联网模式) 组合，以满足配置的p95目标：
+
+- 用户手动选择的组合已满足目标，或样本不足时不改派
+- 只在样本充足、失败率不高的组合中选择p95最低的一个
+- 只会关闭联网，不会替用户开启联网
+"""
+import math
+from collections import deque
+
+DEFAULT_WINDOW = 50
+
+DEFAULT_P95_TARGET = 30.0
+DEFAULT_SHORT_PROMPT = 30
+DEFAULT_LOAD_THRESHOLD = 4
+DEFAULT_MIN_SAMPLES = 5
+DEFAULT_MAX_FAILURE_RATE = 0.3
+
+
+class LatencyWindow:
+    """单个 key 最近若干次请求的耗时和成败"""
+
+    __slots__ = ('samples', 'outcomes')
+
+    def __init__(self, size=DEFAULT_WINDOW):
+        self.samples = deque(maxlen=size)   # 成功请求的耗时（秒）
+        self.outcomes = deque(maxlen=size)  # 每次请求是否成功
+
+    def record(self, seconds, ok=True):
+        self.outcomes.append(ok)
+        if ok:
+            self.samples.append(seconds)
+
+    def percentile(self, q):
+        """成功请求耗时的分位数（q 取 0~1），没有样本时返回 None"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        # 最近秩法
+        index = min(len(ordered), max(1, math.ceil(q * len(ordered)))) - 1
+        return ordered[index]
+
+    @property
+    def failure_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def __len__(self):
+        return len(self.outcomes)
+
+
+class LatencyTracker:
+    """按 key 分别统计的滚动延迟窗口"""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._windows = {}
+
+    def record(self, key, seconds, ok=True):
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = LatencyWindow(self.window)
+        window.record(seconds, ok)
+
+    def get(self, key):
+        return self._windows.get(key)
+
+    def percentile(self, key, q, min_samples=1):
+        """key 的耗时分位数，样本不足时返回 None"""
+        window = self._windows.get(key)
+        if window is None or len(window.samples) < min_samples:
+            return None
+        return window.percentile(q)
+
+    def stats(self):
+        """{key: (请求数, p50, p95, 失败率)}"""
+        return {
+            key: (len(window), window.percentile(0.5), window.percentile(0.95), window.failure_rate)
+            for key, window in self._windows.items()
+        }
+
+
+class AdaptiveRouting:
+    """按p95目标自动选择路由
+
+    路由是可哈希的元组，如 (API版本, 模型ID, 是否联网)，直接作为统计的 key。
+    """
+
+    def __init__(self, tracker, enabled=False, p95_target=DEFAULT_P95_TARGET,
+                 short_prompt=DEFAULT_SHORT_PROMPT, load_threshold=DEFAULT_LOAD_THRESHOLD,
+                 min_samples=DEFAULT_MIN_SAMPLES, max_failure_rate=DEFAULT_MAX_FAILURE_RATE):
+        self.tracker = tracker
+        self.enabled = enabled
+        self.p95_target = p95_target
+        self.short_prompt = short_prompt
+        self.load_threshold = load_threshold
+        self.min_samples = min_samples
+        self.max_failure_rate = max_failure_rate
+
+    @classmethod
+    def from_config(cls, tracker, config):
+        config = config or {}
+        return cls(
+            tracker,
+            enabled=bool(config.get('enabled', False)),
+            p95_target=float(config.get('p95_target', DEFAULT_P95_TARGET)),
+            short_prompt=int(config.get('short_prompt', DEFAULT_SHORT_PROMPT)),
+            load_threshold=int(config.get('load_threshold', DEFAULT_LOAD_THRESHOLD)),
+            min_samples=int(config.get('min_samples', DEFAULT_MIN_SAMPLES)),
+            max_failure_rate=float(config.get('max_failure_rate', DEFAULT_MAX_FAILURE_RATE)),
+        )
+
+    def _p95(self, route):
+        """路由的p95，样本不足或失败率过高时返回 None"""
+        window = self.tracker.get(route)
+        if window is None or len(window.samples) < self.min_samples:
+            return None
+        if window.failure_rate > self.max_failure_rate:
+            return None
+        return window.percentile(0.95)
+
+    def choose(self, preferred, candidates, prompt, load):
+        """选择本次请求的路由
+
+        Args:
+            preferred: 用户手动选择的路由
+            candidates: 可以改派到的路由
+            prompt: 归一化后的问题
+            load: 当前进行中的请求数
+
+        Returns:
+            tuple: (路由, 改派原因)，不改派时原因为 None
+        """
+        if not self.enabled:
+            return preferred, None
+        if load >= self.load_threshold:
+            reason = f"负载较高({load}个进行中的请求)"
+        elif len(prompt) <= self.short_prompt:
+            reason = "简短问题"
+        else:
+            return preferred, None
+
+        current = self._p95(preferred)
+        if current is not None and current <= self.p95_target:
+            return preferred, None
+
+        best, best_p95 = None, None
+        for route in candidates:
+            p95 = self._p95(route)
+            if p95 is not None and (best_p95 is None or p95 < best_p95):
+                best, best_p95 = route, p95
+        if best is None or best == preferred or (current is not None and best_p95 >= current):
+            return preferred, None
+        return best, f"{reason}，p95 {best_p95:.1f}秒"
@@ -1,16 +1,167 @@
 # -*- coding: utf-8 -*-
+import base64
+import binascii
 import json
 import os
+import random
 import time
+import traceback
+from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
 import aiohttp
 from loguru import logger
 import asyncio
-import requests
-import toml
+
+from .config_store import ConfigStore, toml_document
 
 # 改为使用TOML配置文件
 CONFIG_FILE = 'config.toml'
 
+# 主账号名称，对应配置中顶层的 oasis_webid / oasis_token
+PRIMARY_ACCOUNT = 'default'
+
+# 账号被限流(429)后的冷却时间（秒），连续限流时按倍数递增
+THROTTLE_BASE_COOLDOWN = 60
+THROTTLE_MAX_COOLDOWN = 900
+
+# 令牌刷新调度（秒）
+TOKEN_REFRESH_LEAD = 300            # 在过期前多久主动刷新
+TOKEN_REFRESH_JITTER = 120          # 刷新时间的随机抖动上限，避免多个账号同时刷新
+TOKEN_REFRESH_RETRY_INTERVAL = 60   # 两次刷新尝试的最小间隔（失败后的重试间隔）
+TOKEN_REFRESH_FALLBACK_INTERVAL = 1800  # 无法解析过期时间时的刷新周期
+TOKEN_REFRESH_MIN_SLEEP = 5
+
+# 多实例共享状态中的key
+SHARED_TOKEN_KEY = 'token:{}'
+SHARED_THROTTLE_KEY = 'throttle:{}'
+REFRESH_LOCK_NAME = 'token-refresh:{}'
+
+
+# 刷新令牌请求头，完全按照curl命令构建（只读，所有账号共用）
+REFRESH_HEADERS = MappingProxyType({
+    'Accept': '*/*',
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
+    'Connection': 'keep-alive',
+    'Origin': 'https://www.stepfun.com',
+    'Referer': 'https://www.stepfun.com/chats/new',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-origin',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0',
+    'connect-protocol-version': '1',
+    'content-type': 'application/json',
+    'oasis-appid': '10200',
+    'oasis-language': 'zh',
+    'oasis-platform': 'web',
+    'priority': 'u=1, i',
+    'sec-ch-ua': '"Chromium";v="136", "Microsoft Edge";v="136", "Not.A/Brand";v="99"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'x-waf-client-type': 'fetch_sdk'
+})
+
+
+@lru_cache(maxsize=32)
+def decode_token_expiry(token):
+    """从令牌中解析访问令牌(JWT)的过期时间戳
+
+    令牌格式为 "访问令牌...刷新令牌"，只解析访问令牌的 exp 字段。
+
+    Returns:
+        float: 过期时间戳，无法解析时返回None
+    """
+    if not token:
+        return None
+    parts = token.split('...', 1)[0].split('.')
+    if len(parts) != 3:
+        return None
+    payload = parts[1] + '=' * (-len(parts[1]) % 4)
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload))
+    except (binascii.Error, ValueError):
+        return None
+    exp = data.get('exp') if isinstance(data, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
+class AccountThrottledError(Exception):
+    """上游返回429，账号已被降级"""
+
+    def __init__(self, account, cooldown, message):
+        super().__init__(message)
+        self.account = account
+        self.cooldown = cooldown
+        self.message = message
+
+
+class Account:
+    """账号池中的一个上游账号
+
+    凭证直接读写配置字典（主账号即顶层配置，其余账号为 accounts 列表中的条目），
+    因此令牌刷新后保存配置即可持久化。
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.in_flight = 0            # 正在进行的请求数
+        self.health = 1.0             # 健康分 (0~1)，限流时减半，成功时逐步恢复
+        self.throttled_until = 0      # 限流冷却截止时间
+        self.last_throttled = 0       # 最近一次被限流的时间
+        self.throttle_strikes = 0     # 连续限流次数
+        self.last_token_refresh = 0   # 最近一次刷新成功的时间
+        self.last_refresh_attempt = 0 # 最近一次尝试刷新的时间
+        self.refresh_jitter = random.uniform(0, TOKEN_REFRESH_JITTER)
+        self.refresh_task = None      # 进行中的刷新，并发调用共享同一次刷新
+
+    @property
+    def token(self):
+        return self.config.get('oasis_token') or ''
+
+    @property
+    def webid(self):
+        return self.config.get('oasis_webid') or ''
+
+    @property
+    def usable(self):
+        """凭证齐全且不需要重新登录"""
+        return bool(self.token and self.webid) and not self.config.get('need_login', False)
+
+    @property
+    def token_expiry(self):
+        """访问令牌的过期时间戳，无法解析时为None"""
+        return decode_token_expiry(self.token)
+
+    @property
+    def token_unexpired(self):
+        """令牌存在且尚未过期（无法解析过期时间时视为未过期）"""
+        expiry = self.token_expiry
+        return bool(self.token) and (expiry is None or expiry > time.time())
+
+    def is_throttled(self, now=None):
+        return (now or time.time()) < self.throttled_until
+
+    def record_success(self):
+        self.throttle_strikes = 0
+        self.health = min(1.0, self.health * 0.9 + 0.1)
+
+    def record_throttled(self, retry_after=None):
+        """记录一次限流，返回冷却秒数"""
+        now = time.time()
+        self.throttle_strikes += 1
+        self.health *= 0.5
+        cooldown = min(THROTTLE_BASE_COOLDOWN * 2 ** (self.throttle_strikes - 1), THROTTLE_MAX_COOLDOWN)
+        try:
+            if retry_after:
+                cooldown = max(cooldown, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        self.last_throttled = now
+        self.throttled_until = now + cooldown
+        return cooldown
+
+
 class LoginHandler:
     def __init__(self, config):
         try:
@@ -34,10 +185,19 @@ class LoginHandler:
             self.config = config
             self.config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_FILE)
             self._plugin = None
+            self._config_store = None  # 没有插件实例时使用
             # 移除httpx客户端
             # self.client = httpx.Client(http2=True, timeout=30.0)
             self.http_session = None  # 将由主插件设置
-            self._last_token_refresh = 0
+            self.shared_state = None  # 多实例共享状态，由主插件设置
+
+            # 账号池：主账号 + 配置中 [[yuewen.accounts]] 的附加账号
+            self.accounts = [Account(PRIMARY_ACCOUNT, self.config)]
+            for index, account_config in enumerate(self.config.get('accounts') or [], 1):
+                name = account_config.get('name') or f"account{index}"
+                self.accounts.append(Account(name, account_config))
+            if len(self.accounts) > 1:
+                logger.info(f"[Yuewen] 账号池已加载 {len(self.accounts)} 个账号")
         except Exception as e:
             logger.error(f"[Yuewen] LoginHandler初始化失败: {str(e)}")
             raise e
@@ -46,74 +206,89 @@ class LoginHandler:
         """设置HTTP会话"""
         self.http_session = session
 
+    def set_shared_state(self, state):
+        """设置多实例共享状态（shared_state.SharedState）"""
+        self.shared_state = state
+
+    @property
+    def _shared(self):
+        """在实例之间共享时返回共享状态，否则为None"""
+        state = self.shared_state
+        return state if state is not None and state.shared else None
+
+    # ======== 账号池 ========
+    @property
+    def primary_account(self):
+        return self.accounts[0]
+
+    def get_account(self, name):
+        """按名称查找账号"""
+        if name is None:
+            return None
+        return next((account for account in self.accounts if account.name == name), None)
+
+    def pick_account(self):
+        """选择一个账号：优先未被限流的账号中负载最低、最久未被限流、健康分最高的
+
+        所有账号都在冷却时选择最早恢复的账号。
+        """
+        now = time.time()
+        candidates = [account for account in self.accounts if account.usable] or [self.primary_account]
+        ready = [account for account in candidates if not account.is_throttled(now)]
+        if ready:
+            return min(ready, key=lambda a: (a.in_flight, a.last_throttled, -a.health))
+        return min(candidates, key=lambda a: a.throttled_until)
+
+    def demote_account(self, account, retry_after=None):
+        """账号被限流后暂时降级，返回冷却秒数"""
+        cooldown = account.record_throttled(retry_after)
+        logger.warning(f"[Yuewen] 账号 {account.name} 被限流，冷却 {cooldown:.0f} 秒，健康分 {account.health:.2f}")
+        return cooldown
+
+    async def publish_throttle(self, account):
+        """把账号的限流冷却同步给其他实例"""
+        state = self._shared
+        remaining = account.throttled_until - time.time()
+        if state is None or remaining <= 0:
+            return
+        try:
+            await state.set(SHARED_THROTTLE_KEY.format(account.name), account.throttled_until, ttl=remaining)
+        except Exception as e:
+            logger.warning(f"[Yuewen] 同步账号 {account.name} 限流状态失败: {e}")
+
+    async def load_shared_throttles(self):
+        """读取其他实例记录的限流冷却，选择账号前调用"""
+        state = self._shared
+        if state is None or len(self.accounts) < 2:
+            return
+        try:
+            values = await asyncio.gather(*(
+                state.get(SHARED_THROTTLE_KEY.format(account.name)) for account in self.accounts
+            ))
+        except Exception as e:
+            logger.warning(f"[Yuewen] 读取共享限流状态失败: {e}")
+            return
+        for account, throttled_until in zip(self.accounts, values):
+            if throttled_until and throttled_until > account.throttled_until:
+                account.throttled_until = throttled_until
+
+    def _context_account(self):
+        """当前上下文使用的账号（由插件按会话分配），无插件时使用主账号"""
+        if self._plugin is not None and hasattr(self._plugin, 'current_account'):
+            return self._plugin.current_account
+        return self.primary_account
+
     def save_config(self):
-        """保存配置到文件"""
+        """保存配置到文件（防抖，在工作线程中原子写入）"""
         try:
             # 如果有插件实例引用，使用插件的update_config方法保存配置
             if self._plugin is not None and hasattr(self._plugin, 'update_config'):
-                logger.info(f"[Yuewen] LoginHandler保存配置到: {os.path.join(os.path.dirname(__file__), CONFIG_FILE)}")
                 return self._plugin.update_config(self.config)
-            
-            # 直接保存方式：使用TOML格式
-            config_file_path = os.path.join(os.path.dirname(__file__), CONFIG_FILE)
-            
-            # 最多尝试3次保存
-            for attempt in range(3):
-                try:
-                    # 确保目录存在
-                    os.makedirs(os.path.dirname(config_file_path), exist_ok=True)
-                    
-                    # 先保存到临时文件，然后重命名，避免文件被部分写入
-                    temp_file_path = f"{config_file_path}.tmp"
-                    
-                    # 构建TOML格式（嵌套结构）
-                    toml_config = {"yuewen": {k: v for k, v in self.config.items() if k != "image_config"}}
-                    
-                    # 添加image_config子项
-                    if "image_config" in self.config:
-                        toml_config["yuewen"]["image_config"] = self.config.get("image_config", {})
-                    
-                    # 保存到临时TOML文件
-                    with open(temp_file_path, "w", encoding="utf-8") as f:
-                        toml.dump(toml_config, f)
-                    
-                    # 如果文件已存在，先尝试备份
-                    if os.path.exists(config_file_path):
-                        backup_path = f"{config_file_path}.bak"
-                        try:
-                            if os.path.exists(backup_path):
-                                os.remove(backup_path)
-                            os.rename(config_file_path, backup_path)
-                        except Exception as e:
-                            logger.warning(f"[Yuewen] 创建配置备份失败 (非致命): {e}")
-                    
-                    # 重命名临时文件为正式文件
-                    os.rename(temp_file_path, config_file_path)
-                    
-                    logger.info(f"[Yuewen] 配置已保存到TOML文件: {config_file_path}")
-                    logger.debug(f"[Yuewen] 配置已更新: {list(self.config.keys())}")
-                    return True
-                    
-                except PermissionError as pe:
-                    # 文件可能被另一个进程锁定
-                    if attempt < 2:  # 只在前两次尝试时记录警告
-                        logger.warning(f"[Yuewen] 保存配置时遇到权限错误 (尝试 {attempt+1}/3): {pe}")
-                        time.sleep(0.2 * (attempt + 1))  # 递增延迟
-                    else:
-                        logger.error(f"[Yuewen] 保存配置权限错误，已达最大重试次数: {pe}")
-                        return False
-                        
-                except Exception as inner_e:
-                    # 其他异常，记录错误并继续尝试
-                    if attempt < 2:
-                        logger.warning(f"[Yuewen] 保存TOML配置失败 (尝试 {attempt+1}/3): {inner_e}")
-                        time.sleep(0.1 * (attempt + 1))
-                    else:
-                        logger.error(f"[Yuewen] 保存TOML配置失败，已达最大重试次数: {inner_e}")
-                        return False
-            
-            return False  # 如果所有尝试都失败
-                
+
+            # 独立使用时由自己的ConfigStore保存
+            if self._config_store is None:
+                self._config_store = ConfigStore(self.config_path, lambda: toml_document(self.config))
+            return self._config_store.save()
         except Exception as e:
             logger.error(f"[Yuewen] LoginHandler保存配置失败: {e}")
             return False
@@ -274,6 +449,7 @@ class LoginHandler:
                             self.config['oasis_token'] = f"{access_token}...{refresh_token}"
                             self.config['need_login'] = False
                             self.save_config()
+                            await self._publish_token(self.primary_account)
                             logger.info(f"[Yuewen] 登录验证成功: {mobile_num}")
                             return True
                         else:
@@ -295,324 +471,254 @@ class LoginHandler:
         """验证码登录（sign_in的异步别名）"""
         return await self.sign_in(mobile_num, verify_code)
 
-    async def refresh_token(self, force=False):
+    # ======== 令牌刷新 ========
+    def get_token_expiry_time(self, account=None):
+        """获取令牌过期时间
+
+        Returns:
+            tuple: (过期时间datetime, 剩余秒数)，无法解析时为 (None, None)
+        """
+        account = account or self._context_account()
+        expiry = account.token_expiry
+        if expiry is None:
+            return None, None
+        return datetime.fromtimestamp(expiry), max(0, int(expiry - time.time()))
+
+    def _next_refresh_time(self, account):
+        """计算账号下一次应当主动刷新的时间"""
+        expiry = account.token_expiry
+        if expiry is not None:
+            due = expiry - TOKEN_REFRESH_LEAD - account.refresh_jitter
+        else:
+            due = account.last_token_refresh + TOKEN_REFRESH_FALLBACK_INTERVAL + account.refresh_jitter
+        # 刷新失败后不要立即重试
+        return max(due, account.last_refresh_attempt + TOKEN_REFRESH_RETRY_INTERVAL)
+
+    async def run_refresh_scheduler(self):
+        """后台令牌刷新循环
+
+        在每个账号的令牌过期前（提前量加随机抖动）主动刷新，请求路径上
+        的 refresh_token() 因此通常无需访问网络。
+        """
+        logger.info("[Yuewen] 后台令牌刷新任务已启动")
+        while True:
+            try:
+                now = time.time()
+                next_wake = now + TOKEN_REFRESH_FALLBACK_INTERVAL
+                for account in self.accounts:
+                    if not account.usable:
+                        continue
+                    due = self._next_refresh_time(account)
+                    if due <= now:
+                        logger.debug(f"[Yuewen] 账号 {account.name} 令牌即将过期，后台刷新")
+                        await self.refresh_token(force=True, account=account)
+                        due = self._next_refresh_time(account)
+                    next_wake = min(next_wake, due)
+                await asyncio.sleep(max(next_wake - time.time(), TOKEN_REFRESH_MIN_SLEEP))
+            except asyncio.CancelledError:
+                logger.info("[Yuewen] 后台令牌刷新任务已停止")
+                raise
+            except Exception as e:
+                logger.error(f"[Yuewen] 后台令牌刷新异常: {e}")
+                await asyncio.sleep(TOKEN_REFRESH_RETRY_INTERVAL)
+
+    async def refresh_token(self, force=False, account=None):
         """刷新令牌 (更新oasis_token)（异步版本）
-        
+
+        令牌离过期还远时直接返回，不访问网络；需要刷新时同一账号的并发
+        调用共享同一次进行中的刷新。
+
         Args:
-            force (bool, optional): 是否强制刷新令牌，忽略刷新频率限制。默认为False。
-            
+            force (bool, optional): 是否强制刷新令牌，忽略过期时间和刷新间隔。默认为False。
+            account (Account, optional): 要刷新的账号，默认为当前会话分配的账号。
+
         Returns:
-            bool: 刷新成功返回True，失败返回False
+            bool: 令牌有效返回True，失败返回False
         """
-        # 限制刷新频率，除非强制刷新
-        current_time = time.time()
-        if not force and hasattr(self, '_last_token_refresh') and current_time - self._last_token_refresh < 60:
-            logger.warning("[Yuewen] Token刷新太频繁，跳过")
-            # 虽然跳过，但如果已经有token，认为token仍有效
-            return bool(self.config.get('oasis_token'))
-        
-        if force:
-            logger.info("[Yuewen] 强制刷新令牌，忽略刷新频率限制")
+        if account is None:
+            account = self._context_account()
+
+        if not force:
+            expiry = account.token_expiry
+            remaining = expiry - time.time() if expiry is not None else None
+            if remaining is not None and remaining > TOKEN_REFRESH_LEAD:
+                return True
+            if time.time() - account.last_refresh_attempt < TOKEN_REFRESH_RETRY_INTERVAL:
+                # 刚刚尝试过刷新，令牌未过期则继续使用
+                return account.token_unexpired
+        else:
+            logger.info(f"[Yuewen] 强制刷新账号 {account.name} 的令牌")
+
+        task = account.refresh_task
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._refresh_account_token(account))
+            account.refresh_task = task
+        # shield: 某个调用方被取消时不影响其他等待同一次刷新的调用方
+        return await asyncio.shield(task)
+
+    async def load_shared_tokens(self):
+        """启动时采用其他实例刷新过的令牌（本地配置中的刷新令牌可能已经轮换失效）"""
+        if self._shared is None:
+            return
+        for account in self.accounts:
+            try:
+                await self._adopt_shared_token(account)
+            except Exception as e:
+                logger.warning(f"[Yuewen] 读取账号 {account.name} 的共享令牌失败: {e}")
+
+    async def _adopt_shared_token(self, account):
+        """共享状态中有其他实例刷新的、尚未临近过期的令牌时直接采用（不写配置文件）"""
+        record = await self.shared_state.get(SHARED_TOKEN_KEY.format(account.name))
+        if not record or not record.get('token') or record['token'] == account.token:
+            return False
+        expiry = decode_token_expiry(record['token'])
+        if expiry is not None and expiry - time.time() <= TOKEN_REFRESH_LEAD:
+            return False
+
+        credentials = account.config
+        credentials['oasis_token'] = record['token']
+        if record.get('webid'):
+            credentials['oasis_webid'] = record['webid']
+        credentials['need_login'] = False
+        account.last_token_refresh = record.get('refreshed_at') or time.time()
+        account.refresh_jitter = random.uniform(0, TOKEN_REFRESH_JITTER)
+        # 不主动写配置文件：只有持有刷新锁、实际刷新令牌的实例负责写入，避免多个实例同时写同一个文件。
+        # 本实例之后因其他设置保存配置时会带上这个令牌，与刷新实例写入的值相同；
+        # 重启时 load_shared_tokens() 也会从共享状态重新采用
+        logger.info(f"[Yuewen] 采用其他实例刷新的账号 {account.name} 令牌")
+        return True
+
+    async def _publish_token(self, account):
+        """把新令牌写入共享状态，供其他实例采用"""
+        state = self._shared
+        if state is None:
+            return
+        try:
+            await state.set(SHARED_TOKEN_KEY.format(account.name), {
+                'token': account.token,
+                'webid': account.webid,
+                'refreshed_at': time.time(),
+            })
+        except Exception as e:
+            logger.warning(f"[Yuewen] 发布账号 {account.name} 的令牌失败: {e}")
+
+    async def _refresh_account_token(self, account):
+        """刷新账号令牌
+
+        多个实例共享账号时，同一账号同时只有一个实例（持有共享锁）访问服务器；
+        刷新令牌每次刷新都会轮换，其他实例取得锁后直接采用已刷新的令牌。
+        """
+        state = self._shared
+        if state is None:
+            return await self._request_new_token(account)
+        try:
+            return await self._refresh_with_lock(state, account)
+        except Exception as e:
+            logger.error(f"[Yuewen] 共享状态不可用，直接刷新账号 {account.name} 的令牌: {e}")
+            return await self._request_new_token(account)
+
+    async def _refresh_with_lock(self, state, account):
+        async with state.lock(REFRESH_LOCK_NAME.format(account.name)) as acquired:
+            if await self._adopt_shared_token(account):
+                account.last_refresh_attempt = time.time()
+                return True
+            if not acquired:
+                # 其他实例的刷新迟迟没有结束，稍后由调度器重试；当前令牌未过期时仍可继续使用
+                account.last_refresh_attempt = time.time()
+                return account.token_unexpired
+            if not await self._request_new_token(account):
+                return False
+            await self._publish_token(account)
+            return True
+
+    async def _request_new_token(self, account):
+        """向服务器请求新令牌并保存"""
+        credentials = account.config
+        account.last_refresh_attempt = time.time()
 
         # 检查webid是否存在
-        if not self.config.get('oasis_webid'):
-            logger.error("[Yuewen] webid不存在，无法刷新令牌")
+        if not credentials.get('oasis_webid'):
+            logger.error(f"[Yuewen] 账号 {account.name} webid不存在，无法刷新令牌")
             return False
 
-        # 开始刷新令牌流程
-        logger.debug("[Yuewen] 开始刷新令牌")
-        
-        # 确定当前使用的API版本
-        current_api_version = self.config.get('api_version', 'old')
-        
-        # 与原始项目保持一致的URL
-        refresh_url = 'https://yuewen.cn/passport/proto.api.passport.v1.PassportService/RefreshToken'
-        
-        # 如果是新版API，则使用新版的域名
-        if current_api_version == 'new':
+        # 确保存在HTTP会话
+        if not self.http_session:
+            logger.error("[Yuewen] HTTP会话未初始化，无法刷新令牌")
+            return False
+
+        # 与原始项目保持一致的URL，新版API使用新版的域名
+        if self.config.get('api_version', 'old') == 'new':
             refresh_url = 'https://www.stepfun.com/passport/proto.api.passport.v1.PassportService/RefreshToken'
-        
-        logger.debug(f"[Yuewen] 刷新令牌URL: {refresh_url}")
-
-        # 完全按照curl命令构建请求头
-        headers = {
-            'Accept': '*/*',
-            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
-            'Connection': 'keep-alive',
-            'Origin': 'https://www.stepfun.com',
-            'Referer': 'https://www.stepfun.com/chats/new',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-origin',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0',
-            'connect-protocol-version': '1',
-            'content-type': 'application/json',
-            'oasis-appid': '10200',
-            'oasis-language': 'zh',
-            'oasis-platform': 'web',
-            'priority': 'u=1, i',
-            'sec-ch-ua': '"Chromium";v="136", "Microsoft Edge";v="136", "Not.A/Brand";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'x-waf-client-type': 'fetch_sdk'
+        else:
+            refresh_url = 'https://yuewen.cn/passport/proto.api.passport.v1.PassportService/RefreshToken'
+
+
+        # 使用完整的复合token，不分割
+        cookies = {
+            'Oasis-Webid': credentials.get('oasis_webid'),
+            'i18next': 'zh',
+            '_tea_utm_cache_20002086': '{%22utm_source%22:%22share%22%2C%22utm_content%22:%22web_image_share%22}',
+            'sidebar_state': 'false'
         }
+        if credentials.get('oasis_token'):
+            cookies['Oasis-Token'] = credentials['oasis_token']
 
-        # 设置Cookie - 使用完全符合curl示例的格式
-        cookies = {}
-        
-        # 添加webid
-        if self.config.get('oasis_webid'):
-            cookies['Oasis-Webid'] = self.config.get('oasis_webid')
-        
-        # 添加token (使用原始完整的复合token，不分割)
-        if self.config.get('oasis_token'):
-            # 使用完整token，不分割
-            token = self.config.get('oasis_token', '')
-            cookies['Oasis-Token'] = token
-            logger.debug(f"[Yuewen] 使用完整令牌，长度: {len(token)}")
-        
-        # 添加curl命令中的其他Cookie
-        cookies['i18next'] = 'zh'
-        cookies['_tea_utm_cache_20002086'] = '{%22utm_source%22:%22share%22%2C%22utm_content%22:%22web_image_share%22}'
-        cookies['sidebar_state'] = 'false'
-        
-        # 构建请求体 - 与curl命令一致的空对象
-        payload = {}
-        
-        # 准备开始发送请求，详细记录信息
-        logger.debug(f"[Yuewen] 刷新令牌请求URL: {refresh_url}")
-        logger.debug(f"[Yuewen] 刷新令牌请求Cookie: {list(cookies.keys())}")
-        
-        # 发送请求
+        logger.debug(f"[Yuewen] 刷新账号 {account.name} 令牌: {refresh_url}")
         try:
-            # 确保存在HTTP会话
-            if not self.http_session:
-                logger.error("[Yuewen] HTTP会话未初始化，无法刷新令牌")
-                return False
-                
-            # 尝试使用requests库发送请求
-            try:
-                import requests
-                
-                # 转换headers和cookies为requests格式
-                req_headers = dict(headers)
-                req_cookies = dict(cookies)
-                
-                logger.debug("[Yuewen] 使用requests库刷新令牌")
-                
-                # 同步发送请求
-                response = requests.post(
-                    refresh_url,
-                    headers=req_headers,
-                    cookies=req_cookies,
-                    json=payload,
-                    timeout=30
-                )
-                
-                response_status = response.status_code
-                logger.debug(f"[Yuewen] 刷新令牌响应状态: {response_status}")
-                
-                if response_status == 200:
-                    try:
-                        # 获取完整响应
-                        response_text = response.text
-                        logger.debug(f"[Yuewen] 令牌刷新原始响应: {response_text[:200]}...")
-                        
-                        # 解析响应JSON
-                        data = json.loads(response_text)
-                        
-                        # 按照curl命令响应格式提取token
-                        access_token = data.get('accessToken', {}).get('raw')
-                        refresh_token = data.get('refreshToken', {}).get('raw')
-                        
-                        # 添加详细日志
-                        if access_token:
-                            logger.debug(f"[Yuewen] 获取到新的访问令牌，长度: {len(access_token)}")
-                        else:
-                            logger.error("[Yuewen] 响应中未找到访问令牌")
-                            
-                        if refresh_token:
-                            logger.debug(f"[Yuewen] 获取到新的刷新令牌，长度: {len(refresh_token)}")
-                        else:
-                            logger.error("[Yuewen] 响应中未找到刷新令牌")
-                        
-                        if access_token and refresh_token:
-                            # 按照原始项目格式构造token
-                            token_value = f"{access_token}...{refresh_token}"
-                            
-                            # 临时保存旧token，以便在保存失败时恢复
-                            old_token = self.config.get('oasis_token')
-                            
-                            # 更新config
-                            self.config['oasis_token'] = token_value
-                            self.config['need_login'] = False
-                            
-                            # 记录刷新时间
-                            self._last_token_refresh = current_time
-                            
-                            # 保存到配置前先验证数据
-                            try:
-                                # 确保token存在且格式正确
-                                if not isinstance(token_value, str) or not token_value:
-                                    logger.error("[Yuewen] 刷新令牌后token无效，恢复旧token")
-                                    self.config['oasis_token'] = old_token
-                                    return False
-                                
-                                # 保存配置
-                                saved = self.save_config()
-                                if not saved:
-                                    logger.warning("[Yuewen] 令牌刷新后保存配置失败")
-                                    # 尝试第二次保存
-                                    time.sleep(0.5)  # 短暂延迟
-                                    saved = self.save_config()
-                                    if not saved:
-                                        logger.error("[Yuewen] 令牌刷新后第二次保存仍然失败")
-                                        
-                                logger.info("[Yuewen] ✅ 令牌刷新成功，已保存新令牌")
-                                return True
-                            except Exception as cfg_e:
-                                logger.error(f"[Yuewen] 刷新令牌后保存配置异常: {cfg_e}")
-                                # 即使保存失败，我们仍然有内存中的令牌
-                                logger.debug("[Yuewen] 令牌刷新成功，但配置保存失败")
-                                return True
-                        else:
-                            logger.error("[Yuewen] 令牌刷新失败: 响应中未找到完整令牌")
-                            return False
-                    except Exception as parse_err:
-                        logger.error(f"[Yuewen] 令牌刷新处理响应异常: {parse_err}")
-                        return False
-                
-                # 处理错误情况
-                error_text = response.text
-                logger.debug(f"[Yuewen] 刷新令牌错误响应: {error_text[:200]}...")
-                logger.error(f"[Yuewen] 令牌刷新失败: HTTP {response_status}")
-                
-                # 判断是否需要重新登录
-                if response_status == 401 or (error_text and ("unauthorized" in error_text.lower() or "token is illegal" in error_text.lower())):
-                    logger.warning("[Yuewen] 令牌已过期或无效，需要重新登录")
-                    self.config['need_login'] = True
-                    return False
-                
-                return False
-                
-            except ImportError:
-                # 回退到 aiohttp
-                logger.warning("[Yuewen] requests库未安装，使用aiohttp")
-                
-                # 发送异步请求
-                async with self.http_session.post(
-                    refresh_url,
-                    headers=headers,
-                    cookies=cookies,
-                    json=payload,
-                    timeout=30
-                ) as response:
-                    response_status = response.status
-                    logger.debug(f"[Yuewen] 刷新令牌响应状态: {response_status}")
-                    
-                    if response_status == 200:
-                        try:
-                            # 获取完整响应
-                            response_text = await response.text()
-                            logger.debug(f"[Yuewen] 令牌刷新原始响应: {response_text[:200]}...")
-                            
-                            # 解析响应JSON
-                            data = json.loads(response_text)
-                            
-                            # 按照curl命令响应格式提取token
-                            access_token = data.get('accessToken', {}).get('raw')
-                            refresh_token = data.get('refreshToken', {}).get('raw')
-                            
-                            # 添加详细日志
-                            if access_token:
-                                logger.debug(f"[Yuewen] 获取到新的访问令牌，长度: {len(access_token)}")
-                            else:
-                                logger.error("[Yuewen] 响应中未找到访问令牌")
-                                
-                            if refresh_token:
-                                logger.debug(f"[Yuewen] 获取到新的刷新令牌，长度: {len(refresh_token)}")
-                            else:
-                                logger.error("[Yuewen] 响应中未找到刷新令牌")
-                            
-                            if access_token and refresh_token:
-                                # 按照原始项目格式构造token
-                                token_value = f"{access_token}...{refresh_token}"
-                                
-                                # 临时保存旧token，以便在保存失败时恢复
-                                old_token = self.config.get('oasis_token')
-                                
-                                # 更新config
-                                self.config['oasis_token'] = token_value
-                                self.config['need_login'] = False
-                                
-                                # 记录刷新时间
-                                self._last_token_refresh = current_time
-                                
-                                # 保存到配置前先验证数据
-                                try:
-                                    # 确保token存在且格式正确
-                                    if not isinstance(token_value, str) or not token_value:
-                                        logger.error("[Yuewen] 刷新令牌后token无效，恢复旧token")
-                                        self.config['oasis_token'] = old_token
-                                        return False
-                                    
-                                    # 保存配置
-                                    saved = self.save_config()
-                                    if not saved:
-                                        logger.warning("[Yuewen] 令牌刷新后保存配置失败")
-                                        # 尝试第二次保存
-                                        time.sleep(0.5)  # 短暂延迟
-                                        saved = self.save_config()
-                                        if not saved:
-                                            logger.error("[Yuewen] 令牌刷新后第二次保存仍然失败")
-                                            
-                                    logger.info("[Yuewen] ✅ 令牌刷新成功，已保存新令牌")
-                                    return True
-                                except Exception as cfg_e:
-                                    logger.error(f"[Yuewen] 刷新令牌后保存配置异常: {cfg_e}")
-                                    # 即使保存失败，我们仍然有内存中的令牌
-                                    logger.debug("[Yuewen] 令牌刷新成功，但配置保存失败")
-                                    return True
-                            else:
-                                logger.error("[Yuewen] 令牌刷新失败: 响应中未找到完整令牌")
-                                return False
-                        except json.JSONDecodeError as json_err:
-                            logger.error(f"[Yuewen] 令牌刷新解析JSON响应失败: {json_err}")
-                            # 打印原始响应内容以便调试
-                            raw_text = await response.text()
-                            logger.debug(f"[Yuewen] 令牌刷新原始响应: {raw_text[:200]}...")
-                            return False
-                        except Exception as parse_err:
-                            logger.error(f"[Yuewen] 令牌刷新处理响应异常: {parse_err}")
-                            return False
-                            
-                    # 处理错误情况
-                    error_text = await response.text()
-                    logger.debug(f"[Yuewen] 刷新令牌错误响应: {error_text[:200]}...")
-                    
-                    try:
-                        # 尝试解析错误JSON
-                        error_data = json.loads(error_text) if error_text else {"error": {"message": "未知错误"}}
-                        error_msg = error_data.get('error', {}).get('message', '未知错误')
-                    except json.JSONDecodeError:
-                        # 如果不是JSON，使用原始文本
-                        error_msg = error_text if error_text else "未知错误"
-                            
-                    logger.error(f"[Yuewen] 令牌刷新失败: HTTP {response.status}, {error_msg}")
-                    
-                    # 判断是否需要重新登录
-                    if response.status == 401 or (error_text and ("unauthorized" in error_text.lower() or "token is illegal" in error_text.lower())):
-                        logger.warning("[Yuewen] 令牌已过期或无效，需要重新登录")
-                        self.config['need_login'] = True
-                        return False
-                        
-                    return False
-                        
+            async with self.http_session.post(
+                refresh_url,
+                headers=REFRESH_HEADERS,
+                cookies=cookies,
+                json={},
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                response_status = response.status
+                response_text = await response.text()
         except Exception as e:
             logger.error(f"[Yuewen] 令牌刷新异常: {e}")
             logger.debug(f"[Yuewen] 令牌刷新异常栈: {traceback.format_exc()}")
             return False
 
+        if response_status != 200:
+            logger.debug(f"[Yuewen] 刷新令牌错误响应: {response_text[:200]}...")
+            logger.error(f"[Yuewen] 令牌刷新失败: HTTP {response_status}")
+            # 判断是否需要重新登录
+            lowered = response_text.lower()
+            if response_status == 401 or "unauthorized" in lowered or "token is illegal" in lowered:
+                logger.warning(f"[Yuewen] 账号 {account.name} 令牌已过期或无效，需要重新登录")
+                credentials['need_login'] = True
+            return False
+
+        try:
+            data = json.loads(response_text)
+            access_token = data.get('accessToken', {}).get('raw')
+            refresh_token = data.get('refreshToken', {}).get('raw')
+        except (ValueError, AttributeError) as e:
+            logger.error(f"[Yuewen] 令牌刷新解析JSON响应失败: {e}")
+            logger.debug(f"[Yuewen] 令牌刷新原始响应: {response_text[:200]}...")
+            return False
+
+        if not access_token or not refresh_token:
+            logger.error("[Yuewen] 令牌刷新失败: 响应中未找到完整令牌")
+            return False
+
+        # 按照原始项目格式构造token
+        credentials['oasis_token'] = f"{access_token}...{refresh_token}"
+        credentials['need_login'] = False
+        account.last_token_refresh = time.time()
+        account.refresh_jitter = random.uniform(0, TOKEN_REFRESH_JITTER)
+
+        try:
+            if not self.save_config():
+                logger.warning("[Yuewen] 令牌刷新后保存配置失败，新令牌仅保存在内存中")
+        except Exception as cfg_e:
+            # 即使保存失败，我们仍然有内存中的令牌
+            logger.error(f"[Yuewen] 刷新令牌后保存配置异常: {cfg_e}")
+
+        _, remaining = self.get_token_expiry_time(account)
+        logger.info(f"[Yuewen] ✅ 账号 {account.name} 令牌刷新成功" + (f"，有效期 {remaining} 秒" if remaining else ""))
+        return True
+
     async def login_flow(self):
         """登录流程（异步版本）"""
         try:
@@ -1,12 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import time
-import struct
-import random
 import os
-import httpx
 import re
-import requests
 import base64
 import tomllib
 import asyncio
@@ -15,8 +11,8 @@ from loguru import logger
 from io import BytesIO
 from typing import List, Dict, Union, Optional
 import io
+import contextvars
 from datetime import datetime
-import traceback
 
 # 添加PIL库用于图片处理和验证
 try:
@@ -31,7 +27,45 @@ except ImportError:
 from WechatAPI import WechatAPIClient
 from utils.decorators import *
 from utils.plugin_base import PluginBase
-from .login import LoginHandler
+from .login import AccountThrottledError, LoginHandler
+from . import codec, context, frames, hotlog, poster, wx_message
+from .backends import BASE_HEADERS, FrameDecoder, create_backends
+from .commands import PASS, CommandRouter, command
+from .config_store import ConfigStore, toml_document
+from .gateway import Gateway
+from .image_buffer import ImageBuffer
+from .image_download import ImageDownloader, Strategy
+from .latency import AdaptiveRouting, LatencyTracker
+from .outbound import OutboundDispatcher
+from .response_cache import ResponseCache
+from .server_settings import SettingsSync
+from .shared_state import create_shared_state
+from .singleflight import SingleFlight
+from .text_normalizer import TextNormalizer, normalize_prompt, normalize_text
+
+_stream_log = hotlog.get('stream')
+_download_log = hotlog.get('download')
+
+# 登录流程中识别手机号
+_PHONE_RE = re.compile(r'1\d{10}')
+# 识图命令参数: "识图 描述" / "识图N 描述"
+_PIC_ARGS_PARSER = r'(?:(?P<count>\d+)(?=\s|$))?(?P<prompt>.*)'
+# 正常回答开头的模型说明，如 "使用Step2模型联网模式回答（耗时3.20秒）：\n"
+_REPLY_HEADER_RE = re.compile(r'(使用.+?模型.+?模式回答（耗时[\d.]+秒）)：\n?')
+# 拆分模型说明: (模型名称, 联网模式, 冒号及换行)
+_REPLY_META_RE = re.compile(r'使用(.+?)模型(.+?)模式回答（耗时[\d.]+秒）(：\n?)')
+_SHARE_HINT = "3分钟内发送yw分享获取回答图片"
+# "yw思考过程"回复的最大字符数
+MAX_REASONING_REPLY = 3000
+# 会话超过该时间（秒）没有活动时重新创建上游会话
+SESSION_TIMEOUT = 180
+# 会话状态超过该时间（秒）没有活动且没有保存后端绑定时从内存中清理
+CONVERSATION_IDLE_TTL = 3600
+# 上传缓存的默认有效期（秒），同一张图片在有效期内不重复上传
+DEFAULT_UPLOAD_TTL = 1800
+
+# 当前正在处理的会话状态，每条消息在自己的上下文中设置，并发处理时互不干扰
+_active_conversation = contextvars.ContextVar('yuewen_active_conversation', default=None)
 
 class YuewenPlugin(PluginBase):
     description = "跃问AI助手插件"
@@ -54,15 +88,8 @@ class YuewenPlugin(PluginBase):
         # 用户会话状态
         self.waiting_for_image = {}  # 存储待处理的识图请求 {user_id: {prompt: "...", time: ...}}
         self.multi_image_data = {}   # 存储多图处理数据
-        self.user_sessions = {}      # 用户会话状态
-
-        # API参数
-        self.current_base_url = "https://www.stepfun.com"
-        self.api_version = 'new'    # 'new'=StepFun, 'old'=Yuewen
-
-        # 会话相关
-        self.current_chat_id = None
-        self.current_chat_session_id = None
+        self.user_sessions = {}      # 用户会话状态 {user_id: 会话状态}，每个会话固定绑定一个后端
+        self._sessions_pruned_at = 0  # 上次清理空闲会话状态的时间
 
         # 登录凭据
         self.oasis_token = None
@@ -75,17 +102,16 @@ class YuewenPlugin(PluginBase):
         self.temperature = 0.9
         self.network_mode = True
 
+        # 配置持久化（内存中的self.config为权威状态）
+        self.config_store = ConfigStore(
+            os.path.join(os.path.dirname(__file__), 'config.toml'),
+            lambda: toml_document(self.config)
+        )
+
         # 加载配置
         self._load_config()
 
-        # 当前消息上下文，用于直接发送图片
-        self.current_bot = None
-        self.current_message = None
-        self.image_directly_sent = False  # 标记图片是否已直接发送
-        self.last_image_error = None      # 保存最近的图片生成错误信息
-        self._last_upload_error = None    # 保存最近的图片上传错误信息
-
-        # 定期刷新token的任务
+        # 后台令牌刷新任务（在async_init中启动）
         self.refresh_token_task = None
 
         # 错误计数和状态跟踪
@@ -95,23 +121,7 @@ class YuewenPlugin(PluginBase):
         self._load_config()
 
         # 基础请求头，用于API请求
-        self.base_headers = {
-            'accept': '*/*',
-            'accept-language': 'zh-CN,zh;q=0.9',
-            'cache-control': 'no-cache',
-            'origin': '', # 将在请求时动态设置
-            'pragma': 'no-cache',
-            'priority': 'u=1, i',
-            'referer': '', # 将在请求时动态设置
-            'sec-ch-ua': '"Not/A)Brand";v="99", "Microsoft Edge";v="127", "Chromium";v="127"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36 Edg/127.0.0.0',
-            'x-waf-client-type': 'fetch_sdk'
-        }
+        self.base_headers = dict(BASE_HEADERS)
 
         # HTTP会话
         self.http_session = None  # 将在async_init中创建
@@ -122,11 +132,12 @@ class YuewenPlugin(PluginBase):
             'new': 'https://www.stepfun.com'
         }
 
-        # 当前基本URL基于配置的API版本
-        self.current_base_url = self.base_urls[self.config.get('api_version', 'old')]
+        # 上游后端 (共享传输层、分帧与重试)
+        self.backends = create_backends(self, self.base_urls)
 
-        # 设置API版本属性
-        self.api_version = self.config.get('api_version', 'old')
+        # 不属于任何用户会话时（初始化、后台任务）使用的默认会话状态，
+        # 配置中的api_version同时作为新会话的默认后端
+        self._default_conversation = self._new_conversation_state(None, self.config.get('api_version', 'old'))
 
         # 创建LoginHandler实例并传递配置
         self.login_handler = LoginHandler(self.config)
@@ -138,6 +149,15 @@ class YuewenPlugin(PluginBase):
         if hasattr(self.login_handler, 'base_headers'):
             self.login_handler.base_headers = self.base_headers.copy()
 
+        # 多实例共享状态（令牌、上游会话、上传缓存、账号限流），未启用时为进程内实现
+        shared_config = self.config.get('shared_state') or {}
+        self.shared_state = create_shared_state(shared_config, os.path.dirname(__file__))
+        self.login_handler.set_shared_state(self.shared_state)
+        self.upload_ttl = float(shared_config.get('upload_ttl', DEFAULT_UPLOAD_TTL))
+        # 每个账号每分钟的上游请求数上限（所有实例合计），0 表示不限
+        self.account_rate = float(shared_config.get('requests_per_minute', 0)) / 60
+        self.account_burst = int(shared_config.get('burst', 3))
+
         # 用户状态
         self.oasis_webid = self.config.get('oasis_webid')
         self.oasis_token = self.config.get('oasis_token')
@@ -146,17 +166,48 @@ class YuewenPlugin(PluginBase):
         self.network_mode = self.config.get('network_mode', True)   # 默认开启联网
         self.trigger_prefix = self.config.get('trigger_prefix', 'yw')
 
+        # 单条消息的处理时限（秒），所有上游请求的超时都不超过剩余时间
+        self.generation_deadline = float(self.config.get('generation_deadline', context.DEFAULT_DEADLINE))
+
+        # 进行中的生成任务 {user_id: asyncio.Task}，用于取消被新问题取代或被停止的回答
+        self.generations = {}
+
+        # 分享图片: 'local' 本地渲染（新旧API均可），'upstream' 使用旧版API的分享接口
+        self.share_mode = self.config.get('share_mode', 'local')
+        self.poster_font = self.config.get('poster_font') or None
+
+        # 是否保留最近一次回答的思考过程（原始帧，"yw思考过程"查看时才解码）
+        self.keep_reasoning = bool(self.config.get('keep_reasoning', False))
+
+        # 相同问题的并发请求合并（如群里多人同时问同一个问题）
+        self.request_coalescer = SingleFlight(float(self.config.get('coalesce_window', 5)))
+
+        # 回复消息的发送队列（按接收方排队、限速、合并短消息、拆分长消息）
+        self.outbound = OutboundDispatcher.from_config(self.config.get('outbound'))
+
+        # 各账号已应用的上游设置（模型、联网），同步时只发送变化的项
+        self.settings_sync = SettingsSync()
+
+        # 按 (API版本, 模型ID, 是否联网) 统计真实请求的延迟，自适应路由据此改派（默认关闭）
+        self.latency = LatencyTracker()
+        self.adaptive_routing = AdaptiveRouting.from_config(self.latency, self.config.get('adaptive_routing'))
+
+        # 本地HTTP/SSE网关（默认关闭），在async_init中启动
+        self.gateway = Gateway.from_config(self, self.config.get('gateway'))
+
+        # 新会话首条问题的回答缓存（默认关闭）
+        self.response_cache = ResponseCache.from_config(self.config.get('response_cache'))
+
+        # 图片获取策略（记录各方法的成功次数，最常成功的方法优先）
+        self.image_downloader = self._create_image_downloader()
+
         # 图片配置
         image_config = self.config.get('image_config', {})
         self.pic_trigger_prefix = image_config.get('trigger', '识图')
         self.imgprompt = image_config.get('imgprompt', '解释下图片内容')
 
-        # 会话状态
-        self.current_chat_id = None  # 旧版API会话ID
-        self.current_chat_session_id = None  # 新版API会话ID
-        self.last_active_time = 0
+        # 会话状态（会话ID、最后活动时间等保存在各自的会话状态中）
         self.last_token_refresh = 0
-        self.last_message = None  # 保存最近一次消息用于分享
 
         # 登录相关状态
         self.device_id = ""
@@ -169,6 +220,9 @@ class YuewenPlugin(PluginBase):
         self.multi_image_data = {}
         self.max_images = 9
 
+        # 命令路由（加载时一次性构建）
+        self.command_router = self._create_command_router()
+
         # 模型列表
         self.models = {
             1: {"name": "deepseek r1", "id": 6, "can_network": True},
@@ -222,6 +276,10 @@ class YuewenPlugin(PluginBase):
             )
             # 将HTTP会话传递给LoginHandler
             self.login_handler.set_http_session(self.http_session)
+        # 重新启动后台令牌刷新任务
+        if self.refresh_token_task is None or self.refresh_token_task.done():
+            self.refresh_token_task = asyncio.create_task(self.login_handler.run_refresh_scheduler())
+        await self.gateway.start()
         # 更新配置启用状态
         self.update_config({"enable": True})
         return True
@@ -230,12 +288,22 @@ class YuewenPlugin(PluginBase):
         """插件禁用时调用，按XXXBot框架要求实现"""
         logger.info("[Yuewen] 插件已禁用")
         self.enable = False
+        # 停止后台令牌刷新任务
+        if self.refresh_token_task and not self.refresh_token_task.done():
+            self.refresh_token_task.cancel()
+        self.refresh_token_task = None
+        # 停止HTTP网关（取消进行中的网关任务）
+        await self.gateway.stop()
         # 关闭HTTP会话
         if self.http_session and not self.http_session.closed:
             await self.http_session.close()
             self.http_session = None
-        # 更新配置禁用状态
+        # 发送队列中尚未发出的回复
+        await self.outbound.close()
+        poster.shutdown()
+        # 更新配置禁用状态，并立即写入尚未保存的配置
         self.update_config({"enable": False})
+        await self.config_store.flush()
         return True
 
     def update_config(self, updates):
@@ -265,39 +333,24 @@ class YuewenPlugin(PluginBase):
             if 'network_mode' in updates:
                 self.network_mode = updates['network_mode']
             if 'api_version' in updates:
-                self.api_version = updates['api_version']
-                self.current_base_url = self.base_urls[self.api_version]
+                # 仅影响之后新建的会话，已有会话保持各自绑定的后端
+                self._default_conversation['api_version'] = updates['api_version']
 
             # 保存到配置文件
             self._save_config()
 
             logger.debug(f"[Yuewen] 配置已更新: {updates.keys()}")
+            return True
         else:
             logger.error(f"[Yuewen] 配置更新失败: 不是有效的字典 {type(updates)}")
+            return False
 
     def _save_config(self):
-        """保存配置到TOML文件"""
-        config_path = os.path.join(os.path.dirname(__file__), 'config.toml')
+        """保存配置到TOML文件
 
-        # 保存到TOML（标准格式）
-        try:
-            import toml
-
-            # 构造TOML格式（嵌套结构）
-            toml_config = {"yuewen": {k: v for k, v in self.config.items() if k != "image_config"}}
-            if "image_config" in self.config:
-                toml_config["yuewen"]["image_config"] = self.config.get("image_config", {})
-
-            with open(config_path, "w", encoding="utf-8") as f:
-                toml.dump(toml_config, f)
-            logger.info(f"[Yuewen] 配置已保存到TOML文件: {config_path}")
-            return True
-        except ImportError:
-            logger.warning("[Yuewen] toml库未安装，无法保存TOML配置")
-            return False
-        except Exception as e:
-            logger.error(f"[Yuewen] 保存TOML配置失败: {e}")
-            return False
+        写入经过防抖并在工作线程中原子完成，不阻塞消息处理；内容没有变化时不写文件。
+        """
+        return self.config_store.save()
 
     async def async_init(self):
         """异步初始化插件，创建HTTP会话并设置给登录处理器"""
@@ -315,6 +368,9 @@ class YuewenPlugin(PluginBase):
             else:
                 logger.error("[Yuewen] LoginHandler未初始化，无法设置HTTP会话")
 
+            # 其他实例可能已经刷新过令牌，本地配置中的刷新令牌随之失效
+            await self.login_handler.load_shared_tokens()
+
             # 检查登录状态 - _check_login_status_async返回True表示需要登录，False表示已登录
             try:
                 need_login = await self._check_login_status_async()
@@ -334,6 +390,12 @@ class YuewenPlugin(PluginBase):
                     self.need_login = False
                     self.update_config({"need_login": False})
 
+            # 启动后台令牌刷新任务
+            if self.refresh_token_task is None or self.refresh_token_task.done():
+                self.refresh_token_task = asyncio.create_task(self.login_handler.run_refresh_scheduler())
+
+            await self.gateway.start()
+
             logger.info("[Yuewen] 异步初始化完成")
         except Exception as e:
             logger.error(f"[Yuewen] 异步初始化失败: {e}")
@@ -361,12 +423,27 @@ class YuewenPlugin(PluginBase):
                     "network_mode": yuewen_config.get("network_mode", True),
                     "trigger_prefix": yuewen_config.get("trigger_prefix", "yw"),
                     "api_version": yuewen_config.get("api_version", "old"),
+                    "conversation_backends": dict(yuewen_config.get("conversation_backends", {})),
+                    "accounts": [dict(account) for account in yuewen_config.get("accounts", [])],
+                    "admins": list(yuewen_config.get("admins", [])),
+                    "coalesce_window": yuewen_config.get("coalesce_window", 5),
+                    "keep_reasoning": yuewen_config.get("keep_reasoning", False),
+                    "share_mode": yuewen_config.get("share_mode", "local"),
+                    "poster_font": yuewen_config.get("poster_font", ""),
+                    "generation_deadline": yuewen_config.get("generation_deadline", 300),
+                    "response_cache": dict(yuewen_config.get("response_cache", {})),
+                    "shared_state": dict(yuewen_config.get("shared_state", {})),
+                    "gateway": dict(yuewen_config.get("gateway", {})),
+                    "adaptive_routing": dict(yuewen_config.get("adaptive_routing", {})),
+                    "hedging": dict(yuewen_config.get("hedging", {})),
+                    "outbound": dict(yuewen_config.get("outbound", {})),
                     "image_config": {
                         "imgprompt": image_config.get("imgprompt", "解释下图片内容"),
                         "trigger": image_config.get("trigger", "识图")
                     }
                 }
                 logger.info(f"[Yuewen] 成功加载TOML配置文件: {config_path}")
+                self.config_store.mark_clean()
 
         except FileNotFoundError:
             logger.info(f"[Yuewen] 配置文件 {config_path} 未找到，将创建默认配置文件。")
@@ -379,6 +456,20 @@ class YuewenPlugin(PluginBase):
                 "network_mode": True,
                 "trigger_prefix": "yw",
                 "api_version": "old",
+                "conversation_backends": {},
+                "accounts": [],
+                "admins": [],
+                "coalesce_window": 5,
+                "keep_reasoning": False,
+                "share_mode": "local",
+                "poster_font": "",
+                "generation_deadline": 300,
+                "response_cache": {},
+                "shared_state": {},
+                "gateway": {},
+                "adaptive_routing": {},
+                "hedging": {},
+                "outbound": {},
                 "image_config": {
                     "imgprompt": "解释下图片内容",
                     "trigger": "识图"
@@ -397,6 +488,20 @@ class YuewenPlugin(PluginBase):
                 "network_mode": True,
                 "trigger_prefix": "yw",
                 "api_version": "old",
+                "conversation_backends": {},
+                "accounts": [],
+                "admins": [],
+                "coalesce_window": 5,
+                "keep_reasoning": False,
+                "share_mode": "local",
+                "poster_font": "",
+                "generation_deadline": 300,
+                "response_cache": {},
+                "shared_state": {},
+                "gateway": {},
+                "adaptive_routing": {},
+                "hedging": {},
+                "outbound": {},
                 "image_config": {
                     "imgprompt": "解释下图片内容",
                     "trigger": "识图"
@@ -416,528 +521,211 @@ class YuewenPlugin(PluginBase):
                 "network_mode": True,
                 "trigger_prefix": "yw",
                 "api_version": "old",
+                "conversation_backends": {},
+                "accounts": [],
+                "admins": [],
+                "coalesce_window": 5,
+                "keep_reasoning": False,
+                "share_mode": "local",
+                "poster_font": "",
+                "generation_deadline": 300,
+                "response_cache": {},
+                "shared_state": {},
+                "gateway": {},
+                "adaptive_routing": {},
+                "hedging": {},
+                "outbound": {},
                 "image_config": {
                     "imgprompt": "解释下图片内容",
                     "trigger": "识图"
                 }
             }
 
-    def _get_user_id(self, message: dict) -> str:
-        """从消息中提取用户ID"""
-        from_wxid = message.get("FromWxid", "")
-        is_group = message.get("IsGroup", False)
+    @command("日志", prefix=True, parser=r'(?:\s+(.*))?', requires_login=False)
+    async def _cmd_hot_log(self, call):
+        """管理命令: yw日志 [子系统|全部] [开|关]"""
+        sender_wxid = call.message.get("SenderWxid") or call.from_wxid
+        admins = self.config.get('admins') or []
+        if sender_wxid not in admins:
+            return "⚠️ 该命令仅限管理员使用，请在config.toml的admins中配置管理员wxid"
+
+        parts = (call.args.group(1) or '').split()
+        if len(parts) == 2 and parts[1] in ("开", "关"):
+            subsystem = None if parts[0] in ("全部", "all") else parts[0]
+            try:
+                hotlog.set_enabled(subsystem, parts[1] == "开")
+            except ValueError as e:
+                return f"❌ {e}"
+        elif parts:
+            return "用法: yw日志 [子系统|全部] [开|关]"
+
+        lines = ["📝 热路径调试日志（需日志级别为DEBUG才会输出）:"]
+        for name, enabled in hotlog.status().items():
+            lines.append(f"{name} ({hotlog.SUBSYSTEMS[name]}): {'开' if enabled else '关'}")
+        return "\n".join(lines)
+
+    # ======== 会话状态与后端路由 ========
+    def _new_conversation_state(self, conversation_id, api_version):
+        """创建一个会话状态"""
+        if api_version not in self.backends:
+            api_version = 'old'
+        return {
+            'id': conversation_id,
+            'api_version': api_version,   # 'new'=StepFun, 'old'=Yuewen
+            'chat_id': None,              # 旧版API会话ID
+            'chat_session_id': None,      # 新版API会话ID
+            'account': None,              # 粘性分配的账号名称，上游会话ID只在该账号下有效
+            'last_active_time': 0,
+            'last_message': None,         # 保存最近一次消息用于分享
+            'last_exchange': None,        # 最近一次问答的文本，用于本地生成分享图片
+            'reasoning': None,            # 最近一次回答的思考过程（frames.ReasoningTrace）
+            'shared_at': 0                # 最近一次与共享状态同步上游会话的时间
+        }
 
-        if is_group:
-            group_id = message.get("FromWxid", "")
-            sender_wxid = message.get("SenderWxid", "")
-            return f"{group_id}_{sender_wxid}" if sender_wxid else group_id
+    def _get_conversation(self, conversation_id):
+        """获取会话状态，不存在时按已保存的绑定或默认后端创建"""
+        conversation = self.user_sessions.get(conversation_id)
+        if conversation is None:
+            bindings = self.config.get('conversation_backends') or {}
+            api_version = bindings.get(conversation_id, self._default_conversation['api_version'])
+            conversation = self._new_conversation_state(conversation_id, api_version)
+            self.user_sessions[conversation_id] = conversation
+        return conversation
+
+    def _activate_conversation(self, conversation_id):
+        """将会话设置为当前上下文的活动会话，后续调用都路由到该会话绑定的后端"""
+        self._prune_idle_conversations()
+        conversation = self._get_conversation(conversation_id)
+        _active_conversation.set(conversation)
+        return conversation
+
+    def _prune_idle_conversations(self):
+        """清理长时间没有活动的会话状态，每分钟最多执行一次
+
+        保存了后端绑定或有进行中回答的会话保留；被清理的会话下次使用时按默认后端重新创建，
+        它的上游会话早已超时，不影响对话。
+        """
+        now = time.time()
+        if now - self._sessions_pruned_at < 60:
+            return
+        self._sessions_pruned_at = now
+        bindings = self.config.get('conversation_backends') or {}
+        idle = [
+            conversation_id for conversation_id, conversation in self.user_sessions.items()
+            if now - conversation['last_active_time'] > CONVERSATION_IDLE_TTL
+            and conversation_id not in bindings and conversation_id not in self.generations
+        ]
+        for conversation_id in idle:
+            del self.user_sessions[conversation_id]
+        if idle:
+            logger.debug(f"[Yuewen] 清理 {len(idle)} 个空闲会话状态")
+
+    def _switch_conversation_backend(self, api_version):
+        """切换当前会话绑定的后端，并保存绑定关系"""
+        conversation = self.conversation
+        conversation['api_version'] = api_version
+        conversation['chat_id'] = None
+        conversation['chat_session_id'] = None
+        conversation['last_active_time'] = 0
+        conversation['last_message'] = None
+        conversation['reasoning'] = None
+        conversation['last_exchange'] = None
+
+        if conversation['id'] is None:
+            self.update_config({"api_version": api_version})
+            return
+
+        bindings = dict(self.config.get('conversation_backends') or {})
+        if api_version == self._default_conversation['api_version']:
+            bindings.pop(conversation['id'], None)
         else:
-            return from_wxid
-
-    async def _check_login_status_async(self):
-        """检查登录状态（异步版本）
-        @return: True表示需要登录，False表示已登录
+            bindings[conversation['id']] = api_version
+        self.update_config({"conversation_backends": bindings})
+
+    @property
+    def conversation(self):
+        """当前上下文的活动会话状态"""
+        conversation = _active_conversation.get()
+        return conversation if conversation is not None else self._default_conversation
+
+    @property
+    def api_version(self):
+        return self.conversation['api_version']
+
+    @property
+    def current_base_url(self):
+        return self.base_urls[self.api_version]
+
+    @property
+    def current_chat_id(self):
+        return self.conversation['chat_id']
+
+    @current_chat_id.setter
+    def current_chat_id(self, value):
+        self.conversation['chat_id'] = value
+
+    @property
+    def current_chat_session_id(self):
+        return self.conversation['chat_session_id']
+
+    @current_chat_session_id.setter
+    def current_chat_session_id(self, value):
+        self.conversation['chat_session_id'] = value
+
+    @property
+    def last_active_time(self):
+        return self.conversation['last_active_time']
+
+    @last_active_time.setter
+    def last_active_time(self, value):
+        self.conversation['last_active_time'] = value
+
+    @property
+    def last_message(self):
+        return self.conversation['last_message']
+
+    @last_message.setter
+    def last_message(self, value):
+        self.conversation['last_message'] = value
+
+    @property
+    def current_account(self):
+        """当前会话分配的账号，未分配时使用主账号"""
+        return (self.login_handler.get_account(self.conversation['account'])
+                or self.login_handler.primary_account)
+
+    def _bind_account(self):
+        """为当前会话分配账号
+
+        分配是粘性的，这样上游会话ID保持有效；只有当账号被限流或失效时才迁移到
+        其他账号，此时清空该会话在原账号下的会话ID。
         """
-        # 如果配置中明确需要登录，直接返回True
-        if self.config.get('need_login', True):
-            self.need_login = True
-            return True
-
-        # 检查是否有必要的凭证
-        if not self.oasis_webid or not self.oasis_token:
-            logger.warning("[Yuewen] 缺少webid或token，需要登录")
-            self.need_login = True
-            self.update_config({"need_login": True})
-            return True
-
-        # 尝试刷新令牌验证有效性
-        try:
-            # 刷新令牌
-            if hasattr(self.login_handler, 'refresh_token'):
-                token_valid = await self.login_handler.refresh_token()
-                # 如果刷新失败但存在令牌，可以继续使用
-                if not token_valid and self.oasis_token:
-                    logger.warning("[Yuewen] 刷新令牌失败，但存在令牌，继续使用现有令牌")
-                    self.need_login = False
-                    self.update_config({"need_login": False})
-                    return False
-                # 如果刷新失败且没有有效令牌，需要登录
-                elif not token_valid:
-                    logger.warning("[Yuewen] 令牌刷新失败，需要重新登录")
-                    self.need_login = True
-                    self.update_config({"need_login": True})
-                    return True
-                # 刷新成功，不需要登录
-                else:
-                    self.need_login = False
-                    self.update_config({"need_login": False})
-                    return False
-            else:
-                logger.error("[Yuewen] login_handler缺少refresh_token方法")
-                # 如果没有刷新方法但存在令牌，也可以继续使用
-                if self.oasis_token:
-                    logger.warning("[Yuewen] 无法刷新令牌，但存在令牌，继续使用现有令牌")
-                    self.need_login = False
-                    self.update_config({"need_login": False})
-                    return False
-                else:
-                    self.need_login = True
-                    self.update_config({"need_login": True})
-                    return True
-        except Exception as e:
-            logger.error(f"[Yuewen] 刷新令牌异常: {e}")
-            # 出现异常但存在令牌，可以继续使用
-            if self.oasis_token:
-                logger.warning("[Yuewen] 刷新令牌异常，但存在令牌，继续使用现有令牌")
-                self.need_login = False
-                self.update_config({"need_login": False})
-                return False
-            else:
-                self.need_login = True
-                self.update_config({"need_login": True})
-                return True
-
-        # 令牌有效，不需要登录
-        return False
-
-    async def _initiate_login_async(self, bot, reply_to_wxid, user_id):
-        """初始化登录流程（异步版本）"""
-        try:
-            # 检查是否已有等待验证的用户
-            if user_id in self.waiting_for_verification:
-                # 清除之前的状态
-                self.waiting_for_verification.pop(user_id, None)
-
-            # 无论是否有webid都重新注册设备，确保流程完整
-            logger.info("[Yuewen] 正在注册设备...")
-            await bot.send_text_message(reply_to_wxid, "⏳ 正在注册设备，请稍候...")
-
-            # 异步调用登录处理器的注册设备方法
-            if not await self.login_handler.register_device():
-                await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败，请稍后重试")
-                return False
-
-            # 从登录处理器获取webid
-            self.oasis_webid = self.login_handler.config.get('oasis_webid')
-
-            # 成功注册设备后，检查是否有webid
-            if not self.oasis_webid:
-                await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败: 未获取到webid")
-                return False
-
-            logger.info(f"[Yuewen] 设备注册成功，webid={self.oasis_webid}")
-            await bot.send_text_message(reply_to_wxid, "✅ 设备注册成功，正在初始化登录...")
-
-            # 提示用户输入手机号
-            await bot.send_text_message(
-                reply_to_wxid,
-                "📱 请输入您的11位手机号码\n注意：此手机号将用于接收跃问的验证码"
-            )
-
-            # 标记此用户正在进行登录操作 - 使用空字符串作为占位符
-            self.waiting_for_verification[user_id] = ""
-
-            # 记录用户正在等待输入手机号
-            self.login_users.add(user_id)
-            self.is_login_triggered = True
-
-            return True
-        except Exception as e:
-            logger.error(f"[Yuewen] 初始化登录流程失败: {e}", exc_info=True)
-            await bot.send_text_message(reply_to_wxid, f"❌ 初始化登录失败: {str(e)}")
-            return False
-
-    async def _send_verification_code_async(self, bot, reply_to_wxid, user_id, phone_number):
-        """发送验证码到手机（异步版本）"""
-        try:
-            # 检查手机号格式
-            if not phone_number.isdigit() or len(phone_number) != 11:
-                await bot.send_text_message(reply_to_wxid, "❌ 请输入有效的11位手机号码")
-                return False
-
-            await bot.send_text_message(reply_to_wxid, f"⏳ 正在发送验证码，请稍候...")
-
-            # 确保有webid - 使用login_handler中的
-            if not self.oasis_webid:
-                # 更新webid
-                self.oasis_webid = self.login_handler.config.get('oasis_webid')
-
-                # 如果仍然没有，尝试重新注册设备
-                if not self.oasis_webid:
-                    logger.info("[Yuewen] 发送验证码前重新注册设备")
-                    if not await self.login_handler.register_device():
-                        await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败，无法发送验证码")
-                        return False
-
-                    # 更新webid
-                    self.oasis_webid = self.login_handler.config.get('oasis_webid')
-
-                    # 检查注册后是否有webid
-                    if not self.oasis_webid:
-                        await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败: 未获取到webid")
-                        return False
-
-                    logger.info(f"[Yuewen] 设备注册成功，webid={self.oasis_webid}")
-
-            # 使用异步版本发送验证码
-            success = await self.login_handler.send_verify_code(phone_number)
-
-            if success:
-                # 保存手机号，等待后续输入验证码
-                self.waiting_for_verification[user_id] = phone_number
-
-                # 从登录状态列表移除，表示已完成手机号输入步骤
-                if user_id in self.login_users:
-                    self.login_users.remove(user_id)
-
-                await bot.send_text_message(
-                    reply_to_wxid,
-                    "✅ 验证码已发送，请输入收到的4位验证码完成登录"
-                )
-                return True
-            else:
-                # 验证码发送失败，清除等待状态
-                if user_id in self.waiting_for_verification:
-                    self.waiting_for_verification.pop(user_id, None)
-
-                await bot.send_text_message(
-                    reply_to_wxid,
-                    f"❌ 验证码发送失败，请检查手机号是否正确或稍后重试"
-                )
-                return False
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 验证码发送处理异常: {e}", exc_info=True)
-            # 清除等待状态
-            if user_id in self.waiting_for_verification:
-                self.waiting_for_verification.pop(user_id, None)
-
-            await bot.send_text_message(reply_to_wxid, f"❌ 处理失败: {str(e)}")
-            return False
-
-    async def _verify_login_async(self, bot, reply_to_wxid, user_id, verify_code):
-        """验证登录（异步版本）"""
-        try:
-            # 获取之前保存的手机号
-            phone_number = self.waiting_for_verification.get(user_id)
-            if not phone_number:
-                await bot.send_text_message(reply_to_wxid, "❌ 验证失败：请先发送手机号获取验证码")
-                return False
-
-            # 向用户发送正在验证的消息
-            await bot.send_text_message(reply_to_wxid, "⏳ 正在验证登录，请稍候...")
-
-            # 使用登录处理器的异步方法进行登录验证
-            if await self.login_handler.sign_in(mobile_num=phone_number, auth_code=verify_code):
-                # 清除等待验证状态
-                self.waiting_for_verification.pop(user_id, None)
-
-                # 同步登录状态到当前插件
-                self.need_login = False
-                self.oasis_webid = self.login_handler.config.get('oasis_webid')
-                self.oasis_token = self.login_handler.config.get('oasis_token')
-
-                # 更新配置
-                self.update_config({
-                    'need_login': False,
-                    'oasis_webid': self.oasis_webid,
-                    'oasis_token': self.oasis_token
-                })
-
-                # 创建新会话
-                await bot.send_text_message(reply_to_wxid, "✅ 登录成功，正在创建会话...")
-
-                # 创建新会话
-                if await self.create_chat_async():
-                    await bot.send_text_message(reply_to_wxid, "✅ 会话创建成功，可以开始对话了")
-                else:
-                    await bot.send_text_message(reply_to_wxid, "⚠️ 登录成功，但会话创建失败，请发送'yw新建会话'尝试创建会话")
-
-                logger.info("[Yuewen] 用户登录成功并创建会话")
-                return True
-            else:
-                # 验证失败
-                await bot.send_text_message(reply_to_wxid, "❌ 验证码错误或已过期，请重新发送'yw登录'进行登录")
-                # 清除等待状态
-                self.waiting_for_verification.pop(user_id, None)
-                return False
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 验证登录异常: {e}", exc_info=True)
-            # 清除等待状态
-            self.waiting_for_verification.pop(user_id, None)
-            await bot.send_text_message(reply_to_wxid, f"❌ 验证登录出错: {str(e)}")
-            return False
-
-    async def _handle_commands_async(self, content):
-        """处理内置命令（异步版本）"""
-        if not content:
-            return None
-
-        # 打印模型命令
-        if content == "打印模型":
-            # 构建模型列表 - 无论API版本都显示可用模型
-            output = ["可用模型："]
-            for num, info in self.models.items():
-                status = "（支持联网）" if info.get('can_network', True) else ""
-                current = " ← 当前使用" if info['id'] == self.current_model_id else ""
-                output.append(f"{num}. {info['name']}{status}{current}")
-            return '\n'.join(output)
-
-        # 模型切换命令
-        if content.startswith("切换模型") or content.startswith("模型") or content.startswith("model"):
-            # 如果是新版API，提示用户不支持
-            if self.api_version == 'new':
-                return "⚠️ 切换模型功能仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
-
-            model_num = None
-            # 尝试提取模型编号
-            try:
-                # 支持 "切换模型1", "切换模型 1", "模型1", "模型 1", "model1", "model 1" 等格式
-                cmd_parts = content.replace("切换模型", "").replace("模型", "").replace("model", "").strip()
-                if cmd_parts.isdigit():
-                    model_num = int(cmd_parts)
-            except:
-                pass
-
-            # 如果没有指定模型或模型无效，显示可用模型列表
-            if not model_num or model_num not in self.models:
-                models_info = "\n".join([f"{idx}. {model['name']}" for idx, model in self.models.items()])
-                return f"可用模型列表：\n{models_info}\n\n使用方法：yw切换模型[编号] 进行切换"
-
-            # 切换模型
-            selected_model = self.models.get(model_num, {})
-            self.current_model_id = selected_model["id"]
-            self.update_config({"current_model_id": self.current_model_id})
-
-            # 如果是deepseek r1模型(id=6)，强制开启联网模式
-            if selected_model.get('id') == 6:  # deepseek r1模型ID
-                self.network_mode = True
-                self.update_config({"network_mode": True})
-                # 同步启用深度思考模式
-                await self._enable_deep_thinking_async()
-
-            # 如果该模型不支持联网但是当前开启了联网，关闭联网
-            elif not selected_model.get("can_network", True) and self.network_mode:
-                self.network_mode = False
-                self.update_config({"network_mode": False})
-
-            # 创建新会话
-            self.current_chat_id = None
-            self.current_chat_session_id = None
-            if not await self.create_chat_async():
-                return f"⚠️ 已切换到 [{selected_model.get('name', '未知模型')}]，但新会话创建失败，请手动发送'yw新建会话'"
-
-            # 同步服务器状态
-            await self._sync_server_state_async()
-
-            # 根据模型联网支持情况返回不同消息
-            if not selected_model.get("can_network", True) and self.network_mode:
-                return f"✅ 已切换到 [{selected_model.get('name', '未知模型')}]，该模型不支持联网，已自动关闭联网功能"
-            else:
-                return f"✅ 已切换至 [{selected_model.get('name', '未知模型')}]"
-
-        # 联网模式命令
-        elif content in ["联网", "开启联网", "打开联网"]:
-            # 检查当前模型是否支持联网
-            current_model_info = None
-            for model_num, model_info in self.models.items():
-                if model_info.get("id") == self.current_model_id:
-                    current_model_info = model_info
-                    break
-
-            if current_model_info and not current_model_info.get("can_network", True):
-                return f"❌ 当前模型 [{current_model_info.get('name', '未知模型')}] 不支持联网，请先切换到支持联网的模型"
-
-            # 如果已经是联网模式，提示用户
-            if self.network_mode:
-                return "ℹ️ 联网模式已经开启"
-
-            # 开启联网模式
-            self.network_mode = True
-            self.update_config({"network_mode": True})
-
-            # 尝试同步服务器状态
-            try:
-                await self._sync_server_state_async()
-            except Exception as e:
-                logger.error(f"[Yuewen] 同步网络状态失败: {e}")
-
-            return "✅ 已开启联网模式"
-
-        # 关闭联网模式命令
-        elif content in ["不联网", "关闭联网", "禁用联网"]:
-            # 如果已经是非联网模式，提示用户
-            if not self.network_mode:
-                return "ℹ️ 联网模式已经关闭"
-
-            # 关闭联网模式
-            self.network_mode = False
-            self.update_config({"network_mode": False})
-
-            # 尝试同步服务器状态
-            try:
-                await self._sync_server_state_async()
-            except Exception as e:
-                logger.error(f"[Yuewen] 同步网络状态失败: {e}")
-
-            return "✅ 已关闭联网模式"
-
-        # API版本切换命令
-        elif content in ["切换旧版", "使用旧版", "旧版API"]:
-            if self.api_version == 'old':
-                return "ℹ️ 已经是旧版API模式"
-
-            # 切换到旧版API
-            self.api_version = 'old'
-            self.current_base_url = self.base_urls['old']
-            self.update_config({"api_version": "old"})
-
-            # 清除会话
-            self.current_chat_id = None
-            self.current_chat_session_id = None
-
-            return "✅ 已切换到旧版API模式，将在下一次对话创建新会话"
-
-        elif content in ["切换新版", "使用新版", "新版API"]:
-            if self.api_version == 'new':
-                return "ℹ️ 已经是新版API模式"
-
-            # 切换到新版API
-            self.api_version = 'new'
-            self.current_base_url = self.base_urls['new']
-            self.update_config({"api_version": "new"})
-
-            # 清除会话
-            self.current_chat_id = None
-            self.current_chat_session_id = None
-
-            return "✅ 已切换到新版API模式，将在下一次对话创建新会话"
-
-        # 分享命令
-        elif content in ["分享", "share", "生成图片"]:
-            # 检查是否支持分享功能
-            if self.api_version == 'new':
-                return "⚠️ 分享功能仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
-
-            # 检查是否有最近的消息记录
-            if not hasattr(self, 'last_message') or not self.last_message:
-                return "⚠️ 没有可分享的消息记录，请先发送一条消息"
-
-            # 检查最近消息是否超时
-            current_time = time.time()
-            if current_time - self.last_message.get('last_time', 0) > 180:  # 3分钟超时
-                return "⚠️ 分享超时，请重新发送消息后再尝试分享"
-
-            return "🔄 正在生成分享图片，请稍候..."
-
-        # 深度思考模式
-        elif content in ["深度思考", "enable_deep_thinking", "思考模式"]:
-            if self.api_version != 'old':
-                return "⚠️ 深度思考模式仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
-
-            # 调用深度思考设置方法
-            if await self._enable_deep_thinking_async():
-                return "✅ 已开启深度思考模式"
-            else:
-                return "❌ 开启深度思考模式失败，请重试"
-
-        # 帮助命令
-        elif content in ["帮助", "help", "指令", "命令"]:
-            current_api_version = "新版API" if self.api_version == 'new' else "旧版API"
-            help_text = f"""📚 跃问AI助手指令 (当前: {current_api_version})：
-
-【通用指令】
-1. yw [问题] - 向AI提问
-2. yw登录 - 重新登录账号
-3. yw联网/不联网 - 开启/关闭联网功能
-4. yw新建会话 - 开始新的对话
-5. yw切换旧版/新版 - 切换API版本
-6. yw识图 [描述] - 发送图片让AI分析
-
-【仅限旧版API功能】
-7. yw切换模型[编号] - 切换AI模型 (当前：{
-    next((f"{idx}.{model['name']}" for idx, model in self.models.items()
-         if model['id'] == self.current_model_id), "未知")})
-8. yw打印模型 - 显示所有可用模型
-9. yw分享 - 生成对话分享图片
-10. yw深度思考 - 启用思考模式
-11. yw识图N [描述] - 分析N张图片
-12. yw多图 [描述] - 分析多张图片
-
-当前状态：联网{" ✓" if self.network_mode else " ✗"}
-"""
-            return help_text
-
-        # 未匹配任何命令
-        return None
+        conversation = self.conversation
+        account = self.login_handler.get_account(conversation['account'])
+        if account is not None and account.usable and not account.is_throttled():
+            return account
+
+        new_account = self.login_handler.pick_account()
+        if account is not None and new_account is not account:
+            logger.info(f"[Yuewen] 会话 {conversation['id']} 从账号 {account.name} 迁移到 {new_account.name}")
+            conversation['chat_id'] = None
+            conversation['chat_session_id'] = None
+            conversation['last_message'] = None
+        conversation['account'] = new_account.name
+        return new_account
+
+    @property
+    def backend(self):
+        """当前会话绑定的上游后端"""
+        return self.backends[self.api_version]
+
+    def _get_session_id(self):
+        """当前API版本的会话ID"""
+        return self.current_chat_session_id if self.api_version == 'new' else self.current_chat_id
 
     def _update_headers(self):
-        """根据当前 API 版本更新通用请求头"""
-        headers = self.base_headers.copy()
-        # 使用 self.current_base_url 代替硬编码的 URL
-        base_url = self.current_base_url
-        token = self.oasis_token or self.config.get('oasis_token', '')
-        webid = self.oasis_webid or self.config.get('oasis_webid', '')
-
-        # 基本 Cookie 组件
-        cookie_parts = []
-        if webid:
-             cookie_parts.append(f"Oasis-Webid={webid}")
-        # 注意：新 API 可能需要不同的或额外的 Cookie
-        if token:
-             cookie_parts.append(f"Oasis-Token={token}")
-
-        cookie_string = "; ".join(cookie_parts)
-
-        # 两个版本通用的 Header
-        common_headers = {
-            'Cookie': cookie_string,
-            'oasis-webid': webid,
-            'origin': base_url, # 使用当前版本的 base_url
-            'referer': f'{base_url}/', # Referer 可能需要根据具体端点调整
-            'oasis-appid': '10200',
-            'oasis-platform': 'web',
-            'oasis-language': 'zh', # 新增，新版可能需要
-            'connect-protocol-version': '1', # 两个版本似乎都需要
-            'canary': 'false', # 两个版本似乎都需要
-            'priority': 'u=1, i', # 两个版本似乎都需要
-            'x-waf-client-type': 'fetch_sdk' # 两个版本似乎都需要
-        }
-        headers.update(common_headers)
-
-        # --- 旧版 API 特有 Headers ---
-        if self.api_version == 'old':
-            logger.debug("[Yuewen] Adding Old API specific headers (RUM trace).")
-            headers.update({
-                 'x-rum-traceparent': self._generate_traceparent(),
-                 'x-rum-tracestate': self._generate_tracestate(),
-                 # 可能还有 'oasis-mode': '2' 等旧版特有的，根据需要添加回
-                 'oasis-mode': '2',
-            })
-            # 确保移除新版可能添加的不兼容 header (如果 common_headers 中有的话)
-
-        # --- 新版 API 特有 Headers ---
-        elif self.api_version == 'new':
-             logger.debug("[Yuewen] Adding New API specific headers (if any).")
-             # 添加新版 API 特有的 Headers，例如 'Sec-Fetch-Dest': 'empty' 等
-             # headers.update({ 'some-new-header': 'new-value'})
-             # 移除旧版特有的 header
-             headers.pop('x-rum-traceparent', None)
-             headers.pop('x-rum-tracestate', None)
-             headers.pop('oasis-mode', None) # 假设新版不需要
-
-        return headers
-
-    def _generate_traceparent(self):
-        """生成跟踪父ID - 跃问服务器请求需要"""
-        trace_id = ''.join(random.choices('0123456789abcdef', k=32))
-        span_id = ''.join(random.choices('0123456789abcdef', k=16))
-        return f"00-{trace_id}-{span_id}-01"
-
-    def _generate_tracestate(self):
-        """生成跟踪状态 - 跃问服务器请求需要"""
-        return f"yuewen@rsid={random.getrandbits(64):016x}"
+        """根据当前 API 版本获取通用请求头"""
+        return self.backend.headers()
 
     async def create_chat_async(self):
         """创建新聊天会话（异步版本）"""
@@ -952,214 +740,50 @@ class YuewenPlugin(PluginBase):
                 logger.error("[Yuewen] 刷新令牌失败，无法创建会话")
                 return False
 
-            # 根据API版本调用不同的会话创建函数
-            if self.api_version == 'new':
-                success = await self._create_chat_session_new_async()
-                if success:
-                    logger.info(f"[Yuewen] 新会话创建成功: {self.current_chat_session_id}")
-                    self.last_active_time = time.time()
-                    return True
-                else:
-                    logger.error("[Yuewen] 新会话创建失败")
-                    return False
-            else:
-                success = await self._create_chat_old_async()
-                if success:
-                    logger.info(f"[Yuewen] 旧会话创建成功: {self.current_chat_id}")
-                    self.last_active_time = time.time()
-                    return True
-                else:
-                    logger.error("[Yuewen] 旧会话创建失败")
-                    return False
+            return await self._create_upstream_session_async()
 
         except Exception as e:
             logger.error(f"[Yuewen] 创建会话失败: {e}", exc_info=True)
             return False
 
-    async def _create_chat_old_async(self):
-        """创建旧版API会话（异步版本）"""
-        try:
-            logger.info("[Yuewen] 尝试创建旧版API会话...")
-
-            url = f"{self.current_base_url}/api/proto.chat.v1.ChatService/CreateChat"
-
-            # 构建请求头 - 确保包含关键参数
-            headers = self._update_headers()
-
-            logger.debug(f"[Yuewen] 创建旧会话请求: URL={url}, headers={headers}")
-
-            # 添加重试机制
-            for retry in range(2):
-                try:
-                    # 使用httpx异步客户端发送请求
-                    import httpx
-                    async with httpx.AsyncClient(timeout=30.0) as client:
-                        response = await client.post(
-                            url,
-                            headers=headers,
-                            json={"chatName": "新会话"}
-                        )
-                        if response.status_code == 200:
-                            result = response.json()
-                            logger.debug(f"[Yuewen] 创建旧会话响应: {result}")
-
-                            # 从响应中提取chatId
-                            if 'id' in result:
-                                self.current_chat_id = result['id']
-
-                                # 保存到配置
-                                self.update_config({
-                                    'current_chat_id': self.current_chat_id
-                                })
-
-                                logger.info(f"[Yuewen] 旧版API创建会话成功: {self.current_chat_id}")
-
-                                # 同步服务器状态 (设置模型和联网)
-                                await self._sync_server_state_async()
-
-                                return True
-                            elif 'chatId' in result:  # 尝试另一种可能的字段名
-                                self.current_chat_id = result['chatId']
-
-                                # 保存到配置
-                                self.update_config({
-                                    'current_chat_id': self.current_chat_id
-                                })
-
-                                logger.info(f"[Yuewen] 旧版API创建会话成功: {self.current_chat_id}")
-
-                                # 同步服务器状态 (设置模型和联网)
-                                await self._sync_server_state_async()
-
-                                return True
-                            else:
-                                logger.error(f"[Yuewen] 旧版API创建会话失败: 响应缺少id字段 - {result}")
-                                # 如果是第一次重试，继续尝试
-                                if retry == 0:
-                                    logger.info("[Yuewen] 尝试刷新令牌并重试创建会话...")
-                                    if await self.login_handler.refresh_token():
-                                        # 更新header中的Cookie
-                                        headers = self._update_headers()
-                                        continue
-                                return False
-
-                        # 处理其他错误响应
-                        error_text = response.text
-                        logger.error(f"[Yuewen] 旧版API创建会话失败: {response.status_code}, {error_text}")
-
-                        # 如果是第一次重试，继续尝试
-                        if retry == 0:
-                            logger.info("[Yuewen] 尝试重试创建会话...")
-                            if await self.login_handler.refresh_token():
-                                # 更新header
-                                headers = self._update_headers()
-                                continue
-
-                        return False
+    async def _create_upstream_session_async(self):
+        """在当前后端创建会话并同步服务器状态
 
-                except Exception as e:
-                    logger.error(f"[Yuewen] 创建会话请求异常: {e}", exc_info=True)
-                    # 如果是第一次重试，继续尝试
-                    if retry == 0:
-                        logger.info("[Yuewen] 尝试重试创建会话...")
-                        if await self.login_handler.refresh_token():
-                            # 更新header
-                            headers = self._update_headers()
-                            continue
-                    return False
-
-            return False
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 旧版API创建会话异常: {e}", exc_info=True)
+        旧版API的模型/联网设置是账号级的，不依赖新会话ID，与创建会话并发进行。
+        """
+        session_id, _ = await asyncio.gather(self.backend.create_session(), self._sync_server_state_async())
+        if not session_id:
+            logger.error(f"[Yuewen] {self.api_version}版API会话创建失败")
             return False
 
-    async def _create_chat_session_new_async(self):
-        """创建新版API (stepfun.com) 会话（异步版本）"""
-        logger.debug("[Yuewen] 调用_create_chat_session_new_async")
-
-        for retry in range(2):
-            # 获取适配新版的headers
-            headers = self._update_headers()
-            headers['Content-Type'] = 'application/json'
-
-            # 新版创建会话的端点
-            url = f'{self.current_base_url}/api/agent/capy.agent.v1.AgentService/CreateChatSession'
-            logger.info(f"[Yuewen][New API] 尝试创建会话: {url}")
-
-            try:
-                # 异步发送请求
-                async with self.http_session.post(
-                    url,
-                    headers=headers,
-                    json={}
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        # 提取 chatSessionId
-                        session_data = data.get('chatSession')
-                        if session_data and session_data.get('chatSessionId'):
-                            self.current_chat_session_id = session_data['chatSessionId']
-                            self.current_chat_id = None # 清空旧版 ID
-                            self.last_active_time = time.time()
-                            logger.info(f"[Yuewen][New API] 新建会话成功 SessionID: {self.current_chat_session_id}")
-                            return True
-                        else:
-                            logger.error(f"[Yuewen][New API] 创建会话失败: 响应中缺少 chatSessionId - {await response.text()}")
-                            return False
-                    elif response.status == 401 and retry == 0:
-                        if await self.login_handler.refresh_token():
-                            continue
-                        else:
-                            logger.error("[Yuewen][New API] Token刷新失败")
-                            return False
-
-                    error_text = await response.text()
-                    logger.error(f"[Yuewen][New API] 创建会话失败: HTTP {response.status} - {error_text}")
-                    if retry < 1:
-                        continue
-                    return False
-
-            except Exception as e:
-                if retry == 0:
-                    if await self.login_handler.refresh_token():
-                        continue
-                logger.error(f"[Yuewen][New API] 创建会话失败: {str(e)}", exc_info=True)
-                if retry < 1:
-                    continue
-                return False
+        if self.api_version == 'new':
+            self.current_chat_session_id = session_id
+            self.current_chat_id = None  # 清空旧版 ID
+        else:
+            self.current_chat_id = session_id
 
-        return False
+        self.last_active_time = time.time()
+        logger.info(f"[Yuewen] 会话创建成功: {session_id}")
+        return True
 
     async def _sync_server_state_async(self):
-        """同步服务器状态(设置模型和网络搜索首选项)（异步版本）"""
+        """同步服务器状态(设置模型和网络搜索首选项)（异步版本）
+
+        只发送与该账号上次成功应用的设置不同的项，并发执行。
+        """
         try:
             # 仅旧版API需要显式同步
             if self.api_version != 'old':
                 return True
 
-            # 确保有会话ID
-            if not self.current_chat_id:
-                logger.warning("[Yuewen] 同步服务器状态失败: 没有有效的会话ID")
-                return False
-
-            # 设置模型首选项
-            model_success = False
-            for model_num, model_info in self.models.items():
-                if model_info.get("id") == self.current_model_id:
-                    logger.info(f"[Yuewen] 同步模型设置: {model_info.get('name', '未知模型')} (ID: {self.current_model_id})")
-                    model_success = await self._call_set_model_async(self.current_model_id)
-                    break
-
-            if not model_success:
-                logger.warning(f"[Yuewen] 同步模型设置失败: {self.current_model_id}")
-
-            # 设置网络搜索首选项
-            network_success = await self._enable_search_async(self.network_mode)
-            if not network_success:
-                logger.warning(f"[Yuewen] 同步网络搜索设置失败: {self.network_mode}")
-
-            return model_success and network_success
+            desired = {'model': self.current_model_id, 'search': bool(self.network_mode)}
+            changes = self.settings_sync.changes(self.current_account.name, desired)
+            if changes:
+                logger.info(f"[Yuewen] 同步服务器设置: {changes}")
+            return await self.settings_sync.sync(self.current_account.name, desired, {
+                'model': self._call_set_model_async,
+                'search': self._enable_search_async,
+            })
 
         except Exception as e:
             logger.error(f"[Yuewen] 同步服务器状态失败: {e}", exc_info=True)
@@ -1167,131 +791,39 @@ class YuewenPlugin(PluginBase):
 
     async def _call_set_model_async(self, model_id):
         """设置模型ID（异步版本）"""
-        try:
-            # 仅旧版API支持此操作
-            if self.api_version != 'old':
-                return False
-
-            # 设置模型URL
-            url = f"{self.current_base_url}/api/proto.user.v1.UserService/SetModelInUse"
-
-            # 获取包含Cookie的headers
-            headers = self._update_headers()
-            headers.update({
-                'Content-Type': 'application/json',
-                'oasis-mode': '1',  # 使用mode 1，与创建会话保持一致
-                'referer': f'{self.current_base_url}/chats/{self.current_chat_id}'
-            })
-
-            # 发送异步请求
-            for retry in range(2):
-                try:
-                    async with self.http_session.post(
-                        url,
-                        headers=headers,
-                        json={"modelId": model_id}
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            if result.get("result") == "RESULT_CODE_SUCCESS":
-                                logger.info(f"[Yuewen] 模型设置成功: {model_id}")
-                                return True
-
-                        # 如果是401错误，尝试刷新令牌并重试
-                        elif response.status == 401 and retry == 0:
-                            logger.warning("[Yuewen] 设置模型失败: 令牌无效，尝试刷新...")
-                            if await self.login_handler.refresh_token():
-                                # 更新headers (包含新的token)
-                                headers = self._update_headers()
-                                headers.update({
-                                    'Content-Type': 'application/json',
-                                    'oasis-mode': '1',
-                                    'referer': f'{self.current_base_url}/chats/{self.current_chat_id}'
-                                })
-                                continue
-
-                        error_text = await response.text()
-                        logger.error(f"[Yuewen] 设置模型失败: {response.status}, {error_text}")
-                        return False
-
-                except Exception as e:
-                    logger.error(f"[Yuewen] 设置模型请求异常: {e}", exc_info=True)
-                    return False
-
-            return False
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 设置模型异常: {e}", exc_info=True)
+        # 仅旧版API支持此操作
+        if self.api_version != 'old':
             return False
+        return await self.backends['old'].set_model(self.current_chat_id, model_id)
 
     async def _enable_search_async(self, enable=True):
         """设置网络搜索功能状态（异步版本）"""
-        try:
-            # 仅旧版API支持此操作
-            if self.config.get('api_version') != 'old':
-                return False
-
-            # 设置模型URL
-            url = f"{self.current_base_url}/api/proto.user.v1.UserService/EnableSearch"
-
-            # 获取包含Cookie的headers
-            headers = self._update_headers()
-            headers.update({
-                'Content-Type': 'application/json',
-                'oasis-mode': '1',  # 使用mode 1，与创建会话保持一致
-                'referer': f'{self.current_base_url}/chats/{self.current_chat_id}'
-            })
-
-            # 发送异步请求
-            for retry in range(2):
-                try:
-                    async with self.http_session.post(
-                        url,
-                        headers=headers,
-                        json={"enable": enable}
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            if result.get("result") == "RESULT_CODE_SUCCESS":
-                                logger.info(f"[Yuewen] 网络搜索设置成功: {enable}")
-                                return True
-
-                        # 如果是401错误，尝试刷新令牌并重试
-                        elif response.status == 401 and retry == 0:
-                            logger.warning("[Yuewen] 设置网络搜索失败: 令牌无效，尝试刷新...")
-                            if await self.login_handler.refresh_token():
-                                # 更新headers (包含新的token)
-                                headers = self._update_headers()
-                                headers.update({
-                                    'Content-Type': 'application/json',
-                                    'oasis-mode': '1',
-                                    'referer': f'{self.current_base_url}/chats/{self.current_chat_id}'
-                                })
-                                continue
-
-                        error_text = await response.text()
-                        logger.error(f"[Yuewen] 设置网络搜索失败: {response.status}, {error_text}")
-                        return False
-
-                except Exception as e:
-                    logger.error(f"[Yuewen] 设置网络搜索请求异常: {e}", exc_info=True)
-                    return False
-
-            return False
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 设置网络搜索异常: {e}", exc_info=True)
+        # 仅旧版API支持此操作
+        if self.api_version != 'old':
             return False
+        return await self.backends['old'].enable_search(self.current_chat_id, enable)
 
     # ======== 消息发送与处理 ========
-    async def send_message_async(self, content):
-        """发送消息到跃问AI并返回响应（异步版本）"""
+    async def send_message_async(self, content, attachments=None):
+        """发送消息到跃问AI并返回响应（异步版本）
+
+        Args:
+            content: 问题
+            attachments: 图片附件（backend.build_attachment 的结果），附件只在上传时的账号下有效
+        """
         try:
             current_time = time.time()
 
+            # 多实例时同一会话的上一条消息可能由其他实例处理
+            await self._restore_shared_session()
+            await self.login_handler.load_shared_throttles()
+
+            # 先确定账号：账号迁移会清空旧账号下的会话ID
+            account = self._bind_account()
+
             # 实现会话超时机制
             # 如果距离上次活动超过180秒(3分钟)，则重新创建会话
-            session_timeout = 180  # 3分钟超时
+            session_timeout = SESSION_TIMEOUT
             is_session_expired = self.last_active_time > 0 and (current_time - self.last_active_time) > session_timeout
 
             if is_session_expired:
@@ -1301,11 +833,24 @@ class YuewenPlugin(PluginBase):
                 self.current_chat_session_id = None
 
             # 检查是否有有效会话，没有则创建
-            needs_new_session = False
-            if self.api_version == 'new':
-                needs_new_session = not self.current_chat_session_id
-            else:
-                needs_new_session = not self.current_chat_id
+            needs_new_session = not self._get_session_id()
+
+            # 简短问题或高负载时按延迟统计选择更快的模型/联网模式
+            context.current().route = self._choose_route(content)
+
+            # 新会话的第一条问题没有上下文，命中缓存时直接返回，不访问网络
+            # key 使用实际的路由，自适应路由改派的回答不会记到用户手动选择的模型下
+            cache_key = None
+            if needs_new_session and not attachments and self.response_cache.enabled:
+                _, model_id, network = self._request_route()
+                cache_key = ResponseCache.make_key(self.api_version, normalize_prompt(content), model_id, network)
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    logger.info("[Yuewen] 新会话问题命中回答缓存，跳过请求")
+                    return self._format_cached_answer(cached, current_time)
+
+            if not await self._acquire_account_slot(account):
+                return "⚠️ 请求过于频繁，请稍后再试"
 
             if needs_new_session:
                 logger.info("[Yuewen] 没有活动会话，正在创建新会话")
@@ -1322,8 +867,7 @@ class YuewenPlugin(PluginBase):
                         return "创建会话失败，请尝试发送'yw新建会话'或检查网络连接"
 
             # 再次检查会话是否有效
-            if (self.api_version == 'new' and not self.current_chat_session_id) or \
-               (self.api_version == 'old' and not self.current_chat_id):
+            if not self._get_session_id():
                 return "无效的会话ID，请尝试发送'yw新建会话'创建新会话"
 
             # 更新最后活动时间
@@ -1333,76 +877,364 @@ class YuewenPlugin(PluginBase):
             if not await self.login_handler.refresh_token():
                 logger.warning("[Yuewen] 刷新令牌失败，但仍尝试发送消息")
 
-            # 根据API版本发送消息
-            if self.api_version == 'new':
-                response = await self._send_message_new_async(content)
+            hedge_delay = self._hedge_delay() if not attachments else None
+            if hedge_delay is not None:
+                result = await self._send_hedged_async(content, hedge_delay)
+            else:
+                result = await self._send_to_backend_async(content, attachments)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, self._cacheable_answer(result))
+            await self._publish_shared_session()
+            return result
+        except Exception as e:
+            logger.error(f"[Yuewen] 发送消息失败: {e}", exc_info=True)
+            return f"发送消息失败: {str(e)}"
+
+    @staticmethod
+    def _cacheable_answer(response):
+        """正常完成的文本回答去掉本次请求的信息（耗时、分享提示）后用于缓存
+
+        错误提示和直接发送的图片不缓存，返回 None。
+
+        Returns:
+            tuple: (模型名称, 联网模式, 冒号及换行, 正文)
+        """
+        if not isinstance(response, str) or context.current().image_sent:
+            return None
+        meta = _REPLY_META_RE.match(response)
+        if not meta:
+            return None
+        body = response[meta.end():]
+        if body.endswith(_SHARE_HINT):
+            body = body[:-len(_SHARE_HINT)].rstrip()
+        if not body.strip():
+            return None
+        return meta.group(1), meta.group(2), meta.group(3), body
+
+    def _format_cached_answer(self, cached, started_at):
+        """按本次请求重新生成缓存回答的模型说明和分享提示"""
+        model_name, network_mode, separator, body = cached
+        reply = f"使用{model_name}模型{network_mode}模式回答（耗时{time.time() - started_at:.2f}秒）{separator}{body}"
+        # 缓存的回答没有上游消息记录，只能在本地生成分享图片
+        if self.api_version == 'old' and self.share_mode == 'local':
+            reply = f"{reply}\n\n{_SHARE_HINT}"
+        return reply
+
+    # ======== 多实例共享状态 ========
+    def _shared_session_key(self):
+        return f"session:{self.conversation['id']}"
+
+    async def _restore_shared_session(self):
+        """采用其他实例在该会话上更新过的上游会话，保持对话上下文连续"""
+        conversation = self.conversation
+        if not self.shared_state.shared or conversation['id'] is None:
+            return
+        try:
+            record = await self.shared_state.get(self._shared_session_key())
+        except Exception as e:
+            logger.warning(f"[Yuewen] 读取共享会话失败: {e}")
+            return
+        if (not record or record.get('updated', 0) <= conversation['shared_at']
+                or record.get('api_version') != conversation['api_version']):
+            return
+        if record.get('chat_id') != conversation['chat_id']:
+            # 分享需要的消息记录属于原来的上游会话
+            conversation['last_message'] = None
+        conversation['chat_id'] = record.get('chat_id')
+        conversation['chat_session_id'] = record.get('chat_session_id')
+        conversation['account'] = record.get('account')
+        conversation['last_active_time'] = record.get('last_active_time', 0)
+        conversation['shared_at'] = record['updated']
+        logger.debug(f"[Yuewen] 会话 {conversation['id']} 采用其他实例的上游会话")
+
+    async def _publish_shared_session(self):
+        """把会话当前的上游会话写入共享状态，有效期与会话超时相同"""
+        conversation = self.conversation
+        if not self.shared_state.shared or conversation['id'] is None or not self._get_session_id():
+            return
+        now = time.time()
+        try:
+            await self.shared_state.set(self._shared_session_key(), {
+                'api_version': conversation['api_version'],
+                'chat_id': conversation['chat_id'],
+                'chat_session_id': conversation['chat_session_id'],
+                'account': conversation['account'],
+                'last_active_time': conversation['last_active_time'],
+                'updated': now,
+            }, ttl=SESSION_TIMEOUT)
+            conversation['shared_at'] = now
+        except Exception as e:
+            logger.warning(f"[Yuewen] 写入共享会话失败: {e}")
+
+    async def _acquire_account_slot(self, account):
+        """按账号限制上游请求速率，所有实例共用同一个令牌桶；在处理时限内取不到时返回False"""
+        if self.account_rate <= 0:
+            return True
+        try:
+            return await self.shared_state.acquire(
+                f"rate:{account.name}", self.account_rate, self.account_burst,
+                timeout=context.current().remaining()
+            )
+        except Exception as e:
+            logger.warning(f"[Yuewen] 账号限流状态不可用，跳过限流: {e}")
+            return True
+
+    # ======== 自适应路由 ========
+    def _preferred_route(self):
+        """当前会话手动设置的 (API版本, 模型ID, 是否联网)，新版API没有模型选择"""
+        model_id = self.current_model_id if self.api_version == 'old' else None
+        return (self.api_version, model_id, bool(self.network_mode))
+
+    def _request_route(self):
+        """本次请求实际使用的路由"""
+        return context.current().route or self._preferred_route()
+
+    def _route_candidates(self, preferred):
+        """可以改派到的路由：只会关闭联网，不会开启
+
+        旧版API的联网是账号级设置（EnableSearch），改派会影响同账号的其他会话，
+        因此旧版API只在模型之间改派（模型ID随每条消息发送）。
+        """
+        api_version, _, network = preferred
+        if api_version == 'new':
+            return [preferred, (api_version, None, False)]
+        return [
+            (api_version, model['id'], network)
+            for model in self.models.values()
+            if model.get('can_network', True) or not network
+        ]
+
+    def _choose_route(self, content):
+        preferred = self._preferred_route()
+        load = sum(1 for task in self.generations.values() if not task.done())
+        route, reason = self.adaptive_routing.choose(
+            preferred, self._route_candidates(preferred), normalize_prompt(content), load
+        )
+        if reason:
+            logger.info(f"[Yuewen] 自适应路由: {self._describe_route(preferred)} -> {self._describe_route(route)} ({reason})")
+        return route
+
+    def _describe_route(self, route):
+        _, model_id, network = route
+        return f"{self._model_name(model_id)}/{'联网' if network else '未联网'}"
+
+    def _model_name(self, model_id):
+        if model_id is None:
+            return "DeepSeek R1"
+        model = next((m for m in self.models.values() if m['id'] == model_id), None)
+        return model['name'] if model else f"未知模型(ID: {model_id})"
+
+    def _route_label(self):
+        """回复头部的路由说明：模型名称、联网模式，以及是否为自动选择"""
+        route = self._request_route()
+        auto = "(自动选择)" if route != self._preferred_route() else ""
+        return self._model_name(route[1]) + auto, "联网" if route[2] else "未联网"
+
+    @staticmethod
+    def _is_successful_response(response):
+        """正常回答都以模型说明开头（"使用xx模型..."），或者图片已直接发送"""
+        if context.current().image_sent:
+            return True
+        return isinstance(response, str) and response.startswith("使用")
+
+    # ======== 对冲请求 ========
+    def _hedge_delay(self):
+        """本次请求的对冲等待时间，不需要对冲时返回 None
+
+        只用于私聊：主后端的历史首字耗时（TTFB）样本足够时，取配置的分位数。
+        """
+        hedging = self.config.get('hedging') or {}
+        if not hedging.get('enabled', False):
+            return None
+        reply_to = context.current().reply_to
+        if not reply_to or reply_to.endswith("@chatroom"):
+            return None
+        delay = self.latency.percentile(
+            ('ttfb', self.api_version),
+            float(hedging.get('percentile', 0.9)),
+            min_samples=int(hedging.get('min_samples', 5))
+        )
+        if delay is None:
+            return None
+        return max(delay, float(hedging.get('min_delay', 1.0)))
+
+    async def _hedge_leg(self, api_version, content, ctx, lost):
+        """对冲请求的一路：在独立的请求上下文中向指定后端发送
+
+        另一个后端使用会话状态的副本，避免与主后端同时修改同一会话；
+        胜出后再把它的上游会话写回。
+
+        Args:
+            lost: 这一路落败、即将被取消时触发的 asyncio.Event
+
+        Returns:
+            tuple: (结果, 会话状态)
+        """
+        context.use(ctx)
+        if api_version != self.api_version:
+            ctx.route = None
+            _active_conversation.set(dict(self.conversation, api_version=api_version))
+        started = time.monotonic()
+        try:
+            result = await self._send_to_backend_async(content)
+        except asyncio.CancelledError:
+            if lost.is_set():
+                # 落败的一路实际耗时至少是已经过去的时间；不记录的话慢的样本永远进不了统计，
+                # 分位数和对冲等待时间会持续偏小
+                elapsed = time.monotonic() - started
+                self.latency.record(self._request_route(), elapsed)
+                first_text_at = ctx.first_text_at
+                self.latency.record(
+                    ('ttfb', self.api_version), first_text_at - started if first_text_at is not None else elapsed
+                )
+            raise
+        return result, self.conversation
+
+    @staticmethod
+    async def _first_content(legs, timeout=None):
+        """等待任一路收到首个文本或结束，返回该路的任务；超时返回 None"""
+        watchers = [asyncio.create_task(ctx.first_text.wait()) for _, ctx, _ in legs.values()]
+        try:
+            await asyncio.wait([*watchers, *legs], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+        for task, (_, ctx, _) in legs.items():
+            if ctx.first_text.is_set():
+                return task
+        return next((task for task in legs if task.done()), None)
+
+    async def _send_hedged_async(self, content, delay):
+        """对冲请求：主后端在 delay 秒内没有输出文本时，向另一个后端发送同样的问题
+
+        先输出文本的一路胜出并继续完成，另一路被取消；流式输出只转发胜出的一路。
+        """
+        conversation = self.conversation
+        primary = conversation['api_version']
+        alternate = 'old' if primary == 'new' else 'new'
+        legs = {}  # 任务 -> (API版本, 该路的请求上下文, 落败事件)
+
+        def start(api_version):
+            leg_ctx = context.fork(asyncio.Event())
+            lost = asyncio.Event()
+            task = asyncio.create_task(self._hedge_leg(api_version, content, leg_ctx, lost))
+            legs[task] = (api_version, leg_ctx, lost)
+
+        start(primary)
+        timeout = delay
+        try:
+            while True:
+                winner = await self._first_content(legs, timeout)
+                if winner is None:
+                    logger.info(f"[Yuewen] {primary}版API {delay:.1f}秒内没有输出，对冲请求{alternate}版API")
+                    start(alternate)
+                    timeout = None
+                    continue
+                if legs[winner][1].first_text.is_set() or len(legs) == 1:
+                    break
+                # 这一路没有输出文本就结束了（失败），等待另一路
+                del legs[winner]
+            for task, (_, _, lost) in legs.items():
+                if task is not winner:
+                    lost.set()
+                    task.cancel()
+            leg_ctx = legs[winner][1]
+            leg_ctx.release_text()
+            result, leg_conversation = await winner
+        finally:
+            for task in legs:
+                task.cancel()
+
+        ctx = context.current()
+        ctx.image_sent = leg_ctx.image_sent
+        ctx.image_error = leg_ctx.image_error
+        if legs[winner][0] != primary:
+            logger.info(f"[Yuewen] 对冲请求由{alternate}版API胜出")
+            self._adopt_hedge_conversation(conversation, leg_conversation)
+        return result
+
+    @staticmethod
+    def _adopt_hedge_conversation(conversation, leg_conversation):
+        """另一个后端胜出时，把它的上游会话写回会话状态
+
+        会话仍绑定主后端：下一条消息照常发往主后端的上游会话，那里没有这次胜出的回答，
+        对话上下文在这一轮断开。写回的另一后端会话只在之后再次对冲到该后端时继续使用。
+        """
+        if leg_conversation['api_version'] == 'new':
+            conversation['chat_session_id'] = leg_conversation['chat_session_id']
+        else:
+            conversation['chat_id'] = leg_conversation['chat_id']
+            conversation['last_message'] = leg_conversation['last_message']
+        conversation['reasoning'] = leg_conversation['reasoning']
+        if leg_conversation['account'] != conversation['account']:
+            # 上游会话只在创建它的账号下有效，主后端在原账号下的会话作废
+            conversation['account'] = leg_conversation['account']
+            if leg_conversation['api_version'] == 'new':
+                conversation['chat_id'] = None
             else:
-                response = await self._send_message_old_async(content)
+                conversation['chat_session_id'] = None
 
-            return response
-        except Exception as e:
-            logger.error(f"[Yuewen] 发送消息失败: {e}", exc_info=True)
-            return f"发送消息失败: {str(e)}"
+    async def _send_to_backend_async(self, content, attachments=None):
+        """按当前API版本发送消息并解析响应
+
+        账号被限流时降级该账号，并在会话迁移到其他账号后重试一次。
+        附件只在上传时的账号下有效，因此带附件的消息不会换号重试。
+        """
+        for attempt in range(2):
+            account = self._bind_account()
+            account.in_flight += 1
+            try:
+                started = time.monotonic()
+                context.current().first_text_at = None
+                if self.api_version == 'new':
+                    result = await self._send_message_new_async(content, attachments)
+                else:
+                    result = await self._send_message_old_async(content, attachments)
+                # 带图片的消息耗时主要取决于图片处理，不计入统计
+                if not attachments:
+                    self.latency.record(
+                        self._request_route(), time.monotonic() - started, self._is_successful_response(result)
+                    )
+                    first_text_at = context.current().first_text_at
+                    if first_text_at is not None:
+                        self.latency.record(('ttfb', self.api_version), first_text_at - started)
+            except AccountThrottledError as e:
+                if attempt == 0 and not attachments and self._bind_account() is not account:
+                    logger.warning(f"[Yuewen] 账号 {account.name} 被限流，切换到账号 {self.current_account.name} 重试")
+                    continue
+                return e.message
+            finally:
+                account.in_flight -= 1
+
+            account.record_success()
+            return result
 
     async def _send_message_old_async(self, content, attachments=None):
         """发送消息到AI (旧版API)（异步版本）"""
         if not self.current_chat_id:
             logger.warning("[Yuewen] 未找到有效会话ID，尝试创建新会话...")
-            if not await self._create_chat_old_async():
+            if not await self._create_upstream_session_async():
                 logger.error("[Yuewen] 无法创建会话，无法发送消息")
                 return None
 
+        _, model_id, network_mode = self._request_route()
         try:
-            # 设置URL
-            url = f"{self.current_base_url}/api/proto.chat.v1.ChatMessageService/SendMessageStream"
-
-            # 构建请求包
-            packet = self._construct_protocol_packet(content, attachments)
-
-            # 获取包含Cookie的headers
-            headers = self._update_headers()
-            headers.update({
-                'content-type': 'application/connect+json',
-                'connect-protocol-version': '1'
-            })
-
-            # 使用httpx异步客户端发送请求
-            import httpx
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    url,
-                    headers=headers,
-                    content=packet
-                )
-
-                if response.status_code != 200:
+            async with self.backends['old'].stream_message(
+                self.current_chat_id, content, attachments,
+                model_id=model_id, network_mode=network_mode
+            ) as response:
+                if response.status != 200:
                     # 处理错误响应
-                    error_text = response.text
-                    error_result = f"请求失败: HTTP {response.status_code} - {error_text[:200]}"
-                    return error_result
-
-                # 解析响应并返回文本
-                start_time = time.time()
-
-                # 检查响应中是否包含用户消息ID
-                try:
-                    # 尝试从响应中提取用户消息ID
-                    response_content = response.content
-                    if response_content:
-                        # 尝试解析响应内容以获取消息ID
-                        chunk_str = response_content.decode('utf-8', errors='ignore')
-
-                        # 使用正则表达式查找messageId
-                        user_msg_match = re.search(r'"parentMessageId":"([^"]+)"', chunk_str)
-                        if user_msg_match:
-                            self.last_user_message_id = user_msg_match.group(1)
-                            logger.debug(f"[Yuewen] 提取到用户消息ID: {self.last_user_message_id}")
-                except Exception as e:
-                    logger.error(f"[Yuewen] 提取用户消息ID时出错: {e}")
+                    error_text = await response.text()
+                    if response.status == 429:
+                        return await self._handle_error_async(response, error_text)
+                    return f"请求失败: HTTP {response.status} - {error_text[:200]}"
 
                 # 使用旧版API专用的响应解析方法处理流式响应
-                return self._parse_stream_response(response, start_time)
+                return await self._parse_stream_response(response, time.time())
 
+        except AccountThrottledError:
+            raise
         except Exception as e:
             logger.error(f"[Yuewen] 发送消息请求异常: {e}", exc_info=True)
             return f"发送消息请求异常: {str(e)}"
@@ -1410,321 +1242,41 @@ class YuewenPlugin(PluginBase):
     async def _send_message_new_async(self, content, attachments=None):
         """发送消息到AI (新版API)（异步版本）"""
         # 重置图片直接发送标记
-        self.image_directly_sent = False
+        context.current().image_sent = False
 
         if not self.current_chat_session_id:
             logger.warning("[Yuewen] 未找到有效会话ID，尝试创建新会话...")
-            if not await self._create_chat_session_new_async():
+            if not await self._create_upstream_session_async():
                 logger.error("[Yuewen] 无法创建会话，无法发送消息")
                 return None
 
         # 使用预防性令牌验证
         await self._ensure_token_valid_async()
 
-        # 使用原始项目中确认有效的API端点
-        url = f"{self.current_base_url}/api/agent/capy.agent.v1.AgentService/ChatStream"
-        logger.debug(f"[Yuewen] 使用新版API发送消息: {url}")
-
-        # 获取包含Cookie的headers
-        headers = self._update_headers()
-
-        # 确保headers完全匹配curl命令格式，精确对应curl
-        headers.update({
-            'accept': '*/*',
-            'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
-            'content-type': 'application/connect+json',
-            'canary': 'false',
-            'connect-protocol-version': '1',
-            'priority': 'u=1, i',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'x-waf-client-type': 'fetch_sdk'
-        })
-
-        # 如果有attachments，添加对应的引用记录
-        has_attachments = attachments and len(attachments) > 0
-        if has_attachments:
+        if attachments:
             logger.debug(f"[Yuewen] 消息包含 {len(attachments)} 个图片附件")
 
-        # 构建请求数据
-        data = self._construct_protocol_packet_new(content, attachments)
-        if not data:
-            logger.error("[Yuewen] 构造请求数据失败")
-            return None
-
-        logger.debug(f"[Yuewen] 新版API请求包构造成功，长度: {len(data)}")
-
         try:
-            # 发送异步请求获取响应
-            async with self.http_session.post(
-                url,
-                headers=headers,
-                data=data,  # 使用data参数传递二进制数据，而不是json
-                timeout=120
+            async with self.backends['new'].stream_message(
+                self.current_chat_session_id, content, attachments,
+                network_mode=self._request_route()[2]
             ) as response:
                 if response.status == 200:
-                    start_time = time.time()
-                    result_text = await self._parse_response_new_async(response, start_time)
-                    return result_text
-                else:
-                    # 处理错误响应
-                    error_text = await response.text()
-                    error_msg = await self._handle_error_async(response, error_text)
-                    logger.error(f"[Yuewen] 发送消息失败: {error_msg}, HTTP状态码: {response.status}")
-                    # 记录详细的错误信息
-                    logger.debug(f"[Yuewen] 请求URL: {url}")
-                    logger.debug(f"[Yuewen] 请求数据长度: {len(data)}")
-                    logger.debug(f"[Yuewen] 响应内容: {error_text}")
-                    return None
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 发送消息异常: {e}", exc_info=True)
-            return None
-
-    def _construct_protocol_packet(self, message, attachments=None):
-        """构造旧版API的协议包"""
-        if not self.current_chat_id:
-            logger.error("[Yuewen] 旧版API构造协议包缺少chatId")
-            return None
-
-        # 按照原始yuewen.py构造payload
-        payload = {
-            "chatId": self.current_chat_id,
-            "messageInfo": {
-                "text": message,
-                "author": {"role": "user"}
-            },
-            "messageMode": "SEND_MESSAGE",
-            "modelId": self.current_model_id  # 旧API使用modelId
-        }
-
-        # 添加附件支持
-        if attachments:
-            payload["messageInfo"]["attachments"] = attachments
+                    return await self._parse_response_new_async(response, time.time())
 
-        try:
-            # 转换为JSON字符串
-            json_str = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-            encoded = json_str.encode('utf-8')
-
-            # 旧版协议: Flag (0x00) + Length (big-endian 4 bytes) + JSON
-            protocol_header = struct.pack('>BI', 0, len(encoded))
-            return protocol_header + encoded
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 构造协议包失败: {e}")
-            return None
-
-    def _construct_protocol_packet_new(self, content, attachments=None):
-        """构造新版API的协议包"""
-        logger.debug(f"[Yuewen] 构造新版API请求包，会话ID: {self.current_chat_session_id}")
-
-        if not self.current_chat_session_id:
-            logger.error("[Yuewen] 无效的会话ID")
-            return None
-
-        # 严格按照curl命令格式构造请求体
-        payload = {
-            "message": {
-                "chatSessionId": self.current_chat_session_id,
-                "content": {
-                    "userMessage": {
-                        "qa": {
-                            "content": content # 发送纯文本内容
-                        }
-                    }
-                }
-            },
-            "config": {
-                # 新版 API 使用模型名称字符串
-                "model": "deepseek-r1",
-                "enableReasoning": True,
-                "enableSearch": self.network_mode
-            }
-        }
-
-        # 如果有附件 (图片)，添加到 payload，严格按照curl格式
-        if attachments:
-            # 确保attachments是一个列表
-            if not isinstance(attachments, list):
-                logger.error(f"[Yuewen] 无效的附件格式: {attachments}")
+                # 处理错误响应
+                error_text = await response.text()
+                error_msg = await self._handle_error_async(response, error_text)
+                logger.error(f"[Yuewen] 发送消息失败: {error_msg}, HTTP状态码: {response.status}")
+                logger.debug(f"[Yuewen] 响应内容: {error_text}")
                 return None
 
-            # 确保 qa 存在
-            if 'qa' not in payload['message']['content']['userMessage']:
-                payload['message']['content']['userMessage']['qa'] = {}
-
-            # 添加到qa.attachments，完全按照curl格式
-            payload['message']['content']['userMessage']['qa']['attachments'] = attachments
-
-            # 如果附件存在但文本内容为空，确保 content 字段存在
-            if not payload['message']['content']['userMessage']['qa'].get('content'):
-                payload['message']['content']['userMessage']['qa']['content'] = ""
-
-            # 记录调试信息
-            logger.debug(f"[Yuewen] 添加了 {len(attachments)} 个附件到请求")
-
-        try:
-            # 为调试记录最终的JSON
-            try:
-                debug_json = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-                if len(debug_json) < 1000:  # 限制日志大小
-                    logger.debug(f"[Yuewen] 最终请求JSON: {debug_json}")
-                else:
-                    logger.debug(f"[Yuewen] 最终请求JSON长度: {len(debug_json)} (太长不记录完整内容)")
-            except:
-                pass
-
-            # Connect 协议: Flag (0x00) + Length (big-endian 4 bytes) + JSON
-            json_str = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-            encoded_json = json_str.encode('utf-8')
-            length = len(encoded_json)
-
-            # 使用与原始代码一致的格式：大端序, flag=0
-            prefix = struct.pack('>BI', 0, length)
-            framed_data = prefix + encoded_json
-
-            logger.debug(f"[Yuewen] 新版API请求包构造成功，长度: {len(framed_data)}")
-            return framed_data
-
+        except AccountThrottledError:
+            raise
         except Exception as e:
-            logger.error(f"[Yuewen] 构造请求包异常: {e}")
+            logger.error(f"[Yuewen] 发送消息异常: {e}", exc_info=True)
             return None
 
-    async def _parse_stream_response_async(self, response, start_time):
-        """解析流式响应并返回结果（异步版本）"""
-        try:
-            # 初始化变量，用于跟踪响应状态
-            message_id = None
-            creation_id = None
-            is_searching = False
-            search_results = []
-            final_text = ""
-            chunk_texts = []
-            received_chunk_count = 0
-            has_finish_chunk = False
-
-            # 使用正则表达式模式匹配消息ID
-            msg_id_pattern = re.compile(r'"messageId":"([^"]+)"')
-
-            # 记录当前处理的message开始时间
-            process_start_time = time.time()
-
-            async for line in response.content:
-                line = line.decode('utf-8').strip()
-
-                if not line:
-                    continue
-
-                # 移除行首的length前缀
-                if line[0].isdigit():
-                    prefix_end = line.find('{')
-                    if prefix_end != -1:
-                        line = line[prefix_end:]
-                    else:
-                        # 如果没有找到JSON开始标记，跳过这一行
-                        continue
-
-                try:
-                    data = json.loads(line) if line and line[0] == '{' else {}
-
-                    # 提取消息ID
-                    if not message_id and line.find('messageId') != -1:
-                        match = msg_id_pattern.search(line)
-                        if match:
-                            message_id = match.group(1)
-                            # 保存bot回复的消息ID，用于后续分享功能
-                            self.last_bot_message_id = message_id
-                            logger.debug(f"[Yuewen] 提取到bot消息ID: {message_id}")
-
-                    # 处理搜索信息
-                    if 'search' in data:
-                        search_data = data.get('search', {})
-                        if search_data.get('searching') is True:
-                            is_searching = True
-                        elif 'results' in search_data:
-                            search_results.extend(search_data.get('results', []))
-
-                    # 处理创建ID (用于图片生成)
-                    if 'creationId' in data:
-                        creation_id = data.get('creationId')
-
-                    # 处理文本内容
-                    if 'text' in data:
-                        text_chunk = data.get('text', '')
-                        if text_chunk:
-                            chunk_texts.append(text_chunk)
-                            received_chunk_count += 1
-
-                    # 处理结束标志
-                    if 'done' in data and data['done']:
-                        has_finish_chunk = True
-                        logger.debug("[Yuewen] 收到流式响应结束标志")
-
-                except json.JSONDecodeError:
-                    # 不是有效的JSON，可能是前缀或其他数据
-                    continue
-                except Exception as chunk_e:
-                    logger.error(f"[Yuewen] 处理响应块异常: {chunk_e}")
-                    continue
-
-            # 合并所有文本块
-            final_text = ''.join(chunk_texts)
-
-            # 处理搜索结果
-            search_info = None
-            if is_searching and search_results:
-                search_info = {
-                    'results': search_results
-                }
-
-            # 记录最后一次交互的消息信息，用于分享功能
-            if message_id:
-                # 记录这次交互的信息（用于分享功能）
-                if not hasattr(self, 'last_message'):
-                    self.last_message = {}
-
-                # 更新消息列表 - 确保格式符合分享API要求
-                if not 'messages' in self.last_message:
-                    self.last_message['messages'] = []
-
-                # 清除旧的消息并添加新的消息
-                self.last_message['messages'] = []
-
-                # 添加用户消息（如果有）
-                if hasattr(self, 'last_user_message_id') and self.last_user_message_id:
-                    self.last_message['messages'].append({
-                        "messageId": self.last_user_message_id,
-                        "messageIndex": 1
-                    })
-
-                # 添加Bot消息
-                self.last_message['messages'].append({
-                    "messageId": message_id,
-                    "messageIndex": 2 if self.last_user_message_id else 1
-                })
-
-                # 记录其他必要信息
-                self.last_message['chat_id'] = self.current_chat_id
-                self.last_message['last_time'] = time.time()
-
-            # 计算总处理时间
-            process_time = time.time() - process_start_time
-            logger.debug(f"[Yuewen] 流式响应处理完成，共接收 {received_chunk_count} 个文本块，处理耗时 {process_time:.2f} 秒")
-
-            # 如果没有获取到任何文本，检查是否有错误
-            if not final_text and not creation_id:
-                logger.warning("[Yuewen] 未能从流式响应中获取到文本或创建ID")
-                return None, None, None
-
-            # 返回处理后的结果
-            return final_text, search_info, creation_id
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 解析流式响应异常: {e}", exc_info=True)
-            return None, None, None
-
     async def _parse_response_new_async(self, response, start_time=None):
         """解析新版API的响应（异步版本）"""
         if start_time is None:
@@ -1737,34 +1289,34 @@ class YuewenPlugin(PluginBase):
         logger.debug(f"[Yuewen][New API] 响应Content-Type: {content_type}")
 
         result_text = ""
-        buffer = b""
+        decoder = FrameDecoder()
         has_received_content = False
         has_sent_partial_text = False  # 添加变量初始化，用于跟踪是否已发送部分文本
         message_done = False
         image_analysis_result = None
+        reasoning = frames.ReasoningTrace.new_api() if self.keep_reasoning else None
+        self.conversation['reasoning'] = reasoning
+        ctx = context.current()
+        streamed = 0  # 已交给流式输出的字符数
 
         try:  # Outer try (L2277)
             async for chunk in response.content.iter_any():
                 if not chunk:
                     continue
-                buffer += chunk
-
-                while buffer:
-                    if len(buffer) < 5:
-                        break
-
-                    msg_type = buffer[0]
-                    length = int.from_bytes(buffer[1:5], byteorder='big')
-
-                    if len(buffer) < 5 + length:
-                        break
 
-                    frame_data = buffer[5:5+length]
-                    buffer = buffer[5+length:]
+                for msg_type, frame_data in decoder.feed(chunk):
+                    if frame_data:
+                        # 思考过程和心跳帧按开头字节识别，不做完整解码
+                        event_name = frames.new_event_name(frame_data)
+                        if event_name == frames.REASONING_EVENT:
+                            if reasoning is not None:
+                                reasoning.add(frame_data)
+                            continue
+                        if event_name == frames.HEARTBEAT_EVENT:
+                            continue
 
-                    if length > 0:
                         try:  # Inner try
-                            frame_json = json.loads(frame_data.decode('utf-8'))
+                            frame_json = codec.loads(frame_data)
                             if 'data' in frame_json:
                                 event_data = frame_json.get('data', {}).get('event', {})
                                 event_type = list(event_data.keys())[0] if event_data else "empty"
@@ -1776,7 +1328,7 @@ class YuewenPlugin(PluginBase):
                                         has_received_content = True
                                         # 仅在调试级别输出，减少日志量
                                         if text and len(text) > 20:
-                                            logger.debug(f"[Yuewen][New API] 收到文本: {text[:20]}...")
+                                            _stream_log.sampled('text', "[Yuewen][New API] 收到文本: {}...", lambda: text[:20])
                                 elif 'reasoningEvent' in event_data:
                                     # 不显示思考过程，跳过reasoningEvent
                                     continue
@@ -1862,20 +1414,20 @@ class YuewenPlugin(PluginBase):
                                                                 # 直接从result_text中移除处理提示和额外文本，这里不再添加URL到文本中
                                                                 result_text = result_text.replace("[正在生成图片，请稍候...]", "")
 
-                                                                # 获取当前正在处理的消息对象，以便直接发送图片
-                                                                from_wxid = self.current_message.get("FromWxid") if hasattr(self, 'current_message') and self.current_message else None
+                                                                # 当前正在处理的消息的回复对象，以便直接发送图片
+                                                                ctx = context.current()
 
-                                                                if from_wxid:
+                                                                if ctx.can_reply:
                                                                     # 使用改进后的send_image_from_url方法发送图片
                                                                     try:
-                                                                        send_success = await self.send_image_from_url(self.current_bot, from_wxid, image_url)
+                                                                        send_success = await self.send_image_from_url(ctx.bot, ctx.reply_to, image_url)
 
                                                                         if send_success:
                                                                             logger.info(f"[Yuewen][New API] 图片已直接发送至用户")
-                                                                            # 设置图片已直接发送标记，避免额外处理
-                                                                            self.image_directly_sent = True
+                                                                            # 设置图片已直接发送标记，调用方据此不再发送文本
+                                                                            ctx.image_sent = True
                                                                             # 图片已经成功发送，直接返回，不做后续处理
-                                                                            return (True, "IMAGE_SENT", "[图片已发送]")
+                                                                            return None
                                                                         else:
                                                                             # 图片发送失败，在文本中添加图片URL
                                                                             logger.warning(f"[Yuewen][New API] 图片发送失败，在文本中添加URL")
@@ -1886,6 +1438,7 @@ class YuewenPlugin(PluginBase):
                                                                         result_text = f"{result_text}\n\n[图片: {image_url}]"
                                                             else:
                                                                 logger.warning(f"[Yuewen][New API] 未能获取图片URL")
+                                                                context.current().image_error = error_message
                                                 # 如果处理了图片生成任务且成功获取URL，则已返回。若失败，则继续。
 
                                             # 处理正常的QA文本内容 (如果不是图片生成或图片生成失败)
@@ -1896,11 +1449,17 @@ class YuewenPlugin(PluginBase):
                                                     has_received_content = True
                                                     # 降级为trace级别或注释掉
                                                     # logger.debug(f"[Yuewen][New API] 收到QA内容: {qa_content[:50]}...")
-                        except json.JSONDecodeError:
+                        except codec.DecodeError:
                             logger.warning(f"[Yuewen][New API] 无法解析JSON: {frame_data.decode('utf-8', errors='ignore')[:100]}...")
                         except Exception as parse_err:
                             logger.error(f"[Yuewen][New API] 解析帧数据异常: {parse_err}")
 
+                if has_received_content:
+                    ctx.mark_first_text()
+                    if ctx.on_text is not None and len(result_text) > streamed:
+                        ctx.stream_text(result_text[streamed:])
+                        streamed = len(result_text)
+
             # This block is after the loop, but still inside the OUTER TRY (L2277)
             elapsed = time.time() - start_time
 
@@ -1912,14 +1471,13 @@ class YuewenPlugin(PluginBase):
                     logger.error(f"[Yuewen][New API] 构造图像分析文本失败: {img_err}")
 
             # 如果已直接发送图片，不需要再返回文本消息
-            if self.image_directly_sent:
+            if context.current().image_sent:
                 logger.info("[Yuewen][New API] 图片已直接发送，不再返回文本消息")
                 return None
 
             if result_text or has_received_content:
                 final_text = self._process_final_text(result_text)
-                current_model = "DeepSeek R1"
-                network_mode_str = "联网" if self.network_mode else "未联网"  # Renamed network_mode to network_mode_str
+                current_model, network_mode_str = self._route_label()
                 model_info = f"使用{current_model}模型{network_mode_str}模式回答（耗时{elapsed:.2f}秒）："
 
                 # 检查是否有图片生成失败的消息
@@ -1927,10 +1485,11 @@ class YuewenPlugin(PluginBase):
                     # 图片生成失败的情况下，提取错误信息并移除它
                     failure_msg = ""
                     # 优先使用保存的具体错误消息
-                    if hasattr(self, 'last_image_error') and self.last_image_error:
-                        failure_msg = self.last_image_error
+                    ctx = context.current()
+                    if ctx.image_error:
+                        failure_msg = ctx.image_error
                         # 使用后清空，避免影响后续请求
-                        self.last_image_error = None
+                        ctx.image_error = None
                     # 如果没有保存的错误消息，尝试从文本中提取
                     elif "处理完所有响应帧，但未找到图片URL" in result_text:
                         failure_msg = "处理完所有响应帧，但未找到图片URL"
@@ -2033,7 +1592,13 @@ class YuewenPlugin(PluginBase):
             elif status_code == 500:
                 return f"服务器错误 (500): 服务器内部错误，请稍后重试。"
             elif status_code == 429:
-                return f"请求过于频繁 (429): 超出服务器频率限制，请稍后重试。"
+                # 降级当前账号，由调用方迁移会话到其他账号后重试
+                account = self.current_account
+                cooldown = self.login_handler.demote_account(account, response.headers.get('Retry-After'))
+                await self.login_handler.publish_throttle(account)
+                raise AccountThrottledError(
+                    account, cooldown, f"请求过于频繁 (429): 超出服务器频率限制，请稍后重试。"
+                )
 
             # 增加API错误计数
             self.api_errors_count += 1
@@ -2049,6 +1614,8 @@ class YuewenPlugin(PluginBase):
 
             return error_message
 
+        except AccountThrottledError:
+            raise
         except Exception as e:
             logger.error(f"[Yuewen] 处理错误响应时发生异常: {e}")
             return f"处理错误时发生异常: {str(e)}"
@@ -2142,11 +1709,11 @@ class YuewenPlugin(PluginBase):
 
             # 无论是否有webid都重新注册设备，确保流程完整
             logger.info("[Yuewen] 正在注册设备...")
-            await bot.send_text_message(reply_to_wxid, "⏳ 正在注册设备，请稍候...")
+            self._reply(bot, reply_to_wxid, "⏳ 正在注册设备，请稍候...")
 
             # 异步调用登录处理器的注册设备方法
             if not await self.login_handler.register_device():
-                await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败，请稍后重试")
+                self._reply(bot, reply_to_wxid, "❌ 设备注册失败，请稍后重试")
                 return False
 
             # 从登录处理器获取webid
@@ -2154,14 +1721,15 @@ class YuewenPlugin(PluginBase):
 
             # 成功注册设备后，检查是否有webid
             if not self.oasis_webid:
-                await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败: 未获取到webid")
+                self._reply(bot, reply_to_wxid, "❌ 设备注册失败: 未获取到webid")
                 return False
 
             logger.info(f"[Yuewen] 设备注册成功，webid={self.oasis_webid}")
-            await bot.send_text_message(reply_to_wxid, "✅ 设备注册成功，正在初始化登录...")
+            self._reply(bot, reply_to_wxid, "✅ 设备注册成功，正在初始化登录...")
 
             # 提示用户输入手机号
-            await bot.send_text_message(
+            self._reply(
+                bot,
                 reply_to_wxid,
                 "📱 请输入您的11位手机号码\n注意：此手机号将用于接收跃问的验证码"
             )
@@ -2176,7 +1744,7 @@ class YuewenPlugin(PluginBase):
             return True
         except Exception as e:
             logger.error(f"[Yuewen] 初始化登录流程失败: {e}", exc_info=True)
-            await bot.send_text_message(reply_to_wxid, f"❌ 初始化登录失败: {str(e)}")
+            self._reply(bot, reply_to_wxid, f"❌ 初始化登录失败: {str(e)}")
             return False
 
     async def _send_verification_code_async(self, bot, reply_to_wxid, user_id, phone_number):
@@ -2184,10 +1752,10 @@ class YuewenPlugin(PluginBase):
         try:
             # 检查手机号格式
             if not phone_number.isdigit() or len(phone_number) != 11:
-                await bot.send_text_message(reply_to_wxid, "❌ 请输入有效的11位手机号码")
+                self._reply(bot, reply_to_wxid, "❌ 请输入有效的11位手机号码")
                 return False
 
-            await bot.send_text_message(reply_to_wxid, f"⏳ 正在发送验证码，请稍候...")
+            self._reply(bot, reply_to_wxid, f"⏳ 正在发送验证码，请稍候...")
 
             # 确保有webid - 使用login_handler中的
             if not self.oasis_webid:
@@ -2198,7 +1766,7 @@ class YuewenPlugin(PluginBase):
                 if not self.oasis_webid:
                     logger.info("[Yuewen] 发送验证码前重新注册设备")
                     if not await self.login_handler.register_device():
-                        await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败，无法发送验证码")
+                        self._reply(bot, reply_to_wxid, "❌ 设备注册失败，无法发送验证码")
                         return False
 
                     # 更新webid
@@ -2206,7 +1774,7 @@ class YuewenPlugin(PluginBase):
 
                     # 检查注册后是否有webid
                     if not self.oasis_webid:
-                        await bot.send_text_message(reply_to_wxid, "❌ 设备注册失败: 未获取到webid")
+                        self._reply(bot, reply_to_wxid, "❌ 设备注册失败: 未获取到webid")
                         return False
 
                     logger.info(f"[Yuewen] 设备注册成功，webid={self.oasis_webid}")
@@ -2222,7 +1790,8 @@ class YuewenPlugin(PluginBase):
                 if user_id in self.login_users:
                     self.login_users.remove(user_id)
 
-                await bot.send_text_message(
+                self._reply(
+                    bot,
                     reply_to_wxid,
                     "✅ 验证码已发送，请输入收到的4位验证码完成登录"
                 )
@@ -2232,7 +1801,8 @@ class YuewenPlugin(PluginBase):
                 if user_id in self.waiting_for_verification:
                     self.waiting_for_verification.pop(user_id, None)
 
-                await bot.send_text_message(
+                self._reply(
+                    bot,
                     reply_to_wxid,
                     f"❌ 验证码发送失败，请检查手机号是否正确或稍后重试"
                 )
@@ -2244,7 +1814,7 @@ class YuewenPlugin(PluginBase):
             if user_id in self.waiting_for_verification:
                 self.waiting_for_verification.pop(user_id, None)
 
-            await bot.send_text_message(reply_to_wxid, f"❌ 处理失败: {str(e)}")
+            self._reply(bot, reply_to_wxid, f"❌ 处理失败: {str(e)}")
             return False
 
     async def _verify_login_async(self, bot, reply_to_wxid, user_id, verify_code):
@@ -2253,11 +1823,11 @@ class YuewenPlugin(PluginBase):
             # 获取之前保存的手机号
             phone_number = self.waiting_for_verification.get(user_id)
             if not phone_number:
-                await bot.send_text_message(reply_to_wxid, "❌ 验证失败：请先发送手机号获取验证码")
+                self._reply(bot, reply_to_wxid, "❌ 验证失败：请先发送手机号获取验证码")
                 return False
 
             # 向用户发送正在验证的消息
-            await bot.send_text_message(reply_to_wxid, "⏳ 正在验证登录，请稍候...")
+            self._reply(bot, reply_to_wxid, "⏳ 正在验证登录，请稍候...")
 
             # 使用登录处理器的异步方法进行登录验证
             if await self.login_handler.sign_in(mobile_num=phone_number, auth_code=verify_code):
@@ -2276,20 +1846,23 @@ class YuewenPlugin(PluginBase):
                     'oasis_token': self.oasis_token
                 })
 
+                # 新的登录凭证下服务器设置需要重新同步
+                self.settings_sync.invalidate()
+
                 # 创建新会话
-                await bot.send_text_message(reply_to_wxid, "✅ 登录成功，正在创建会话...")
+                self._reply(bot, reply_to_wxid, "✅ 登录成功，正在创建会话...")
 
                 # 创建新会话
                 if await self.create_chat_async():
-                    await bot.send_text_message(reply_to_wxid, "✅ 会话创建成功，可以开始对话了")
+                    self._reply(bot, reply_to_wxid, "✅ 会话创建成功，可以开始对话了")
                 else:
-                    await bot.send_text_message(reply_to_wxid, "⚠️ 登录成功，但会话创建失败，请发送'yw新建会话'尝试创建会话")
+                    self._reply(bot, reply_to_wxid, "⚠️ 登录成功，但会话创建失败，请发送'yw新建会话'尝试创建会话")
 
                 logger.info("[Yuewen] 用户登录成功并创建会话")
                 return True
             else:
                 # 验证失败
-                await bot.send_text_message(reply_to_wxid, "❌ 验证码错误或已过期，请重新发送'yw登录'进行登录")
+                self._reply(bot, reply_to_wxid, "❌ 验证码错误或已过期，请重新发送'yw登录'进行登录")
                 # 清除等待状态
                 self.waiting_for_verification.pop(user_id, None)
                 return False
@@ -2298,211 +1871,379 @@ class YuewenPlugin(PluginBase):
             logger.error(f"[Yuewen] 验证登录异常: {e}", exc_info=True)
             # 清除等待状态
             self.waiting_for_verification.pop(user_id, None)
-            await bot.send_text_message(reply_to_wxid, f"❌ 验证登录出错: {str(e)}")
+            self._reply(bot, reply_to_wxid, f"❌ 验证登录出错: {str(e)}")
             return False
 
-    async def _handle_commands_async(self, content):
-        """处理内置命令（异步版本）"""
-        if not content:
-            return None
-
-        # 打印模型命令
-        if content == "打印模型":
-            # 构建模型列表 - 无论API版本都显示可用模型
-            output = ["可用模型："]
-            for num, info in self.models.items():
-                status = "（支持联网）" if info.get('can_network', True) else ""
-                current = " ← 当前使用" if info['id'] == self.current_model_id else ""
-                output.append(f"{num}. {info['name']}{status}{current}")
-            return '\n'.join(output)
-
-        # 模型切换命令
-        if content.startswith("切换模型") or content.startswith("模型") or content.startswith("model"):
-            # 如果是新版API，提示用户不支持
-            if self.api_version == 'new':
-                return "⚠️ 切换模型功能仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
-
-            model_num = None
-            # 尝试提取模型编号
-            try:
-                # 支持 "切换模型1", "切换模型 1", "模型1", "模型 1", "model1", "model 1" 等格式
-                cmd_parts = content.replace("切换模型", "").replace("模型", "").replace("model", "").strip()
-                if cmd_parts.isdigit():
-                    model_num = int(cmd_parts)
-            except:
-                pass
-
-            # 如果没有指定模型或模型无效，显示可用模型列表
-            if not model_num or model_num not in self.models:
-                models_info = "\n".join([f"{idx}. {model['name']}" for idx, model in self.models.items()])
-                return f"可用模型列表：\n{models_info}\n\n使用方法：yw切换模型[编号] 进行切换"
-
-            # 切换模型
-            selected_model = self.models.get(model_num, {})
-            self.current_model_id = selected_model["id"]
-            self.update_config({"current_model_id": self.current_model_id})
-
-            # 如果是deepseek r1模型(id=6)，强制开启联网模式
-            if selected_model.get('id') == 6:  # deepseek r1模型ID
-                self.network_mode = True
-                self.update_config({"network_mode": True})
-                # 同步启用深度思考模式
-                await self._enable_deep_thinking_async()
-
-            # 如果该模型不支持联网但是当前开启了联网，关闭联网
-            elif not selected_model.get("can_network", True) and self.network_mode:
-                self.network_mode = False
-                self.update_config({"network_mode": False})
-
-            # 创建新会话
-            self.current_chat_id = None
-            self.current_chat_session_id = None
-            if not await self.create_chat_async():
-                return f"⚠️ 已切换到 [{selected_model.get('name', '未知模型')}]，但新会话创建失败，请手动发送'yw新建会话'"
-
-            # 同步服务器状态
-            await self._sync_server_state_async()
+    # ======== 命令 ========
+    def _create_command_router(self):
+        """构建命令路由（别名前缀树），识图触发词来自配置"""
+        router = CommandRouter().collect(self)
+        router.register(
+            (self.pic_trigger_prefix,), self._cmd_recognize_image,
+            prefix=True, parser=_PIC_ARGS_PARSER, name='_cmd_recognize_image'
+        )
+        return router
+
+    @command("登录", "登陆", "login", requires_login=False)
+    async def _cmd_login(self, call):
+        await self._initiate_login_async(call.bot, call.from_wxid, call.user_id)
+
+    @command("打印模型")
+    async def _cmd_print_models(self, call):
+        # 构建模型列表 - 无论API版本都显示可用模型
+        output = ["可用模型："]
+        for num, info in self.models.items():
+            status = "（支持联网）" if info.get('can_network', True) else ""
+            current = " ← 当前使用" if info['id'] == self.current_model_id else ""
+            output.append(f"{num}. {info['name']}{status}{current}")
+        return '\n'.join(output)
+
+    # 支持 "切换模型1", "切换模型 1", "模型1", "模型 1", "model1", "model 1" 等格式
+    @command("切换模型", "模型", "model", prefix=True, parser=r'\s*(\d+)?\s*|.*')
+    async def _cmd_switch_model(self, call):
+        # 如果是新版API，提示用户不支持
+        if self.api_version == 'new':
+            return "⚠️ 切换模型功能仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
 
-            # 根据模型联网支持情况返回不同消息
-            if not selected_model.get("can_network", True) and self.network_mode:
-                return f"✅ 已切换到 [{selected_model.get('name', '未知模型')}]，该模型不支持联网，已自动关闭联网功能"
-            else:
-                return f"✅ 已切换至 [{selected_model.get('name', '未知模型')}]"
-
-        # 联网模式命令
-        elif content in ["联网", "开启联网", "打开联网"]:
-            # 检查当前模型是否支持联网
-            current_model_info = None
-            for model_num, model_info in self.models.items():
-                if model_info.get("id") == self.current_model_id:
-                    current_model_info = model_info
-                    break
+        model_num = int(call.args.group(1)) if call.args.group(1) else None
 
-            if current_model_info and not current_model_info.get("can_network", True):
-                return f"❌ 当前模型 [{current_model_info.get('name', '未知模型')}] 不支持联网，请先切换到支持联网的模型"
+        # 如果没有指定模型或模型无效，显示可用模型列表
+        if not model_num or model_num not in self.models:
+            models_info = "\n".join([f"{idx}. {model['name']}" for idx, model in self.models.items()])
+            return f"可用模型列表：\n{models_info}\n\n使用方法：yw切换模型[编号] 进行切换"
 
-            # 如果已经是联网模式，提示用户
-            if self.network_mode:
-                return "ℹ️ 联网模式已经开启"
+        # 切换模型
+        selected_model = self.models.get(model_num, {})
+        self.current_model_id = selected_model["id"]
+        self.update_config({"current_model_id": self.current_model_id})
 
-            # 开启联网模式
+        # 如果是deepseek r1模型(id=6)，强制开启联网模式
+        if selected_model.get('id') == 6:  # deepseek r1模型ID
             self.network_mode = True
             self.update_config({"network_mode": True})
+            # 同步启用深度思考模式
+            await self._enable_deep_thinking_async()
 
-            # 尝试同步服务器状态
-            try:
-                await self._sync_server_state_async()
-            except Exception as e:
-                logger.error(f"[Yuewen] 同步网络状态失败: {e}")
+        # 如果该模型不支持联网但是当前开启了联网，关闭联网
+        elif not selected_model.get("can_network", True) and self.network_mode:
+            self.network_mode = False
+            self.update_config({"network_mode": False})
+
+        # 创建新会话（同时同步服务器状态）
+        self.current_chat_id = None
+        self.current_chat_session_id = None
+        if not await self.create_chat_async():
+            return f"⚠️ 已切换到 [{selected_model.get('name', '未知模型')}]，但新会话创建失败，请手动发送'yw新建会话'"
 
-            return "✅ 已开启联网模式"
+        # 根据模型联网支持情况返回不同消息
+        if not selected_model.get("can_network", True) and self.network_mode:
+            return f"✅ 已切换到 [{selected_model.get('name', '未知模型')}]，该模型不支持联网，已自动关闭联网功能"
+        else:
+            return f"✅ 已切换至 [{selected_model.get('name', '未知模型')}]"
 
-        # 关闭联网模式命令
-        elif content in ["不联网", "关闭联网", "禁用联网"]:
-            # 如果已经是非联网模式，提示用户
-            if not self.network_mode:
-                return "ℹ️ 联网模式已经关闭"
+    @command("联网", "开启联网", "打开联网")
+    async def _cmd_enable_network(self, call):
+        # 检查当前模型是否支持联网
+        current_model_info = None
+        for model_num, model_info in self.models.items():
+            if model_info.get("id") == self.current_model_id:
+                current_model_info = model_info
+                break
 
-            # 关闭联网模式
-            self.network_mode = False
-            self.update_config({"network_mode": False})
+        if current_model_info and not current_model_info.get("can_network", True):
+            return f"❌ 当前模型 [{current_model_info.get('name', '未知模型')}] 不支持联网，请先切换到支持联网的模型"
 
-            # 尝试同步服务器状态
-            try:
-                await self._sync_server_state_async()
-            except Exception as e:
-                logger.error(f"[Yuewen] 同步网络状态失败: {e}")
+        # 如果已经是联网模式，提示用户
+        if self.network_mode:
+            return "ℹ️ 联网模式已经开启"
+
+        # 开启联网模式
+        self.network_mode = True
+        self.update_config({"network_mode": True})
 
-            return "✅ 已关闭联网模式"
+        # 尝试同步服务器状态
+        try:
+            await self._sync_server_state_async()
+        except Exception as e:
+            logger.error(f"[Yuewen] 同步网络状态失败: {e}")
 
-        # API版本切换命令
-        elif content in ["切换旧版", "使用旧版", "旧版API"]:
-            if self.api_version == 'old':
-                return "ℹ️ 已经是旧版API模式"
+        return "✅ 已开启联网模式"
 
-            # 切换到旧版API
-            self.api_version = 'old'
-            self.current_base_url = self.base_urls['old']
-            self.update_config({"api_version": "old"})
+    @command("不联网", "关闭联网", "禁用联网")
+    async def _cmd_disable_network(self, call):
+        # 如果已经是非联网模式，提示用户
+        if not self.network_mode:
+            return "ℹ️ 联网模式已经关闭"
 
-            # 清除会话
-            self.current_chat_id = None
-            self.current_chat_session_id = None
+        # 关闭联网模式
+        self.network_mode = False
+        self.update_config({"network_mode": False})
 
-            return "✅ 已切换到旧版API模式，将在下一次对话创建新会话"
+        # 尝试同步服务器状态
+        try:
+            await self._sync_server_state_async()
+        except Exception as e:
+            logger.error(f"[Yuewen] 同步网络状态失败: {e}")
 
-        elif content in ["切换新版", "使用新版", "新版API"]:
-            if self.api_version == 'new':
-                return "ℹ️ 已经是新版API模式"
+        return "✅ 已关闭联网模式"
 
-            # 切换到新版API
-            self.api_version = 'new'
-            self.current_base_url = self.base_urls['new']
-            self.update_config({"api_version": "new"})
+    @command("切换旧版", "使用旧版", "旧版API")
+    async def _cmd_use_old_api(self, call):
+        if self.api_version == 'old':
+            return "ℹ️ 已经是旧版API模式"
 
-            # 清除会话
-            self.current_chat_id = None
-            self.current_chat_session_id = None
+        # 仅切换当前会话，其他会话保持各自的后端
+        self._switch_conversation_backend('old')
 
-            return "✅ 已切换到新版API模式，将在下一次对话创建新会话"
+        return "✅ 当前会话已切换到旧版API模式，将在下一次对话创建新会话"
 
-        # 分享命令
-        elif content in ["分享", "share", "生成图片"]:
-            # 检查是否支持分享功能
-            if self.api_version == 'new':
-                return "⚠️ 分享功能仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
+    @command("切换新版", "使用新版", "新版API")
+    async def _cmd_use_new_api(self, call):
+        if self.api_version == 'new':
+            return "ℹ️ 已经是新版API模式"
 
-            # 检查是否有最近的消息记录
-            if not hasattr(self, 'last_message') or not self.last_message:
-                return "⚠️ 没有可分享的消息记录，请先发送一条消息"
+        # 仅切换当前会话，其他会话保持各自的后端
+        self._switch_conversation_backend('new')
 
-            # 检查最近消息是否超时
-            current_time = time.time()
-            if current_time - self.last_message.get('last_time', 0) > 180:  # 3分钟超时
-                return "⚠️ 分享超时，请重新发送消息后再尝试分享"
+        return "✅ 当前会话已切换到新版API模式，将在下一次对话创建新会话"
 
-            return "🔄 正在生成分享图片，请稍候..."
+    @command("深度思考", "enable_deep_thinking", "思考模式")
+    async def _cmd_deep_thinking(self, call):
+        if self.api_version != 'old':
+            return "⚠️ 深度思考模式仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
 
-        # 深度思考模式
-        elif content in ["深度思考", "enable_deep_thinking", "思考模式"]:
-            if self.api_version != 'old':
-                return "⚠️ 深度思考模式仅支持旧版API，请先发送'yw切换旧版'切换到旧版API"
+        # 调用深度思考设置方法
+        if await self._enable_deep_thinking_async():
+            return "✅ 已开启深度思考模式"
+        else:
+            return "❌ 开启深度思考模式失败，请重试"
 
-            # 调用深度思考设置方法
-            if await self._enable_deep_thinking_async():
-                return "✅ 已开启深度思考模式"
-            else:
-                return "❌ 开启深度思考模式失败，请重试"
+    @command("思考过程", "reasoning")
+    async def _cmd_reasoning(self, call):
+        """查看最近一次回答的思考过程（保存时只保留原始帧，这里才解码）"""
+        if not self.keep_reasoning:
+            return "⚠️ 未开启思考过程保留，请在配置中设置 keep_reasoning = true"
 
-        # 帮助命令
-        elif content in ["帮助", "help", "指令", "命令"]:
-            current_api_version = "新版API" if self.api_version == 'new' else "旧版API"
-            help_text = f"""📚 跃问AI助手指令 (当前: {current_api_version})：
+        reasoning = self.conversation['reasoning']
+        text = reasoning.text().strip() if reasoning else ''
+        if not text:
+            return "ℹ️ 最近一次回答没有思考过程"
+        if len(text) > MAX_REASONING_REPLY:
+            text = text[:MAX_REASONING_REPLY] + "\n……（思考过程过长，已截断）"
+        elif reasoning.truncated:
+            text += "\n……（思考过程过长，只保留了开头部分）"
+        return f"💭 最近一次回答的思考过程：\n{text}"
+
+    @command("帮助", "help", "指令", "命令")
+    async def _cmd_help(self, call):
+        current_api_version = "新版API" if self.api_version == 'new' else "旧版API"
+        help_text = f"""📚 跃问AI助手指令 (当前: {current_api_version})：
 
 【通用指令】
 1. yw [问题] - 向AI提问
 2. yw登录 - 重新登录账号
 3. yw联网/不联网 - 开启/关闭联网功能
 4. yw新建会话 - 开始新的对话
-5. yw切换旧版/新版 - 切换API版本
+5. yw切换旧版/新版 - 切换当前会话的API版本
 6. yw识图 [描述] - 发送图片让AI分析
+7. yw停止 - 停止当前进行中的回答
+8. yw思考过程 - 查看最近一次回答的思考过程（需开启 keep_reasoning）
+9. yw分享 - 生成对话分享图片
 
 【仅限旧版API功能】
-7. yw切换模型[编号] - 切换AI模型 (当前：{
+10. yw切换模型[编号] - 切换AI模型 (当前：{
     next((f"{idx}.{model['name']}" for idx, model in self.models.items()
          if model['id'] == self.current_model_id), "未知")})
-8. yw打印模型 - 显示所有可用模型
-9. yw分享 - 生成对话分享图片
-10. yw深度思考 - 启用思考模式
-11. yw识图N [描述] - 分析N张图片
-12. yw多图 [描述] - 分析多张图片
+11. yw打印模型 - 显示所有可用模型
+12. yw深度思考 - 启用思考模式
+13. yw识图N [描述] - 分析N张图片
+14. yw多图 [描述] - 分析多张图片
 
 当前状态：联网{" ✓" if self.network_mode else " ✗"}
 """
-            return help_text
+        return help_text
+
+    def _remember_exchange(self, question, response):
+        """记录本会话最近一次正常完成的问答，用于本地生成分享图片"""
+        if isinstance(response, str) and _REPLY_HEADER_RE.match(response):
+            self.conversation['last_exchange'] = {'question': question, 'answer': response, 'time': time.time()}
+
+    @command("分享", "share", "生成图片")
+    async def _cmd_share(self, call):
+        # 上游分享接口只有旧版API支持，其他情况在本地渲染
+        if self.share_mode == 'upstream' and self.api_version == 'old':
+            return await self._share_upstream(call)
+        return await self._share_local(call)
+
+    async def _share_local(self, call):
+        """把最近一次问答在本地渲染为图片发送，不访问上游"""
+        exchange = self.conversation['last_exchange']
+        if not exchange:
+            return "⚠️ 没有可分享的消息记录，请先发送一条消息"
+
+        # 回复开头的模型说明作为副标题，结尾的提示不放进图片
+        answer = exchange['answer']
+        header = _REPLY_HEADER_RE.match(answer)
+        if header:
+            answer = answer[header.end():]
+        answer = answer.replace(_SHARE_HINT, "").strip()
+        subtitle = header.group(1) if header else ""
+        subtitle = f"{subtitle} · {time.strftime('%Y-%m-%d %H:%M', time.localtime(exchange['time']))}"
 
-        # 未匹配任何命令
-        return None
+        try:
+            image_data = await poster.render_poster(
+                exchange['question'], answer, subtitle=subtitle, font_path=self.poster_font
+            )
+        except poster.PosterError as e:
+            return f"❌ {e}"
+        except Exception as e:
+            logger.error(f"[Yuewen] 渲染分享图片失败: {e}", exc_info=True)
+            return "❌ 生成分享图片失败，请稍后重试"
+
+        try:
+            send_result = await self.outbound.call(
+                call.from_wxid, lambda: call.bot.send_image_message(call.from_wxid, image_data)
+            )
+        except Exception as e:
+            logger.error(f"[Yuewen] 发送分享图片异常: {e}")
+            return f"分享图片发送失败: {str(e)}"
+        if not (send_result and send_result.get("Success", False)):
+            logger.error(f"[Yuewen] 分享图片发送失败，send_image_message返回: {send_result}")
+            return "❌ 分享图片发送失败，请稍后重试"
+        logger.info("[Yuewen] 本地分享图片发送成功")
+
+    async def _share_upstream(self, call):
+        """通过上游分享接口生成图片（仅旧版API）"""
+        # 检查是否有最近的消息记录
+        if not self.last_message:
+            return "⚠️ 没有可分享的消息记录，请先发送一条消息"
+
+        # 检查最近消息是否超时
+        if time.time() - self.last_message.get('last_time', 0) > 180:  # 3分钟超时
+            return "⚠️ 分享超时，请重新发送消息后再尝试分享"
+
+        # 发送等待消息
+        self._reply(call.bot, call.from_wxid, "🔄 正在生成分享图片，请稍候...")
+
+        # 获取分享图片
+        share_url = await self._get_share_image_async(
+            call.bot,
+            self.last_message['chat_id'],
+            self.last_message['messages']
+        )
+        if not share_url:
+            return "❌ 生成分享图片失败，请稍后重试"
+
+        logger.info(f"[Yuewen] 开始下载并发送分享图片: {share_url}")
+        try:
+            if not await self.send_image_from_url(call.bot, call.from_wxid, share_url):
+                # 如果发送失败，提供原始链接
+                logger.error(f"[Yuewen] 分享图片发送失败，提供原始链接")
+                return f"分享图片发送失败，您可以直接访问: {share_url}"
+            logger.info(f"[Yuewen] 分享图片发送成功")
+        except Exception as e:
+            logger.error(f"[Yuewen] 发送分享图片异常: {e}")
+            return f"分享图片发送失败: {str(e)}"
+
+    async def _cmd_recognize_image(self, call):
+        """识图 [描述] / 识图N [描述]（触发词来自配置）"""
+        count, prompt = call.args.group('count', 'prompt')
+        prompt = (prompt or '').strip() or self.imgprompt
+
+        # "识图N"格式，支持多张图片分析
+        if count:
+            img_count = int(count)
+            if img_count < 1 or img_count > self.max_images:
+                return f"⚠️ 图片数量必须在1-{self.max_images}之间"
+
+            # 初始化多图处理数据
+            self.multi_image_data[call.user_id] = {
+                'prompt': prompt,
+                'images': [],
+                'count': img_count
+            }
+            return f"🖼 请依次发送{img_count}张图片，发送完毕后请发送'结束'开始处理"
+
+        # 单图模式，等待下一条信息是图片
+        self.waiting_for_image[call.user_id] = {'prompt': prompt}
+        return "🖼 请发送一张图片"
+
+    @command("结束", "完成", "处理")
+    async def _cmd_finish_multi_images(self, call):
+        """多图片上传完成"""
+        multi_data = self.multi_image_data.get(call.user_id)
+        if multi_data is None:
+            return PASS
+
+        # 检查是否已上传足够的图片
+        if len(multi_data['images']) < multi_data['count']:
+            return f"⚠️ 您还需要发送{multi_data['count'] - len(multi_data['images'])}张图片。发送完毕后请发送'结束'开始处理"
+
+        # 消息处理开始
+        self._reply(call.bot, call.from_wxid, "🔄 正在处理图片，请稍候...")
+
+        # 处理多图片
+        await self._process_multi_images_async(
+            call.bot,
+            multi_data['images'],
+            multi_data['prompt'],
+            call.from_wxid
+        )
+
+        # 清除多图数据
+        self.multi_image_data.pop(call.user_id, None)
+
+    @command("停止", "stop", requires_login=False)
+    async def _cmd_stop(self, call):
+        """停止当前会话进行中的回答，立即关闭上游流"""
+        task = self.generations.get(call.user_id)
+        if task is None or task.done():
+            return "ℹ️ 当前没有进行中的回答"
+        task.cancel()
+        return "⏹ 已停止当前回答"
+
+    async def _run_generation(self, coro):
+        """以可取消的任务运行一次生成
+
+        同一会话同时只保留一个生成：新的问题会取消进行中的生成，"yw停止"也通过
+        这里登记的任务取消。取消会关闭上游流并释放连接。
+
+        Returns:
+            tuple: (是否被取消, 结果)
+        """
+        key = context.current().user_id
+        previous = self.generations.get(key)
+        if previous is not None and not previous.done():
+            logger.info(f"[Yuewen] 会话 {key} 有新的问题，取消进行中的回答")
+            previous.cancel()
+
+        task = asyncio.create_task(coro)
+        self.generations[key] = task
+        try:
+            # asyncio.wait 不会因为任务被取消而抛出异常
+            await asyncio.wait({task})
+        finally:
+            if not task.done():
+                task.cancel()
+            if self.generations.get(key) is task:
+                del self.generations[key]
+
+        if task.cancelled():
+            return True, None
+        return False, task.result()
+
+    def _reply(self, bot, wxid, text):
+        """回复文本：交给发送队列按顺序、限速发送，不等待发送完成"""
+        return self.outbound.send_text(bot, wxid, text)
+
+    async def _run_command(self, call):
+        """执行命令，返回handle_text的返回值；命令选择不处理时返回None"""
+        result = await call.command.handler(call)
+        if result is PASS:
+            return None
+        if isinstance(result, str):
+            self._reply(call.bot, call.from_wxid, result)
+        return False
 
     async def _get_image_result_new_async(self, creation_id: str, record_id: str):
         """轮询获取图片生成结果（StepFun新版API）
@@ -2514,259 +2255,37 @@ class YuewenPlugin(PluginBase):
         Returns:
             tuple: (url, error_message) - 成功时url不为None，失败时error_message不为None
         """
-        if not creation_id or not record_id:
-            logger.error("[Yuewen][New API] 缺少必要的创建ID或记录ID")
-            return None, "缺少必要的创建ID或记录ID"
-
-        logger.info(f"[Yuewen][New API] 开始轮询图片生成状态: creation_id={creation_id}, record_id={record_id}")
-
-        # 轮询参数
-        max_polling_count = 60  # 最大轮询次数
-        initial_delay = 1.0     # 初始延迟（秒）
-        max_delay = 5.0         # 最大延迟（秒）
-        current_delay = initial_delay
-
-        # 使用用户提供的curl命令中的正确API端点
-        poll_url = f"{self.current_base_url}/api/capy.creation.v1.CreationService/GetCreationRecordResultStream"
-
-        # 准备请求头
-        headers = self._update_headers()
-        headers.update({
-            'canary': 'false',
-            'connect-protocol-version': '1',
-            'content-type': 'application/connect+json',
-            'origin': self.current_base_url,
-            'priority': 'u=1, i',
-            'x-waf-client-type': 'fetch_sdk'
-        })
-
-        # 准备cookies
-        cookies = {
-            'Oasis-Webid': self.oasis_webid or '',
-            'Oasis-Token': self.oasis_token or '',
-            'i18next': 'zh',
-            'sidebar_state': 'false'
-        }
-
-        # 准备轮询请求体
-        payload = {
-            "creationId": creation_id,
-            "creationRecordId": record_id
-        }
-
-        # 构建Connect格式的请求
-        try:
-            json_str = json.dumps(payload, separators=(',', ':'))
-            # 根据Connect协议，添加0x00作为flag和4字节big-endian长度
-            encoded_json = json_str.encode('utf-8')
-            length = len(encoded_json)
-            prefix = struct.pack('>BI', 0, length)  # Flag(1字节) + Length(4字节)
-            request_data = prefix + encoded_json
-
-            logger.debug(f"[Yuewen][New API] 构建请求数据，大小: {len(request_data)} 字节")
-        except Exception as e:
-            logger.error(f"[Yuewen][New API] 构建请求数据失败: {e}")
-            return None, f"构建请求数据失败: {e}"
+        return await self.backends['new'].poll_creation(creation_id, record_id)
 
+    async def _process_multi_images_async(self, bot, images, prompt, from_wxid):
+        """处理多张图片（异步版本）"""
         try:
-            # 发起轮询请求，使用较长的超时时间
-            timeout = aiohttp.ClientTimeout(total=180)  # 3分钟超时
-
-            async with aiohttp.ClientSession(cookies=cookies, timeout=timeout) as session:
-                async with session.post(poll_url, headers=headers, data=request_data) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"[Yuewen][New API] 图片轮询请求失败: HTTP {response.status}, {error_text}")
-                        return None, f"图片轮询请求失败: HTTP {response.status}, {error_text}"
-
-                    # 处理流式响应
-                    buffer = bytearray()
-                    image_url = None
-
-                    # 处理响应流
-                    async for chunk in response.content.iter_any():
-                        if not chunk:
-                            continue
-
-                        buffer.extend(chunk)
+            # 按当前API版本构建图片附件
+            attachments = [self.backend.build_attachment(img) for img in images]
+            logger.debug(f"[Yuewen] 构建了 {len(attachments)} 个图片附件")
 
-                        # 解析Connect协议帧
-                        while len(buffer) >= 5:  # 至少需要5字节（flag + length）
-                            try:
-                                flags = buffer[0]
-                                frame_length = struct.unpack('>I', buffer[1:5])[0]
+            # 重置图片直接发送标记
+            context.current().image_sent = False
 
-                                if len(buffer) < 5 + frame_length:
-                                    # 数据不完整，等待更多数据
-                                    break
-
-                                # 提取帧数据
-                                frame_data = buffer[5:5+frame_length]
-                                buffer = buffer[5+frame_length:]  # 移除已处理的帧
-
-                                # 解析JSON
-                                if frame_length > 0:
-                                    try:
-                                        frame_json = json.loads(frame_data.decode('utf-8'))
-                                        logger.debug(f"[Yuewen][New API] 收到图片轮询响应帧: {str(frame_json)[:100]}...")
-
-                                        # 从帧中提取图片URL
-                                        record = frame_json.get('body', {}).get('record', {})
-                                        state = record.get('state')
-
-                                        # 检查是否成功
-                                        if state == 'CREATION_RECORD_STATE_SUCCESS':
-                                            # 尝试从结果中提取URL
-                                            result = record.get('result', {})
-                                            gen_image = result.get('genImage', {})
-                                            resources = gen_image.get('resources', [])
-
-                                            if resources and len(resources) > 0:
-                                                resource = resources[0].get('resource', {})
-                                                image_data = resource.get('image', {})
-                                                image_url = image_data.get('url')
-
-                                                if image_url:
-                                                    logger.info(f"[Yuewen][New API] 成功获取图片URL: {image_url}")
-                                                    return image_url, None
-
-                                        # 检查是否失败
-                                        elif state in ['CREATION_RECORD_STATE_FAILED', 'CREATION_RECORD_STATE_REJECTED', 'CREATION_RECORD_STATE_CANCELED']:
-                                            reason = record.get('failedReason') or record.get('rejectReason') or "未知原因"
-                                            logger.error(f"[Yuewen][New API] 图片生成失败: {state}, 原因: {reason}")
-                                            return None, f"图片生成失败: {state}, 原因: {reason}"
-
-                                    except json.JSONDecodeError:
-                                        logger.warning(f"[Yuewen][New API] 解析JSON帧失败: {frame_data[:100]}...")
-                                    except Exception as e:
-                                        logger.error(f"[Yuewen][New API] 处理帧异常: {e}")
-
-                                # 检查是否是结束帧
-                                if flags & 0x02:
-                                    logger.info("[Yuewen][New API] 收到结束帧")
-                                    break
-
-                            except struct.error:
-                                logger.error(f"[Yuewen][New API] 解析帧头失败: {buffer[:10]}...")
-                                buffer = buffer[1:]  # 跳过当前字节继续尝试
-                            except Exception as e:
-                                logger.error(f"[Yuewen][New API] 处理帧异常: {e}")
-                                buffer = buffer[5:]  # 跳过当前帧头继续尝试
-
-                    # 如果处理完所有响应后仍未提取到URL
-                    if not image_url:
-                        logger.warning("[Yuewen][New API] 处理完所有响应帧，但未找到图片URL")
-                        return None, "处理完所有响应帧，但未找到图片URL"
-
-                    return image_url, None
-
-        except asyncio.TimeoutError:
-            logger.error("[Yuewen][New API] 图片轮询请求超时")
-            return None, "图片轮询请求超时"
-        except aiohttp.ClientError as e:
-            logger.error(f"[Yuewen][New API] 图片轮询请求客户端错误: {e}")
-            return None, f"图片轮询请求客户端错误: {e}"
-        except Exception as e:
-            logger.error(f"[Yuewen][New API] 图片轮询请求异常: {e}", exc_info=True)
-            return None, f"图片轮询请求异常: {e}"
+            # 发送消息
+            cancelled, result = await self._run_generation(self.send_message_async(prompt, attachments))
+            if cancelled:
+                return False
 
-    async def _process_multi_images_async(self, bot, images, prompt, from_wxid):
-        """处理多张图片（异步版本）"""
-        try:
-            if self.api_version == 'new':
-                # 新版API支持多图处理
-                attachments = []
-
-                for img in images:
-                    # 构建符合新版API要求的附件结构
-                    if 'response_data' in img:
-                        # 使用完整响应数据构建附件
-                        response_data = img['response_data']
-                        attachment = {
-                            "resource": {
-                                "image": {
-                                    "rid": response_data.get('rid'),
-                                    "url": response_data.get('url'),
-                                    "meta": response_data.get('meta', {"width": img['width'], "height": img['height']}),
-                                    "mimeType": response_data.get('mimeType', "image/jpeg")
-                                },
-                                "rid": response_data.get('rid')
-                            }
-                        }
-                        logger.debug(f"[Yuewen][New API] 使用完整响应数据构建附件: {response_data.get('rid')}")
-                    else:
-                        # 使用基本结构
-                        attachment = {
-                            "resource": {
-                                "image": {
-                                    "rid": img['file_id'],
-                                    "url": f"https://chat-image.stepfun.com/tos-cn-i-9xxiciwj9y/{img['file_id']}~tplv-9xxiciwj9y-image.webp",
-                                    "meta": {
-                                        "width": img['width'],
-                                        "height": img['height']
-                                    },
-                                    "mimeType": "image/jpeg"
-                                },
-                                "rid": img['file_id']
-                            }
-                        }
-                        logger.debug(f"[Yuewen][New API] 使用基本结构构建附件: {img['file_id']}")
-
-                    attachments.append(attachment)
-
-                logger.debug(f"[Yuewen][New API] 构建了 {len(attachments)} 个图片附件")
-
-                # 重置图片直接发送标记
-                self.image_directly_sent = False
-
-                # 发送消息
-                result = await self._send_message_new_async(prompt, attachments)
-
-                # 发送结果 - 检查是否图片已经直接发送
-                if result:
-                    await bot.send_text_message(from_wxid, result)
-                    return True
-                elif hasattr(self, 'image_directly_sent') and self.image_directly_sent:
-                    # 图片已经在处理响应期间直接发送给用户，无需发送错误消息
-                    logger.info("[Yuewen][New API] 图片已直接发送给用户，多图处理成功")
-                    return True
-                else:
-                    await bot.send_text_message(from_wxid, "❌ 处理多张图片失败，请稍后重试")
-                    return False
+            # 发送结果 - 先检查图片是否已经直接发送，此时没有需要回复的文本
+            if context.current().image_sent:
+                logger.info("[Yuewen] 图片已直接发送给用户，多图处理成功")
+                return True
+            elif isinstance(result, str) and result:
+                self._reply(bot, from_wxid, result)
+                return True
             else:
-                # 旧版API处理
-                # 检查是否有活动会话
-                if not self.current_chat_id:
-                    logger.info("[Yuewen] 没有活动会话，尝试创建新会话")
-                    if not await self.create_chat_async():
-                        await bot.send_text_message(from_wxid, "❌ 创建会话失败，请重试")
-                        return False
-
-                # 构建多图片附件
-                attachments = []
-                for img in images:
-                    attachments.append({
-                        "fileId": img['file_id'],
-                        "type": "image/jpeg",
-                        "width": img['width'],
-                        "height": img['height'],
-                        "size": img['size']
-                    })
-
-                # 发送消息
-                result = await self._send_message_old_async(prompt, attachments)
-
-                # 发送结果
-                if result:
-                    await bot.send_text_message(from_wxid, result)
-                    return True
-                else:
-                    await bot.send_text_message(from_wxid, "❌ 处理多张图片失败，请稍后重试")
-                    return False
+                self._reply(bot, from_wxid, "❌ 处理多张图片失败，请稍后重试")
+                return False
 
         except Exception as e:
             logger.error(f"[Yuewen] 处理多张图片异常: {e}", exc_info=True)
-            await bot.send_text_message(from_wxid, f"❌ 处理多张图片出错: {str(e)}")
+            self._reply(bot, from_wxid, f"❌ 处理多张图片出错: {str(e)}")
             return False
 
     async def _get_share_image_async(self, bot, chat_id, messages):
@@ -2786,9 +2305,8 @@ class YuewenPlugin(PluginBase):
                 except Exception as e:
                     logger.error(f"[Yuewen] 刷新令牌异常: {e}")
 
-            # 获取token和webid
-            token = self.config.get('oasis_token', '')
-            webid = self.config.get('oasis_webid', '')
+            # 获取当前会话账号的token和webid
+            token, webid = self.backend.transport.credentials()
 
             if not token or not webid:
                 logger.error("[Yuewen] 获取分享图片失败: 缺少令牌或webid")
@@ -2797,38 +2315,10 @@ class YuewenPlugin(PluginBase):
             # 第一步：获取分享ID
             url = f"{self.current_base_url}/api/proto.chat.v1.ChatService/ChatShareSelectMessage"
 
-            # 完全按照curl命令构建请求头
-            headers = {
-                'accept': '*/*',
-                'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
-                'canary': 'false',
-                'connect-protocol-version': '1',
-                'content-type': 'application/json',
-                'oasis-appid': '10200',
-                'oasis-mode': '2',
-                'oasis-platform': 'web',
-                'oasis-webid': webid,
-                'origin': self.current_base_url,
-                'priority': 'u=1, i',
-                'referer': f'{self.current_base_url}/chats/{chat_id}',
-                'sec-ch-ua': '"Chromium";v="136", "Microsoft Edge";v="136", "Not.A/Brand";v="99"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': '"Windows"',
-                'sec-fetch-dest': 'empty',
-                'sec-fetch-mode': 'cors',
-                'sec-fetch-site': 'same-origin',
-                'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0',
-                'x-waf-client-type': 'fetch_sdk'
-            }
-
-            # 设置Cookie - 使用与curl命令一致的方式
-            cookies = {
-                'Oasis-Webid': webid,
-                'Oasis-Token': token,
-                'i18next': 'zh',
-                '_tea_utm_cache_20002086': '{%22utm_source%22:%22share%22%2C%22utm_content%22:%22web_image_share%22}',
-                'sidebar_state': 'false'
-            }
+            # 与浏览器curl一致的请求头和Cookie（来自按凭证缓存的模板）
+            share_backend = self.backends['old']
+            headers = share_backend.headers('share', referer=f'{self.current_base_url}/chats/{chat_id}')
+            cookies = share_backend.transport.cookies()
 
             share_data = {
                 "chatId": chat_id,
@@ -2875,9 +2365,6 @@ class YuewenPlugin(PluginBase):
                 "scale": 3
             }
 
-            # 更新referer为指向聊天页面
-            headers['referer'] = f'{self.current_base_url}/chats/{chat_id}'
-
             logger.debug(f"[Yuewen] 生成分享图片请求：URL={url}, Headers={headers.keys()}, Data={poster_data}")
 
             # 发送请求
@@ -2915,223 +2402,127 @@ class YuewenPlugin(PluginBase):
 
     async def _enable_deep_thinking_async(self):
         """启用深度思考模式（异步版本）"""
-        try:
-            if self.api_version != 'old':
-                logger.warning("[Yuewen] 深度思考模式仅支持旧版API")
-                return False
-
-            # 设置深度思考URL
-            url = f"{self.current_base_url}/api/proto.user.v1.UserService/EnableLlmDeepThinking"
-
-            # 获取包含Cookie的headers
-            headers = self._update_headers()
-            headers.update({
-                'Content-Type': 'application/json',
-                'oasis-mode': '1',  # 使用mode 1，与创建会话保持一致
-                'referer': f'{self.current_base_url}/chats/{self.current_chat_id}'
-            })
-
-            # 发送异步请求
-            for retry in range(2):
-                try:
-                    async with self.http_session.post(
-                        url,
-                        headers=headers,
-                        json={"enable": True}  # 启用深度思考
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            if result.get("result") == "RESULT_CODE_SUCCESS":
-                                logger.info("[Yuewen] 深度思考模式设置成功")
-                                return True
-
-                        # 如果是401错误，尝试刷新令牌并重试
-                        elif response.status == 401 and retry == 0:
-                            logger.warning("[Yuewen] 设置深度思考模式失败: 令牌无效，尝试刷新...")
-                            if await self.login_handler.refresh_token():
-                                # 更新headers (包含新的token)
-                                headers = self._update_headers()
-                                headers.update({
-                                    'Content-Type': 'application/json',
-                                    'oasis-mode': '1',
-                                    'referer': f'{self.current_base_url}/chats/{self.current_chat_id}'
-                                })
-                                continue
-
-                        error_text = await response.text()
-                        logger.error(f"[Yuewen] 设置深度思考模式失败: {response.status}, {error_text}")
-                        return False
-
-                except Exception as e:
-                    logger.error(f"[Yuewen] 设置深度思考模式请求异常: {e}", exc_info=True)
-                    return False
-
-            return False
-
-        except Exception as e:
-            logger.error(f"[Yuewen] 设置深度思考模式异常: {e}", exc_info=True)
+        if self.api_version != 'old':
+            logger.warning("[Yuewen] 深度思考模式仅支持旧版API")
             return False
+        return await self.backends['old'].enable_deep_thinking(self.current_chat_id)
+
+    def _create_image_downloader(self):
+        """图片获取策略：本地方法依次执行，远程方法带超时竞速"""
+        return ImageDownloader([
+            Strategy('md5_file', self._fetch_image_md5_file),
+            Strategy('img_buf', self._fetch_image_buf),
+            Strategy('image_path', self._fetch_image_path),
+            Strategy('content_base64', self._fetch_image_content),
+            Strategy('cdn', self._fetch_image_cdn, remote=True, timeout=20),
+            Strategy('message_image', self._fetch_image_by_msg_id, remote=True, timeout=15),
+        ])
 
     async def download_image(self, bot, message):
-        """尝试用多种方法下载图片，优先使用系统缓存的图片
+        """尝试用多种方法获取图片，优先使用系统缓存的图片
 
         Args:
-            bot: WechatAPIClient实例
-            message: 消息字典
-
-        Returns:
-            Tuple[str, bytes]: 图片路径和图片二进制数据的元组，失败时返回(None, None)
-        """
-        try:
-            msg_id = message.get("MsgId", "")
-            from_wxid = message.get("FromWxid", "")
-            sender_wxid = message.get("SenderWxid", from_wxid)
-
-            if not msg_id or not from_wxid:
-                logger.error("[Yuewen] 下载图片失败：缺少必要参数")
-                return None, None
-
-            logger.info(f"[Yuewen] 尝试获取图片: MsgId={msg_id}, FromWxid={from_wxid}, SenderWxid={sender_wxid}")
-
-            # 尝试方法0: 检查消息中的md5值，尝试在files目录中查找对应的图片
-            md5_value = None
-
-            # 直接从日志中获取XML内容
-            xml_content = message.get("XML", "") or message.get("Xml", "") or message.get("Content", "")
-
-            # 打印XML内容的前100个字符，用于调试
-            if isinstance(xml_content, str) and len(xml_content) > 0:
-                logger.info(f"[Yuewen] XML内容前100个字符: {xml_content[:100]}")
-            else:
-                logger.warning(f"[Yuewen] XML内容为空或不是字符串: {type(xml_content)}")
-
-            # 尝试从XML中提取MD5值
-            if isinstance(xml_content, str) and "md5=" in xml_content:
-                md5_match = re.search(r'md5=["\']([^"\']+)["\']', xml_content)
-                if md5_match:
-                    md5_value = md5_match.group(1)
-                    logger.info(f"[Yuewen] 从XML中提取到MD5值: {md5_value}")
-
-                    # 尝试在files目录中查找对应的图片
-                    possible_extensions = ['.jpg', '.jpeg', '.png', '.webp', '']  # 添加空扩展名
-                    for ext in possible_extensions:
-                        file_path = f"/app/files/{md5_value}{ext}"
-                        logger.info(f"[Yuewen] 尝试查找文件: {file_path}")
-                        if os.path.exists(file_path):
-                            try:
-                                with open(file_path, "rb") as f:
-                                    image_data = f.read()
-                                logger.info(f"[Yuewen] 方法0从MD5文件读取图片成功: {file_path}, {len(image_data)} 字节")
-                                return file_path, image_data
-                            except Exception as e:
-                                logger.warning(f"[Yuewen] 读取MD5文件失败: {e}")
-
-            # 如果没有从XML中提取到MD5值，尝试从消息对象中直接获取
-            if not md5_value and "md5" in str(message).lower():
-                # 尝试从整个消息对象中查找MD5值
-                message_str = str(message)
-                md5_match = re.search(r'md5["\':=\s]+([a-f0-9]{32})', message_str, re.IGNORECASE)
-                if md5_match:
-                    md5_value = md5_match.group(1)
-                    logger.info(f"[Yuewen] 从消息对象中提取到MD5值: {md5_value}")
-
-                    # 尝试在files目录中查找对应的图片
-                    possible_extensions = ['.jpg', '.jpeg', '.png', '.webp', '']  # 添加空扩展名
-                    for ext in possible_extensions:
-                        file_path = f"/app/files/{md5_value}{ext}"
-                        logger.info(f"[Yuewen] 尝试查找文件: {file_path}")
-                        if os.path.exists(file_path):
-                            try:
-                                with open(file_path, "rb") as f:
-                                    image_data = f.read()
-                                logger.info(f"[Yuewen] 方法0从MD5文件读取图片成功: {file_path}, {len(image_data)} 字节")
-                                return file_path, image_data
-                            except Exception as e:
-                                logger.warning(f"[Yuewen] 读取MD5文件失败: {e}")
-
-            # 尝试方法1: 优先使用ImgBuf字段（系统缓存的图片数据）
-            if "ImgBuf" in message and message["ImgBuf"]:
-                try:
-                    img_buf = message["ImgBuf"]
-                    if isinstance(img_buf, bytes) and len(img_buf) > 0:
-                        logger.info(f"[Yuewen] 方法1从ImgBuf获取图片成功: {len(img_buf)} 字节")
-                        return None, img_buf
-                except Exception as e:
-                    logger.warning(f"[Yuewen] 从ImgBuf获取图片失败: {e}")
-
-            # 尝试方法2: 如果消息包含图片路径，直接读取（系统缓存的图片路径）
-            if "Image" in message and message["Image"]:
-                image_path = message["Image"]
-                try:
-                    if os.path.exists(image_path):
-                        with open(image_path, "rb") as f:
-                            image_data = f.read()
-                            if image_data and len(image_data) > 0:
-                                logger.info(f"[Yuewen] 方法2从系统缓存路径读取图片成功: {image_path}, {len(image_data)} 字节")
-                                return image_path, image_data
-                except Exception as e:
-                    logger.warning(f"[Yuewen] 从系统缓存路径读取图片失败: {e}")
-
-            # 尝试方法3: 从消息中提取XML并解析aeskey和cdnmidimgurl
-            try:
-                # 获取图片消息的xml内容
-                if xml_content and "<msg>" in xml_content:
-                    # 使用正则表达式提取aeskey和cdnmidimgurl
-                    aeskey_match = re.search(r'aeskey=["\']([^"\']+)["\']', xml_content)
-                    cdnurl_match = re.search(r'cdnmidimgurl=["\']([^"\']+)["\']', xml_content)
-
-                    if aeskey_match and cdnurl_match:
-                        aeskey = aeskey_match.group(1)
-                        cdnmidimgurl = cdnurl_match.group(1)
+            bot: WechatAPIClient实例
+            message: 消息字典
 
-                        logger.info(f"[Yuewen] 成功提取图片参数: aeskey={aeskey}, cdnmidimgurl={cdnmidimgurl}")
+        Returns:
+            Tuple[str, bytes]: 图片路径和图片二进制数据的元组，图片已在磁盘上时只返回路径，
+                失败时返回(None, None)
+        """
+        try:
+            msg_id = message.get("MsgId", "")
+            from_wxid = message.get("FromWxid", "")
+            sender_wxid = message.get("SenderWxid", from_wxid)
 
-                        # 调用WechatAPI的下载图片方法
-                        try:
-                            image_data = await bot.download_image(aeskey, cdnmidimgurl)
-                            if image_data:
-                                # 将base64数据转换为字节
-                                image_bytes = base64.b64decode(image_data)
-                                logger.info(f"[Yuewen] 方法3下载图片成功: {len(image_bytes)} 字节")
-                                return None, image_bytes
-                        except Exception as e:
-                            logger.warning(f"[Yuewen] 调用API下载图片失败: {e}")
-                else:
-                    logger.warning(f"[Yuewen] 消息中未找到有效的XML内容")
-            except Exception as e:
-                logger.warning(f"[Yuewen] 方法3下载图片失败: {e}")
+            if not msg_id or not from_wxid:
+                logger.error("[Yuewen] 下载图片失败：缺少必要参数")
+                return None, None
 
-            # 尝试方法4: 使用消息内容本身，如果是图片内容
-            if "Content" in message and isinstance(message["Content"], str) and message["Content"].startswith("/9j/"):
-                try:
-                    # 可能是base64编码的图片
-                    image_data = base64.b64decode(message["Content"])
-                    if image_data and len(image_data) > 0:
-                        logger.info(f"[Yuewen] 方法4直接解码Content成功: {len(image_data)} 字节")
-                        return None, image_data
-                except Exception as e:
-                    logger.warning(f"[Yuewen] 方法4解码Content失败: {e}")
+            _download_log.debug(
+                "[Yuewen] 尝试获取图片: MsgId={}, FromWxid={}, SenderWxid={}",
+                lambda: msg_id, lambda: from_wxid, lambda: sender_wxid
+            )
 
-            # 尝试方法5: 如果有MsgId，尝试直接从bot获取图片数据
-            if msg_id:
-                try:
-                    # 尝试使用bot的get_message_image方法（如果存在）
-                    if hasattr(bot, 'get_message_image'):
-                        image_data = await bot.get_message_image(msg_id)
-                        if image_data and len(image_data) > 0:
-                            logger.info(f"[Yuewen] 方法5使用get_message_image获取图片成功: {len(image_data)} 字节")
-                            return None, image_data
-                except Exception as e:
-                    logger.warning(f"[Yuewen] 方法5获取图片失败: {e}")
+            # 一次解析出图片消息XML中的全部参数（按MsgId缓存）
+            meta = wx_message.image_meta(message)
+            if meta is wx_message.EMPTY_IMAGE_META:
+                _download_log.debug("[Yuewen] 消息中未找到图片XML: {}", lambda: wx_message.message_xml(message)[:100])
 
-            # 返回失败
-            logger.error("[Yuewen] 所有获取图片方法均失败")
-            return None, None
+            image_path, image_data = await self.image_downloader.fetch(bot, message, meta)
+            if not image_path and not image_data:
+                logger.error(f"[Yuewen] 所有获取图片方法均失败: {self.image_downloader.stats}")
+            return image_path, image_data
 
         except Exception as e:
             logger.error(f"[Yuewen] 获取图片异常: {e}", exc_info=True)
             return None, None
 
+    async def _fetch_image_md5_file(self, bot, message, meta):
+        """方法0: 根据md5值在files目录中查找对应的图片"""
+        if not meta.md5:
+            return None
+        possible_extensions = ['.jpg', '.jpeg', '.png', '.webp', '']  # 添加空扩展名
+        for ext in possible_extensions:
+            file_path = f"/app/files/{meta.md5}{ext}"
+            _download_log.debug("[Yuewen] 尝试查找文件: {}", lambda: file_path)
+            if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
+                # 只返回路径，图片数据在上传时再从文件分块读取
+                logger.info(f"[Yuewen] 找到MD5对应的图片文件: {file_path}")
+                return file_path, None
+        return None
+
+    async def _fetch_image_buf(self, bot, message, meta):
+        """方法1: 使用ImgBuf字段（系统缓存的图片数据）"""
+        img_buf = message.get("ImgBuf")
+        if isinstance(img_buf, bytes) and img_buf:
+            logger.info(f"[Yuewen] 从ImgBuf获取图片成功: {len(img_buf)} 字节")
+            return None, img_buf
+        return None
+
+    async def _fetch_image_path(self, bot, message, meta):
+        """方法2: 消息包含图片路径时直接读取（系统缓存的图片路径）"""
+        image_path = message.get("Image")
+        if not image_path or not os.path.isfile(image_path) or os.path.getsize(image_path) == 0:
+            return None
+        logger.info(f"[Yuewen] 找到系统缓存的图片文件: {image_path}")
+        return image_path, None
+
+    async def _fetch_image_content(self, bot, message, meta):
+        """方法3: 消息内容本身是base64编码的图片"""
+        content = message.get("Content")
+        if not isinstance(content, str) or not content.startswith("/9j/"):
+            return None
+        image_data = base64.b64decode(content)
+        logger.info(f"[Yuewen] 直接解码Content成功: {len(image_data)} 字节")
+        return None, image_data
+
+    async def _fetch_image_cdn(self, bot, message, meta):
+        """方法4: 使用XML中的aeskey和cdnmidimgurl通过CDN下载"""
+        if not meta.downloadable:
+            _download_log.debug("[Yuewen] 消息中未找到有效的图片下载参数")
+            return None
+        _download_log.debug(
+            "[Yuewen] 成功提取图片参数: aeskey={}, cdnmidimgurl={}",
+            lambda: meta.aeskey, lambda: meta.cdn_mid_url
+        )
+        image_data = await bot.download_image(meta.aeskey, meta.cdn_mid_url)
+        if not image_data:
+            return None
+        # 将base64数据转换为字节
+        image_bytes = base64.b64decode(image_data)
+        logger.info(f"[Yuewen] CDN下载图片成功: {len(image_bytes)} 字节")
+        return None, image_bytes
+
+    async def _fetch_image_by_msg_id(self, bot, message, meta):
+        """方法5: 使用bot的get_message_image方法按MsgId获取（如果存在）"""
+        if not hasattr(bot, 'get_message_image'):
+            return None
+        image_data = await bot.get_message_image(message.get("MsgId"))
+        if not image_data:
+            return None
+        logger.info(f"[Yuewen] 使用get_message_image获取图片成功: {len(image_data)} 字节")
+        return None, image_data
+
     async def _ensure_token_valid_async(self):
         """确保令牌有效，如果即将过期则刷新
 
@@ -3296,7 +2687,7 @@ class YuewenPlugin(PluginBase):
 
                         try:
                             # 发送图片
-                            send_result = await bot.send_image_message(wxid, image_data)
+                            send_result = await self.outbound.call(wxid, lambda: bot.send_image_message(wxid, image_data))
 
                             # 检查发送结果 - 修改返回值检查逻辑
                             if send_result and send_result.get("Success", False):
@@ -3318,7 +2709,9 @@ class YuewenPlugin(PluginBase):
 
                                         # 尝试使用PNG格式发送
                                         logger.info(f"[Yuewen] 尝试使用PNG格式发送图片 ({len(image_data_png)} 字节)")
-                                        retry_result = await bot.send_image_message(wxid, image_data_png)
+                                        retry_result = await self.outbound.call(
+                                            wxid, lambda: bot.send_image_message(wxid, image_data_png)
+                                        )
 
                                         if retry_result and retry_result.get("Success", False):
                                             logger.info(f"[Yuewen] 使用PNG格式成功发送图片给 {wxid}")
@@ -3352,10 +2745,7 @@ class YuewenPlugin(PluginBase):
                     continue
 
         # 当所有重试都失败后，发送文本消息告知用户
-        try:
-            await bot.send_text_message(wxid, f"图片获取失败，请点击链接查看: {image_url}")
-        except Exception as e:
-            logger.error(f"[Yuewen] 发送失败信息也失败了: {e}")
+        self._reply(bot, wxid, f"图片获取失败，请点击链接查看: {image_url}")
 
         return False
 
@@ -3365,11 +2755,6 @@ class YuewenPlugin(PluginBase):
         if not self.enable:
             return True  # 插件未启用，允许后续插件处理
 
-        # 保存当前bot和message引用，用于直接发送图片
-        self.current_bot = bot
-        self.current_message = message
-        self.image_directly_sent = False  # 重置图片发送标记
-
         # 获取消息内容
         content = message.get("Content", "").strip()
         user_id = self._get_user_id(message)
@@ -3389,184 +2774,53 @@ class YuewenPlugin(PluginBase):
         if not is_command and not in_verification and not in_login_flow:
             return True
 
+        self._activate_conversation(user_id)  # 后续调用路由到该会话绑定的后端
+        # 本条消息的请求上下文，用于直接发送图片和限制处理时长
+        context.begin(bot, message, from_wxid, user_id, deadline=self.generation_deadline)
+
         # 移除前缀，获取实际内容
         content = content[len(trigger_prefix):].strip() if is_command else content
 
-        # 如果是登录流程中的手机号（11位数字）
-        # 需要检查多种格式: 纯数字、带前缀无空格、带前缀有空格
+        # 如果是登录流程中的手机号（查找内容中的11位连续数字，带不带前缀均可）
         if in_login_flow:
-            # 提取手机号 (查找内容中的11位连续数字)
-            phone_match = re.search(r'1\d{10}', content)
-
+            phone_match = _PHONE_RE.search(content)
             if phone_match:
                 phone_number = phone_match.group(0)  # 提取匹配的手机号
                 logger.info(f"[Yuewen] 检测到用户输入手机号: {phone_number}")
                 await self._send_verification_code_async(bot, from_wxid, user_id, phone_number)
                 return False
-            elif content.isdigit() and len(content) == 11 and content.startswith('1'):
-                # 原有逻辑，处理纯11位数字
-                await self._send_verification_code_async(bot, from_wxid, user_id, content)
-                return False
-            elif content.isdigit() and len(content) == 11 and content.startswith('1'):
-                # 处理带前缀的情况，使用处理后的content
-                await self._send_verification_code_async(bot, from_wxid, user_id, content)
-                return False
 
         # 如果等待验证码输入，检查4位数字
-        if in_verification:
-            # 先检查原始内容
-            if content.isdigit() and len(content) == 4:
-                await self._verify_login_async(bot, from_wxid, user_id, content)
-                return False
-            # 再检查去掉前缀后的内容
-            elif content.isdigit() and len(content) == 4:
-                await self._verify_login_async(bot, from_wxid, user_id, content)
-                return False
-
-        # 显式登录命令处理
-        if content in ["登录", "登陆", "login"]:
-            await self._initiate_login_async(bot, from_wxid, user_id)
+        if in_verification and content.isdigit() and len(content) == 4:
+            await self._verify_login_async(bot, from_wxid, user_id, content)
             return False
 
+        # 命令路由：一次扫描找到命令，登录、日志等命令不需要先检查登录状态
+        call = self.command_router.match(
+            content, bot=bot, message=message, from_wxid=from_wxid, user_id=user_id
+        )
+        if call is not None and not call.command.requires_login:
+            handled = await self._run_command(call)
+            if handled is not None:
+                return handled
+            call = None
+
         # 如果需要登录 - 检查登录状态
         if await self._check_login_status_async():
             # 只有当用户特别请求相关功能时才提示登录
             if is_command:
-                await bot.send_text_message(
+                self._reply(
+                    bot,
                     from_wxid,
                     "⚠️ 跃问账号未登录或已失效，请先发送\"yw登录\"进行登录"
                 )
             return False
 
-        # 处理分享命令 - 在处理内置命令前单独处理
-        if content in ["分享", "share", "生成图片"]:
-            if self.api_version == 'new':
-                await bot.send_text_message(from_wxid, "⚠️ 分享功能仅支持旧版API，请先发送'yw切换旧版'切换到旧版API")
-                return False
-
-            # 检查是否有最近的消息记录
-            if not hasattr(self, 'last_message') or not self.last_message:
-                await bot.send_text_message(from_wxid, "⚠️ 没有可分享的消息记录，请先发送一条消息")
-                return False
-
-            # 检查最近消息是否超时
-            current_time = time.time()
-            if current_time - self.last_message.get('last_time', 0) > 180:  # 3分钟超时
-                await bot.send_text_message(from_wxid, "⚠️ 分享超时，请重新发送消息后再尝试分享")
-                return False
-
-            # 发送等待消息
-            await bot.send_text_message(from_wxid, "🔄 正在生成分享图片，请稍候...")
-
-            # 获取分享图片
-            share_url = await self._get_share_image_async(
-                bot,
-                self.last_message['chat_id'],
-                self.last_message['messages']
-            )
-
-            # 发送分享图片
-            if share_url:
-                # 直接使用优化后的发送图片方法
-                logger.info(f"[Yuewen] 开始下载并发送分享图片: {share_url}")
-
-                try:
-                    # 使用改进后的send_image_from_url方法
-                    send_success = await self.send_image_from_url(bot, from_wxid, share_url)
-
-                    if not send_success:
-                        # 如果发送失败，提供原始链接
-                        logger.error(f"[Yuewen] 分享图片发送失败，提供原始链接")
-                        await bot.send_text_message(from_wxid, f"分享图片发送失败，您可以直接访问: {share_url}")
-                    else:
-                        logger.info(f"[Yuewen] 分享图片发送成功")
-
-                    # 无论成功与否，立即返回，不做后续处理
-                    return False  # 阻止后续插件处理
-                except Exception as e:
-                    logger.error(f"[Yuewen] 发送分享图片异常: {e}")
-                    await bot.send_text_message(from_wxid, f"分享图片发送失败: {str(e)}")
-                    return False
-            else:
-                await bot.send_text_message(from_wxid, "❌ 生成分享图片失败，请稍后重试")
-                return False  # 阻止后续插件处理
-
-        # 处理内置命令
-        command_result = await self._handle_commands_async(content)
-        if command_result is not None:
-            # 这里command_result是命令处理的结果，是文字消息
-            await bot.send_text_message(from_wxid, command_result)
-            return False
-
-        # 识图命令处理
-        pic_trigger = self.pic_trigger_prefix
-        if content.startswith(pic_trigger):
-            # 检查是否是"识图N"格式，支持多张图片分析
-            match = re.match(r'^识图(\d+)(\s+.*)?$', content)
-            if match:
-                img_count = int(match.group(1))
-                if img_count < 1 or img_count > self.max_images:
-                    await bot.send_text_message(
-                        from_wxid,
-                        f"⚠️ 图片数量必须在1-{self.max_images}之间"
-                    )
-                    return False
-
-                prompt = match.group(2).strip() if match.group(2) else self.imgprompt
-
-                # 初始化多图处理数据
-                self.multi_image_data[user_id] = {
-                    'prompt': prompt,
-                    'images': [],
-                    'count': img_count
-                }
-
-                # 发送引导消息
-                await bot.send_text_message(
-                    from_wxid,
-                    f"🖼 请依次发送{img_count}张图片，发送完毕后请发送'结束'开始处理"
-                )
-                return False
-            else:
-                # 单图模式，等待下一条信息是图片
-                # 提取可能的提示词
-                prompt = content[len(pic_trigger):].strip()
-                if not prompt:
-                    prompt = self.imgprompt
-
-                # 保存识图请求
-                self.waiting_for_image[user_id] = {'prompt': prompt}
-
-                # 发送引导消息
-                await bot.send_text_message(from_wxid, "🖼 请发送一张图片")
-                return False
-
-        # 处理用户发送的"结束"消息，表示多图片上传完成
-        if user_id in self.multi_image_data and content in ["结束", "完成", "处理"]:
-            multi_data = self.multi_image_data[user_id]
-
-            # 检查是否已上传足够的图片
-            if len(multi_data['images']) < multi_data['count']:
-                await bot.send_text_message(
-                    from_wxid,
-                    f"⚠️ 您还需要发送{multi_data['count'] - len(multi_data['images'])}张图片。发送完毕后请发送'结束'开始处理"
-                )
-                return False
-
-            # 消息处理开始
-            await bot.send_text_message(from_wxid, "🔄 正在处理图片，请稍候...")
-
-            # 处理多图片
-            await self._process_multi_images_async(
-                bot,
-                multi_data['images'],
-                multi_data['prompt'],
-                from_wxid
-            )
-
-            # 清除多图数据
-            self.multi_image_data.pop(user_id, None)
-            return False
+        # 处理命令
+        if call is not None:
+            handled = await self._run_command(call)
+            if handled is not None:
+                return handled
 
         # 正常消息处理
         try:
@@ -3576,71 +2830,62 @@ class YuewenPlugin(PluginBase):
             else:
                 logger.debug("[Yuewen] WechatAPIClient不支持send_typing_status方法，跳过显示输入状态")
 
-            # 发送消息到AI
-            response = await self.send_message_async(content)
+            # 发送消息到AI，相同的并发问题只请求一次；同一会话的新问题或"yw停止"会取消进行中的回答
+            async def ask():
+                response = await self.send_message_async(content)
+                # 图片是否已直接发送只记录在发起请求的上下文中，随结果一起共享给合并的请求
+                return response, context.current().image_sent
+
+            cancelled, outcome = await self._run_generation(self.request_coalescer.do(
+                self._coalesce_key(content, from_wxid), ask
+            ))
+            if cancelled:
+                logger.info(f"[Yuewen] 会话 {user_id} 的回答已取消")
+                return False
+            (response, image_sent), ticket = outcome
+            if not ticket.claim(from_wxid):
+                # 同一个聊天已经（或即将）收到这次请求的回复
+                logger.info(f"[Yuewen] 相同问题的回复已发送到 {from_wxid}，跳过重复回复")
+                return False
+            if image_sent:
+                logger.info("[Yuewen] 图片已直接发送至用户，不再发送文本回复")
+                return False
+            self._remember_exchange(content, response)
 
             # 根据API版本处理不同的返回格式
             if self.api_version == 'new':
-                # 新版API返回元组(text, search_info)
-                if isinstance(response, tuple):
-                    # 检查是否为特殊的图片已发送返回值
-                    if len(response) >= 2 and response[0] is True and response[1] == "IMAGE_SENT":
-                        logger.info("[Yuewen][New API] 检测到图片已发送的特殊返回值，中止后续处理")
-                        return False  # 直接返回，不再处理任何文本消息
-
-                    # 正常处理文本和搜索结果返回值
-                    text, search_info = response[0], response[1]
-
-                    # 如果图片已直接发送，不再发送文本回复
-                    if self.image_directly_sent:
-                        logger.info("[Yuewen][New API] 图片已直接发送至用户，不再发送文本回复")
-                        return False
-
-                    # 发送文本回复
-                    if text:
-                        await bot.send_text_message(from_wxid, text)
-                    else:
-                        await bot.send_text_message(from_wxid, "❌ 未能获取有效回复")
-                        return False
-
-                    # 处理搜索结果
-                    if search_info and search_info.get('results'):
-                        search_results = search_info.get('results', [])
-                        if search_results:
-                            # 准备搜索结果显示
-                            result_text = "\n\n参考资料：\n"
-                            for idx, result in enumerate(search_results[:3], 1):  # 最多显示前3个
-                                title = result.get('title', '未知标题')
-                                url = result.get('url', '#')
-                                result_text += f"{idx}. {title}\n{url}\n\n"
-
-                            # 发送搜索结果
-                            await bot.send_text_message(from_wxid, result_text)
+                # 新版API返回文本（错误时为提示文本）
+                if response:
+                    self._reply(bot, from_wxid, response)
                 else:
-                    # 检查图片是否已直接发送
-                    if hasattr(self, 'image_directly_sent') and self.image_directly_sent:
-                        logger.info("[Yuewen][New API] 图片已直接发送至用户，不再发送额外消息")
-                        return False
-
-                    # 对于字符串类型的响应，直接发送（通常是错误消息）
-                    if response:
-                        await bot.send_text_message(from_wxid, response)
-                    else:
-                        await bot.send_text_message(from_wxid, "❌ 发送消息失败，请重试")
+                    self._reply(bot, from_wxid, "❌ 发送消息失败，请重试")
             else:
                 # 旧版API返回单个字符串
                 if response:
                     # 发送文本消息
-                    await bot.send_text_message(from_wxid, response)
+                    self._reply(bot, from_wxid, response)
                 else:
                     # 如果响应为空，发送错误消息
-                    await bot.send_text_message(from_wxid, "❌ 未获得有效回复，请稍后重试")
+                    self._reply(bot, from_wxid, "❌ 未获得有效回复，请稍后重试")
         except Exception as e:
             logger.error(f"[Yuewen] 处理消息异常: {e}", exc_info=True)
-            await bot.send_text_message(from_wxid, f"❌ 处理消息失败: {str(e)}")
+            self._reply(bot, from_wxid, f"❌ 处理消息失败: {str(e)}")
 
         return False
 
+    def _coalesce_key(self, content, chat_wxid):
+        """请求合并的key: (后端, 模型, 联网模式, 归一化的问题, 聊天)"""
+        return (self.api_version, self.current_model_id, self.network_mode, normalize_prompt(content), chat_wxid)
+
+    def _log_image_meta(self, message):
+        """记录收到的图片参数，解析结果按MsgId缓存，download_image直接复用"""
+        meta = wx_message.image_meta(message)
+        _download_log.debug(
+            "[Yuewen] 收到图片: md5={}, 大小={}字节, 尺寸={}x{}, 可CDN下载={}",
+            lambda: meta.md5, lambda: meta.length, lambda: meta.width, lambda: meta.height,
+            lambda: meta.downloadable
+        )
+
     @on_image_message(priority=50)
     async def handle_image(self, bot: WechatAPIClient, message: dict):
         """处理图片消息"""
@@ -3649,304 +2894,117 @@ class YuewenPlugin(PluginBase):
 
         # 获取用户ID
         user_id = self._get_user_id(message)
+        if user_id not in self.waiting_for_image and user_id not in self.multi_image_data:
+            # 用户没有pending的图片请求，忽略该图片
+            logger.debug(f"[Yuewen] 用户 {user_id} 没有待处理的图片请求，忽略图片消息")
+            return True  # 让其他插件处理
+
+        self._activate_conversation(user_id)  # 后续调用路由到该会话绑定的后端
         from_wxid = message.get("FromWxid")  # 用于发送回复
+        # 本条消息的请求上下文，用于直接发送图片和限制处理时长
+        context.begin(bot, message, from_wxid, user_id, deadline=self.generation_deadline)
 
         # 确保只处理等待图片的请求
         # 检查是否有等待处理的识图请求（单图模式）
         if user_id in self.waiting_for_image:
             logger.info(f"[Yuewen] 用户 {user_id} 正在等待图片，处理图片消息")
-            # 下载图片 - 现在返回元组(image_path, image_data)
-            image_path, image_data = await self.download_image(bot, message)
-
-            if not image_data and not image_path:
-                await bot.send_text_message(from_wxid, "❌ 无法获取图片数据，请重试")
+            self._log_image_meta(message)
+            # 获取图片
+            image = await self._load_image_buffer(bot, message)
+            if not image:
+                self._reply(bot, from_wxid, "❌ 无法获取图片数据，请重试")
                 return False
 
-            # 如果有图片路径但没有图片数据，尝试从路径读取
-            if image_path and not image_data:
-                try:
-                    with open(image_path, "rb") as f:
-                        image_data = f.read()
-                    logger.info(f"[Yuewen] 从图片路径读取图片数据: {image_path}, 大小: {len(image_data)} 字节")
-                except Exception as e:
-                    logger.error(f"[Yuewen] 读取图片路径失败: {e}")
-                    await bot.send_text_message(from_wxid, f"读取图片失败: {e}")
-                    return False
-
-            # 确保有图片数据
-            if not image_data:
-                await bot.send_text_message(from_wxid, "❌ 无法获取图片数据，请重试")
+            # 上传图片，上传完成后即释放图片数据
+            with image:
+                image_info, error_detail = await self._upload_image_async(image)
+            if not image_info:
+                self._reply(bot, from_wxid, f"❌ 图片上传失败{error_detail}\n请稍后重试或联系管理员检查日志")
                 return False
 
-            # 根据API版本选择不同处理方式
-            if self.api_version == 'new':
-                # 上传图片 - 新版API
-                file_id = await self._upload_image_new_async(image_data)
-
-                if not file_id:
-                    # 获取最后一次尝试上传的错误信息
-                    error_detail = ""
-                    if hasattr(self, '_last_upload_error') and self._last_upload_error:
-                        error_detail = f": {self._last_upload_error}"
-
-                    await bot.send_text_message(from_wxid, f"❌ 图片上传失败{error_detail}\n请稍后重试或联系管理员检查日志")
-                    return False
+            # 获取识图提示词
+            prompt = self.waiting_for_image[user_id].get('prompt', self.imgprompt)
 
-                # 获取识图提示词
-                prompt = self.waiting_for_image[user_id].get('prompt', self.imgprompt)
+            # 按当前API版本构建图片附件
+            attachments = [self.backend.build_attachment(image_info)]
 
-                # 创建图片附件
-                # 获取图片尺寸
-                try:
-                    from PIL import Image
-                    from io import BytesIO
-                    img = Image.open(BytesIO(image_data))
-                    width, height = img.size
-                except Exception as e:
-                    logger.error(f"[Yuewen] 获取图片尺寸失败: {e}")
-                    width, height = 800, 600  # 使用默认尺寸
-
-                # 按照新版API要求构建图片附件
-                if hasattr(self, '_last_image_response') and self._last_image_response:
-                    # 使用服务器返回的完整元数据
-                    response_data = self._last_image_response
-
-                    # 构建与curl命令格式完全匹配的附件
-                    attachments = [{
-                        "resource": {
-                            "image": {
-                                "rid": response_data.get('rid'),
-                                "url": response_data.get('url'),
-                                "meta": response_data.get('meta', {"width": width, "height": height}),
-                                "mimeType": response_data.get('mimeType', "image/jpeg")
-                            },
-                            "rid": response_data.get('rid')
-                        }
-                    }]
-                    logger.debug(f"[Yuewen][New API] 使用服务器返回的图片数据构建附件: {response_data.get('rid')}")
-                else:
-                    # 使用基本结构，如果没有完整响应
-                    attachments = [{
-                        "resource": {
-                            "image": {
-                                "rid": file_id,
-                                "url": f"https://chat-image.stepfun.com/tos-cn-i-9xxiciwj9y/{file_id}~tplv-9xxiciwj9y-image.webp",
-                                "meta": {
-                                    "width": width,
-                                    "height": height
-                                },
-                                "mimeType": "image/jpeg"
-                            },
-                            "rid": file_id
-                        }
-                    }]
-                    logger.debug(f"[Yuewen][New API] 使用基本结构构建图片附件: {file_id}")
-
-                # 发送消息
-                await bot.send_text_message(from_wxid, "🔄 正在处理图片，请稍候...")
-                result = await self._send_message_new_async(prompt, attachments)
-
-                # 清除识图请求
-                self.waiting_for_image.pop(user_id, None)
-
-                # 发送结果
-                if result:
-                    # 检查是否为特殊的图片已发送返回值
-                    if isinstance(result, tuple) and len(result) >= 2 and result[0] is True and result[1] == "IMAGE_SENT":
-                        logger.info("[Yuewen][New API] 检测到图片已发送的特殊返回值，不再发送额外消息")
-                        return False  # 直接返回，不再处理任何文本消息
-
-                    # 检查结果中是否包含图片URL
-                    if "生成的图片：" in result and "http" in result:
-                        try:
-                            # 提取图片URL
-                            url_match = re.search(r'生成的图片：(https?://[^\s\n]+)', result)
-                            if url_match:
-                                image_url = url_match.group(1)
-                                logger.info(f"[Yuewen] 提取到图片URL: {image_url}")
-
-                                try:
-                                    # 使用辅助方法下载并发送图片
-                                    image_sent = await self.send_image_from_url(bot, from_wxid, image_url)
-
-                                    if image_sent:
-                                        # 发送纯文本部分（如果有）
-                                        text_parts = result.split("生成的图片：")
-                                        if text_parts[0].strip():
-                                            # 格式化文本，移除多余信息
-                                            clean_text = self._process_final_text(text_parts[0])
-                                            await bot.send_text_message(from_wxid, clean_text)
-
-                                        # 图片已发送，不再进行后续处理
-                                        return False
-                                    else:
-                                        # 图片发送失败，继续发送原始文本（包含URL）
-                                        logger.warning(f"[Yuewen] 图片发送失败，将发送包含URL的文本")
-                                except Exception as img_err:
-                                    logger.error(f"[Yuewen] 处理图片URL时出错: {img_err}", exc_info=True)
-                        except Exception as e:
-                            logger.error(f"[Yuewen] 处理图片URL时出错: {e}", exc_info=True)
-
-                    # 如果没有图片URL或处理失败，发送原始文本结果
-                    await bot.send_text_message(from_wxid, result)
-                else:
-                    await bot.send_text_message(from_wxid, "❌ 图片处理失败，请稍后重试")
+            # 发送消息
+            self._reply(bot, from_wxid, "🔄 正在处理图片，请稍候...")
+            cancelled, result = await self._run_generation(self.send_message_async(prompt, attachments))
 
+            # 清除识图请求
+            self.waiting_for_image.pop(user_id, None)
+            if cancelled:
                 return False
 
-            else:
-                # 旧版API
-                # 上传图片
-                file_id = await self._upload_image_old_async(image_data)
-                if not file_id:
-                    await bot.send_text_message(from_wxid, "❌ 图片上传失败")
-                    return False
+            # 图片已在处理响应期间直接发送
+            if context.current().image_sent:
+                logger.info("[Yuewen] 图片已直接发送至用户，不再发送额外消息")
+                return False
 
-                # 检查文件状态
-                if not await self._check_file_status_async(file_id):
-                    await bot.send_text_message(from_wxid, "❌ 图片处理失败")
-                    return False
+            # 发送结果
+            if result:
+                # 检查结果中是否包含图片URL
+                if "生成的图片：" in result and "http" in result:
+                    try:
+                        # 提取图片URL
+                        url_match = re.search(r'生成的图片：(https?://[^\s\n]+)', result)
+                        if url_match:
+                            image_url = url_match.group(1)
+                            logger.info(f"[Yuewen] 提取到图片URL: {image_url}")
+
+                            # 使用辅助方法下载并发送图片
+                            image_sent = await self.send_image_from_url(bot, from_wxid, image_url)
+
+                            if image_sent:
+                                # 发送纯文本部分（如果有）
+                                text_parts = result.split("生成的图片：")
+                                if text_parts[0].strip():
+                                    # 格式化文本，移除多余信息
+                                    clean_text = self._process_final_text(text_parts[0])
+                                    self._reply(bot, from_wxid, clean_text)
+
+                                # 图片已发送，不再进行后续处理
+                                return False
+                            else:
+                                # 图片发送失败，继续发送原始文本（包含URL）
+                                logger.warning(f"[Yuewen] 图片发送失败，将发送包含URL的文本")
+                    except Exception as e:
+                        logger.error(f"[Yuewen] 处理图片URL时出错: {e}", exc_info=True)
 
-                # 获取图片尺寸
-                try:
-                    from PIL import Image
-                    from io import BytesIO
-                    img = Image.open(BytesIO(image_data))
-                    width, height = img.size
-                    file_size = len(image_data)
-                except Exception as e:
-                    logger.error(f"[Yuewen] 获取图片尺寸失败: {e}")
-                    width, height = 800, 600
-                    file_size = len(image_data)
-
-                # 创建图片附件
-                attachments = [{
-                    "fileId": file_id,
-                    "type": "image/jpeg",
-                    "width": width,
-                    "height": height,
-                    "size": file_size
-                }]
-
-                # 获取识图提示词
-                prompt = self.waiting_for_image[user_id].get('prompt', self.imgprompt)
-
-                # 发送消息
-                await bot.send_text_message(from_wxid, "🔄 正在处理图片，请稍候...")
-                result = await self._send_message_old_async(prompt, attachments)
-
-                # 清除识图请求
-                self.waiting_for_image.pop(user_id, None)
-
-                # 发送结果
-                if result:
-                    await bot.send_text_message(from_wxid, result)
-                else:
-                    await bot.send_text_message(from_wxid, "❌ 图片处理失败，请稍后重试")
+                # 如果没有图片URL或处理失败，发送原始文本结果
+                self._reply(bot, from_wxid, result)
+            else:
+                self._reply(bot, from_wxid, "❌ 图片处理失败，请稍后重试")
 
-                return False
+            return False
 
         # 检查是否等待多张图片
         elif user_id in self.multi_image_data:
             logger.info(f"[Yuewen] 用户 {user_id} 正在等待多图上传，处理图片消息")
             multi_data = self.multi_image_data[user_id]
+            self._log_image_meta(message)
             try:
-                # 下载图片 - 现在返回元组(image_path, image_data)
-                image_path, image_data = await self.download_image(bot, message)
-
-                if not image_data and not image_path:
-                    await bot.send_text_message(from_wxid, "❌ 无法获取图片数据，请重试")
+                # 获取图片
+                image = await self._load_image_buffer(bot, message)
+                if not image:
+                    self._reply(bot, from_wxid, "❌ 无法获取图片数据，请重试")
                     return False
 
-                # 如果有图片路径但没有图片数据，尝试从路径读取
-                if image_path and not image_data:
-                    try:
-                        with open(image_path, "rb") as f:
-                            image_data = f.read()
-                        logger.info(f"[Yuewen] 从图片路径读取图片数据: {image_path}, 大小: {len(image_data)} 字节")
-                    except Exception as e:
-                        logger.error(f"[Yuewen] 读取图片路径失败: {e}")
-                        await bot.send_text_message(from_wxid, f"读取图片失败: {e}")
-                        return False
-
-                # 确保有图片数据
-                if not image_data:
-                    await bot.send_text_message(from_wxid, "❌ 无法获取图片数据，请重试")
+                # 上传图片，上传完成后即释放图片数据
+                with image:
+                    image_info, error_detail = await self._upload_image_async(image)
+                if not image_info:
+                    self._reply(bot, from_wxid, f"❌ 图片上传失败{error_detail}\n请稍后重试或联系管理员检查日志")
                     return False
 
-                # 根据API版本选择不同的上传方法
-                if self.api_version == 'new':
-                    # 使用新版API上传图片
-                    file_id = await self._upload_image_new_async(image_data)
-                    if not file_id:
-                        # 获取最后一次尝试上传的错误信息
-                        error_detail = ""
-                        if hasattr(self, '_last_upload_error') and self._last_upload_error:
-                            error_detail = f": {self._last_upload_error}"
-
-                        await bot.send_text_message(from_wxid, f"❌ 图片上传失败{error_detail}\n请稍后重试或联系管理员检查日志")
-                        return False
-
-                    # 获取图片尺寸
-                    try:
-                        from PIL import Image
-                        from io import BytesIO
-                        img = Image.open(BytesIO(image_data))
-                        width, height = img.size
-                    except Exception as e:
-                        logger.error(f"[Yuewen] 获取图片尺寸失败: {e}")
-                        width, height = 800, 600  # 使用默认尺寸
-
-                    # 保存上传结果，包括完整响应
-                    image_info = {
-                        'file_id': file_id,
-                        'width': width,
-                        'height': height,
-                        'size': len(image_data)
-                    }
-
-                    # 保存完整的服务器响应（如果有）
-                    if hasattr(self, '_last_image_response') and self._last_image_response:
-                        image_info['response_data'] = self._last_image_response
-
-                    # 添加到多图列表
-                    multi_data['images'].append(image_info)
-                else:
-                    # 旧版API上传图片
-                    file_id = await self._upload_image_old_async(image_data)
-                    if not file_id:
-                        await bot.send_text_message(from_wxid, "❌ 图片上传失败")
-                        return False
-
-                    # 检查文件状态
-                    if not await self._check_file_status_async(file_id):
-                        await bot.send_text_message(from_wxid, "❌ 图片处理失败")
-                        return False
-
-                    # 获取图片尺寸
-                    try:
-                        from PIL import Image
-                        from io import BytesIO
-                        img = Image.open(BytesIO(image_data))
-                        width, height = img.size
-                        file_size = len(image_data)
-                    except Exception as e:
-                        logger.error(f"[Yuewen] 获取图片尺寸失败: {e}")
-                        width, height = 800, 600
-                        file_size = len(image_data)
-
-                    # 添加到多图列表
-                    multi_data['images'].append({
-                        'file_id': file_id,
-                        'width': width,
-                        'height': height,
-                        'size': file_size
-                    })
+                # 添加到多图列表
+                multi_data['images'].append(image_info)
 
                 # 检查是否已收集足够的图片
                 if len(multi_data['images']) >= multi_data['count']:
                     # 所有图片已收集完成，发送处理消息
-                    await bot.send_text_message(from_wxid, "✅ 所有图片已接收完成，正在处理...")
+                    self._reply(bot, from_wxid, "✅ 所有图片已接收完成，正在处理...")
 
                     # 处理多图片
                     await self._process_multi_images_async(
@@ -3961,7 +3019,8 @@ class YuewenPlugin(PluginBase):
                 else:
                     # 仍需更多图片
                     remaining = multi_data['count'] - len(multi_data['images'])
-                    await bot.send_text_message(
+                    self._reply(
+                        bot,
                         from_wxid,
                         f"✅ 已接收 {len(multi_data['images'])}/{multi_data['count']} 张图片，还需 {remaining} 张\n" +
                         "请继续发送图片，发送完毕后请发送'结束'开始处理"
@@ -3971,7 +3030,7 @@ class YuewenPlugin(PluginBase):
 
             except Exception as e:
                 logger.error(f"[Yuewen] 处理多图片时出错: {e}", exc_info=True)
-                await bot.send_text_message(from_wxid, f"❌ 处理图片出错: {str(e)}")
+                self._reply(bot, from_wxid, f"❌ 处理图片出错: {str(e)}")
                 return False
 
         else:
@@ -3991,485 +3050,102 @@ class YuewenPlugin(PluginBase):
         Returns:
             str: 处理后的文本
         """
-        if not text:
-            return ""
+        return normalize_text(text)
 
-        # 移除Unicode零宽字符
-        text = re.sub(r'[\u200b-\u200f\u2028-\u202f\ufeff]', '', text)
-
-        # 规范化不同类型的换行符
-        text = re.sub(r'\r\n', '\n', text)
-        text = re.sub(r'\r', '\n', text)
-
-        # 合并多个连续换行符为两个
-        text = re.sub(r'\n{3,}', '\n\n', text)
-
-        # 处理markdown列表格式，确保列表项前有换行
-        text = re.sub(r'([^\n])\n([-*]\s)', r'\1\n\n\2', text)
-
-        # 从文本中移除模型信息前缀
-        text = re.sub(r'^使用.*模型.*模式回答.*秒）：\s*\n+', '', text)
-
-        # 移除图片生成相关的状态信息
-        text = re.sub(r'\[正在生成图片，请稍候...\]', '', text)
-        text = re.sub(r'\[图片已生成，耗时\d+\.\d+秒\]', '', text)
-        text = re.sub(r'\[图片生成失败或超时，耗时\d+\.\d+秒\]', '', text)
-
-        # 删除末尾的换行符
-        text = text.rstrip()
-
-        return text
-
-    async def _upload_image_old_async(self, image_bytes):
-        """上传图片到旧版API服务器（异步版本）"""
-        if self.api_version == 'new':
-            logger.warning("[Yuewen] _upload_image_old_async (old API) called in new API mode.")
-            return None  # 在新模式下调用旧上传是错误的
-
-        logger.debug("[Yuewen][Old API] Executing _upload_image_old_async.")
+    async def _load_image_buffer(self, bot, message):
+        """获取图片消息的数据，返回ImageBuffer，失败返回None"""
+        image_path, image_data = await self.download_image(bot, message)
         try:
-            if not image_bytes:
-                logger.error("[Yuewen][Old API] 图片数据为空")
-                return None
-
-            file_size = len(image_bytes)
-            logger.debug(f"[Yuewen][Old API] 准备上传图片，大小: {file_size} 字节")
-            file_name = f"n_v{random.getrandbits(128):032x}.jpg"
-            logger.debug(f"[Yuewen][Old API] 生成的文件名: {file_name}")
-
-            headers = self._update_headers()  # 获取适配旧版的 headers
-            # 添加旧版上传特有的 headers
-            headers.update({
-                'accept': '*/*',
-                'accept-language': 'zh-CN,zh;q=0.9',
-                'cache-control': 'no-cache',
-                'content-type': 'image/jpeg',  # 明确指定
-                'content-length': str(file_size),  # 明确指定
-                'pragma': 'no-cache',
-                'sec-fetch-dest': 'empty',
-                'sec-fetch-mode': 'cors',
-                'sec-fetch-site': 'same-origin',
-                'stepchat-meta-size': str(file_size)  # 旧版特有
-            })
-
-            # 旧版 referer 可能需要带 chat ID
-            if self.current_chat_id:
-                headers['referer'] = f'{self.current_base_url}/chats/{self.current_chat_id}'
-            else:
-                headers['referer'] = f'{self.current_base_url}/chats/'  # 备用
-
-            upload_url = f'{self.current_base_url}/api/storage?file_name={file_name}'
-            logger.debug(f"[Yuewen][Old API] 开始上传图片到: {upload_url}")
+            if image_data:
+                return await ImageBuffer.create(image_data, spill_dir=self.temp_dir)
+            if image_path:
+                return ImageBuffer.from_file(image_path)
+        except Exception as e:
+            logger.error(f"[Yuewen] 读取图片数据失败: {e}")
+        return None
 
-            for retry in range(2):
-                try:
-                    # 使用异步HTTP客户端发送请求
-                    async with self.http_session.put(
-                        upload_url,
-                        headers=headers,
-                        data=image_bytes,  # 直接使用二进制数据
-                        timeout=45
-                    ) as response:
-                        if response.status == 200:
-                            upload_result = await response.json()
-                            file_id = upload_result.get('id')
-                            if file_id:
-                                logger.debug(f"[Yuewen][Old API] 文件上传成功，ID: {file_id}")
-                                # 旧版上传成功后，通常需要检查文件状态
-                                if await self._check_file_status_async(file_id):
-                                    logger.info(f"[Yuewen][Old API] File status check successful for ID: {file_id}")
-                                    return file_id  # 返回文件 ID
-                                else:
-                                    logger.error(f"[Yuewen][Old API] File status check failed after upload for ID: {file_id}")
-                                    return None  # 文件状态检查失败
-                            else:
-                                logger.error(f"[Yuewen][Old API] Upload success but file ID not found in response: {upload_result}")
-                                return None
-
-                        elif response.status == 401 and retry == 0:
-                            logger.warning("[Yuewen][Old API] Token expired during upload, refreshing...")
-                            if await self.login_handler.refresh_token():
-                                # 刷新成功后，需要更新 headers 再次尝试
-                                headers = self._update_headers()  # 重新获取基础 headers
-                                # 重新添加上传特定 headers
-                                headers.update({
-                                    'accept': '*/*', 'accept-language': 'zh-CN,zh;q=0.9',
-                                    'cache-control': 'no-cache', 'content-type': 'image/jpeg',
-                                    'content-length': str(file_size), 'pragma': 'no-cache',
-                                    'sec-fetch-dest': 'empty', 'sec-fetch-mode': 'cors',
-                                    'sec-fetch-site': 'same-origin', 'stepchat-meta-size': str(file_size)
-                                })
-                                if self.current_chat_id:
-                                    headers['referer'] = f'{self.current_base_url}/chats/{self.current_chat_id}'
-                                else:
-                                    headers['referer'] = f'{self.current_base_url}/chats/'
-                                logger.info("[Yuewen][Old API] Token refreshed, retrying upload...")
-                                continue  # 重试
-                            else:
-                                logger.error("[Yuewen][Old API] Token refresh failed.")
-                                return None  # 刷新失败，直接返回
-                        else:
-                            error_text = await response.text()
-                            logger.error(f"[Yuewen][Old API] 上传失败: HTTP {response.status} - {error_text[:200]}")
-                            # 其他错误，如果是第一次尝试，可以选择重试
-                            if retry < 1:
-                                continue
-                            return None  # 重试后仍失败或非 401 错误
+    async def _upload_image_async(self, image):
+        """通过当前API版本的后端上传图片
 
-                except aiohttp.ClientError as e:
-                    logger.error(f"[Yuewen][Old API] 上传 HTTP错误: {e}")
-                    if retry == 0:
-                        # 网络错误也尝试刷新 token 重试
-                        if await self.login_handler.refresh_token():
-                            continue
-                    return None  # 重试失败或刷新失败
-                except Exception as e:
-                    logger.error(f"[Yuewen][Old API] 上传未知错误: {e}", exc_info=True)
-                    # 未知错误通常不重试
-                    return None
-            # 循环结束仍未成功
-            logger.error("[Yuewen][Old API] Upload failed after all retries.")
-            return None
-        except Exception as e:  # 捕获最外层的意外错误
-            logger.error(f"[Yuewen][Old API] 上传图片函数失败: {e}", exc_info=True)
-            return None
+        Args:
+            image: ImageBuffer
 
-    async def _check_file_status_async(self, file_id):
-        """检查文件状态（异步版本）"""
-        if self.api_version == 'new':
-            logger.warning(f"[Yuewen] _check_file_status_async called in new API mode, which is not supported.")
-            return False  # 返回False表示失败
-
-        max_retries = 5  # 最大重试次数
-        retry_interval = 0.5  # 重试间隔(秒)
-
-        headers = self._update_headers()
-        headers.update({
-            'Content-Type': 'application/json',
-            'canary': 'false',
-            'connect-protocol-version': '1',
-            'oasis-appid': '10200',
-            'oasis-mode': '2',
-            'oasis-platform': 'web',
-            'priority': 'u=1, i',
-            'x-waf-client-type': 'fetch_sdk'
-        })
-
-        for i in range(max_retries):
+        Returns:
+            tuple: (image_info, error_detail)，上传失败时 image_info 为 None
+        """
+        # 图片在哪个账号下上传，附件就只在该账号下有效，先确定账号
+        account = self._bind_account()
+        if not await self._ensure_token_valid_async():
+            return None, ": 认证令牌无效，请重新登录"
+
+        # 同一张图片在同一账号下已上传过时直接复用（包括其他实例上传的）
+        cache_key, cached = None, None
+        if self.upload_ttl > 0:
             try:
-                # 使用异步HTTP客户端发送请求
-                async with self.http_session.post(
-                    f'{self.current_base_url}/api/proto.file.v1.FileService/GetFileStatus',
-                    headers=headers,
-                    json={"id": file_id},
-                    timeout=10
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get("fileStatus") == 1:  # 1表示成功
-                            return True
-                        elif not data.get("needFurtherCall", True):  # 如果不需要继续查询
-                            return False
-                    elif response.status == 401:
-                        if await self.login_handler.refresh_token():
-                            continue
-                        return False
-
-                await asyncio.sleep(retry_interval)
+                cache_key = f"upload:{self.api_version}:{account.name}:{await image.digest()}"
+                cached = await self.shared_state.get(cache_key)
             except Exception as e:
-                logger.error(f"[Yuewen] 检查文件状态失败: {str(e)}")
-                if i < max_retries - 1:  # 如果不是最后一次重试
-                    await asyncio.sleep(retry_interval)
-
-        return False
-
-    async def _upload_image_new_async(self, image_bytes):
-        """上传图片到新版 StepFun API (异步版本)"""
-        logger.debug("[Yuewen][New API] Executing _upload_image_new_async.")
-
-        # 重置错误信息
-        self._last_upload_error = None
-
-        if not image_bytes:
-            logger.error("[Yuewen][New API] Image data is empty for upload.")
-            self._last_upload_error = "图片数据为空"
-            return None
-
-        # 检查令牌有效性
-        logger.debug("[Yuewen][New API] 上传前检查令牌有效性")
-        token_valid = await self._ensure_token_valid_async()
-        if not token_valid:
-            logger.error("[Yuewen][New API] 令牌无效或刷新失败")
-            self._last_upload_error = "认证令牌无效，请重新登录"
-            return None
-
-        # 上传参数
-        upload_url = f'{self.current_base_url}/api/resource/image'
-        file_name = f"upload_{int(time.time() * 1000)}.jpg"
-        mime_type = 'image/jpeg'
-
-        # 请求头 - 精确匹配curl
-        headers = {
-            'accept': '*/*',
-            'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6',
-            'oasis-appid': '10200',
-            'oasis-platform': 'web',
-            'origin': self.current_base_url,
-            'priority': 'u=1, i',
-            'referer': f'{self.current_base_url}/chats/{self.current_chat_session_id or "new"}',
-            'sec-ch-ua': '"Chromium";v="136", "Microsoft Edge";v="136", "Not.A/Brand";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36 Edg/136.0.0.0',
-            'x-waf-client-type': 'fetch_sdk'
+                logger.warning(f"[Yuewen] 读取上传缓存失败: {e}")
+        if cached:
+            logger.info(f"[Yuewen] 图片已上传过，复用文件ID: {cached['file_id']}")
+            return cached, None
+
+        file_id, response_data, error = await self.backend.upload_image(image, self._get_session_id())
+        if not file_id:
+            return None, f": {error}" if error else ""
+
+        # 获取图片尺寸（只解析文件头）
+        width, height = image.dimensions()
+
+        image_info = {
+            'file_id': file_id,
+            'width': width,
+            'height': height,
+            'size': image.size
         }
-
-        # 重试参数
-        max_retries = 3
-        retry_delay = 1.0
-
-        for retry in range(max_retries):
+        # 保存完整的服务器响应，新版API构建附件时需要
+        if response_data:
+            image_info['response_data'] = response_data
+        if cache_key is not None:
             try:
-                if retry > 0:
-                    logger.warning(f"[Yuewen][New API] 上传图片重试 ({retry}/{max_retries})")
-                    await asyncio.sleep(retry_delay * retry)
-
-                # 准备Cookie (每次重试重新获取)
-                cookies = {}
-
-                # 获取令牌 - 使用完整令牌，不分割
-                if self.config.get('oasis_webid'):
-                    cookies['Oasis-Webid'] = self.config.get('oasis_webid')
-
-                # 使用完整的复合令牌
-                if self.config.get('oasis_token'):
-                    token = self.config.get('oasis_token', '')
-                    cookies['Oasis-Token'] = token
-                    logger.debug(f"[Yuewen][New API] 使用令牌，长度: {len(token)}")
-                else:
-                    logger.error("[Yuewen][New API] 配置中未找到令牌")
-                    self._last_upload_error = "未找到访问令牌"
-                    return None
-
-                # 添加其他必要Cookie
-                cookies['i18next'] = 'zh'
-                cookies['_tea_utm_cache_20002086'] = '{%22utm_source%22:%22share%22%2C%22utm_content%22:%22web_image_share%22}'
-                cookies['sidebar_state'] = 'false'
-
-                logger.debug(f"[Yuewen][New API] 上传URL: {upload_url}")
-                logger.debug(f"[Yuewen][New API] 上传图片大小: {len(image_bytes)}字节")
-
-                # 尝试使用requests库 (首选方式)
-                try:
-                    import requests
-
-                    logger.debug(f"[Yuewen][New API] 使用requests库上传图片")
-
-                    # 准备文件和表单数据 - 精确匹配curl格式
-                    files = {
-                        'file': (file_name, image_bytes, mime_type)
-                    }
-
-                    data = {
-                        'scene_id': 'image',
-                        'mime_type': mime_type
-                    }
-
-                    # 发送请求 - 不设置content-type，让requests自动处理multipart/form-data边界
-                    response = requests.post(
-                        upload_url,
-                        headers=headers,
-                        cookies=cookies,
-                        files=files,
-                        data=data,
-                        timeout=30
-                    )
-
-                    status_code = response.status_code
-
-                    if status_code == 200:
-                        try:
-                            result = response.json()
-                            if result and result.get('rid'):
-                                rid = result['rid']
-                                logger.info(f"[Yuewen][New API] 图片上传成功，rid: {rid}")
-
-                                # 存储完整的响应结果，以便后续构建图片附件时使用
-                                self._last_image_response = result
-
-                                return rid
-                            else:
-                                logger.warning(f"[Yuewen][New API] 上传成功但找不到图片ID: {result}")
-                                self._last_upload_error = "服务器返回数据不完整"
-                        except Exception as e:
-                            logger.error(f"[Yuewen][New API] 解析上传响应失败: {e}")
-                            self._last_upload_error = "解析响应失败"
-                    else:
-                        response_text = response.text
-                        logger.error(f"[Yuewen][New API] 上传失败: HTTP {status_code}")
-                        logger.debug(f"[Yuewen][New API] 响应内容: {response_text[:200]}")
-
-                        if "token is illegal" in response_text:
-                            logger.error("[Yuewen][New API] 令牌被拒绝")
-                            self._last_upload_error = "令牌被服务器拒绝"
-
-                            # 尝试刷新令牌
-                            current_time = time.time()
-                            if not hasattr(self, 'last_token_refresh') or (current_time - self.last_token_refresh) > 30:
-                                self.last_token_refresh = current_time
-                                if await self.login_handler.refresh_token():
-                                    logger.info("[Yuewen][New API] 令牌已刷新，将在下次重试")
-                            else:
-                                logger.warning("[Yuewen][New API] 令牌刷新太频繁，跳过")
-                        elif status_code == 401:
-                            logger.error("[Yuewen][New API] 未授权错误 (401)")
-                            self._last_upload_error = "未授权 (401)"
-
-                            if await self.login_handler.refresh_token():
-                                logger.info("[Yuewen][New API] 令牌已刷新，将在下次重试")
-                            else:
-                                logger.error("[Yuewen][New API] 令牌刷新失败")
-                                self._last_upload_error = "令牌刷新失败"
-                        else:
-                            self._last_upload_error = f"HTTP {status_code}"
-
-                except ImportError:
-                    # 回退到aiohttp - 如果requests不可用
-                    logger.warning("[Yuewen][New API] requests库未安装，回退到aiohttp")
-
-                    # 生成一个随机边界 - 与curl类似
-                    boundary = f"----WebKitFormBoundary{random.getrandbits(64):x}"
-
-                    # 设置Content-Type头，显式包含边界
-                    headers['content-type'] = f'multipart/form-data; boundary={boundary}'
-
-                    # 手动构建multipart请求数据
-                    data = bytearray()
-
-                    # 添加文件部分
-                    data.extend(f'--{boundary}\r\n'.encode('utf-8'))
-                    data.extend(f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'.encode('utf-8'))
-                    data.extend(f'Content-Type: {mime_type}\r\n\r\n'.encode('utf-8'))
-                    data.extend(image_bytes)
-                    data.extend(b'\r\n')
-
-                    # 添加scene_id字段
-                    data.extend(f'--{boundary}\r\n'.encode('utf-8'))
-                    data.extend(f'Content-Disposition: form-data; name="scene_id"\r\n\r\n'.encode('utf-8'))
-                    data.extend(b'image\r\n')
-
-                    # 添加mime_type字段
-                    data.extend(f'--{boundary}\r\n'.encode('utf-8'))
-                    data.extend(f'Content-Disposition: form-data; name="mime_type"\r\n\r\n'.encode('utf-8'))
-                    data.extend(f'{mime_type}\r\n'.encode('utf-8'))
-
-                    # 添加结束边界
-                    data.extend(f'--{boundary}--\r\n'.encode('utf-8'))
-
-                    # 创建一个新的aiohttp会话用于上传
-                    async with aiohttp.ClientSession(cookies=cookies) as session:
-                        async with session.post(
-                            upload_url,
-                            headers=headers,
-                            data=data,
-                            timeout=30
-                        ) as response:
-                            status_code = response.status
-
-                            if status_code == 200:
-                                try:
-                                    result = await response.json()
-                                    if result and result.get('rid'):
-                                        rid = result['rid']
-                                        logger.info(f"[Yuewen][New API] 图片上传成功，rid: {rid}")
-
-                                        # 存储完整的响应结果，以便后续构建图片附件时使用
-                                        self._last_image_response = result
-
-                                        return rid
-                                    else:
-                                        logger.warning(f"[Yuewen][New API] 上传成功但找不到图片ID: {result}")
-                                        self._last_upload_error = "服务器返回数据不完整"
-                                except Exception as e:
-                                    logger.error(f"[Yuewen][New API] 解析上传响应失败: {e}")
-                                    self._last_upload_error = "解析响应失败"
-
-                            else:
-                                response_text = await response.text()
-                                logger.error(f"[Yuewen][New API] 上传失败: HTTP {status_code}")
-                                logger.debug(f"[Yuewen][New API] 响应内容: {response_text[:200]}")
-
-                                if "token is illegal" in response_text:
-                                    logger.error("[Yuewen][New API] 令牌被拒绝")
-                                    self._last_upload_error = "令牌被服务器拒绝"
-
-                                    current_time = time.time()
-                                    if not hasattr(self, 'last_token_refresh') or (current_time - self.last_token_refresh) > 30:
-                                        self.last_token_refresh = current_time
-                                        if await self.login_handler.refresh_token():
-                                            logger.info("[Yuewen][New API] 令牌已刷新，将在下次重试")
-                                    else:
-                                        logger.warning("[Yuewen][New API] 令牌刷新太频繁，跳过")
-                                elif status_code == 401:
-                                    logger.error("[Yuewen][New API] 未授权错误 (401)")
-                                    self._last_upload_error = "未授权 (401)"
-
-                                    if await self.login_handler.refresh_token():
-                                        logger.info("[Yuewen][New API] 令牌已刷新，将在下次重试")
-                                    else:
-                                        logger.error("[Yuewen][New API] 令牌刷新失败")
-                                        self._last_upload_error = "令牌刷新失败"
-                                else:
-                                    self._last_upload_error = f"HTTP {status_code}"
-
+                await self.shared_state.set(cache_key, image_info, ttl=self.upload_ttl)
             except Exception as e:
-                logger.error(f"[Yuewen][New API] 上传图片时发生异常: {e}")
-                logger.debug(f"[Yuewen][New API] 异常详情: {traceback.format_exc()}")
-                self._last_upload_error = f"上传异常: {str(e)}"
-
-        # 所有重试失败
-        logger.error("[Yuewen][New API] 图片上传失败，重试次数用尽")
-        if not self._last_upload_error:
-            self._last_upload_error = "上传失败，请稍后重试"
-        return None
+                logger.warning(f"[Yuewen] 写入上传缓存失败: {e}")
+        return image_info, None
 
-    def _parse_stream_response(self, response, start_time):
+
+    async def _parse_stream_response(self, response, start_time):
         """解析流式响应"""
-        buffer = bytearray()
         text_buffer = []
         has_thinking_stage = False  # 是否包含思考阶段
         is_done = False  # 是否完成
         user_message_id = None  # 记录用户消息ID
         ai_message_id = None  # 记录AI回答消息ID
+        normalizer = TextNormalizer()  # 增量规范化文本块
+        reasoning = frames.ReasoningTrace.old_api() if self.keep_reasoning else None
+        self.conversation['reasoning'] = reasoning
+        ctx = context.current()
+        streamed = 0  # 已交给流式输出的文本块数
 
         try:
-            # 获取当前模型信息
-            current_model = next((m for m in self.models.values() if m['id'] == self.current_model_id), None)
-            model_name = current_model['name'] if current_model else f"未知模型(ID: {self.current_model_id})"
+            # 获取本次请求使用的模型信息（可能由自适应路由选择）
+            model_name, network_mode = self._route_label()
 
             logger.debug(f"[Yuewen] 开始处理响应，使用模型: {model_name}")
             logger.debug(f"[Yuewen] 当前会话ID: {self.current_chat_id}")
 
-            for chunk in response.iter_bytes():
-                buffer.extend(chunk)
-                while len(buffer) >= 5:
-                    try:
-                        msg_type, length = struct.unpack('>BI', buffer[:5])
-                    except struct.error:
-                        buffer.clear()
-                        break
-
-                    if len(buffer) < 5 + length:
-                        break
-
-                    packet = buffer[5:5+length]
-                    buffer = buffer[5+length:]
+            decoder = FrameDecoder()
+            async for chunk in response.content.iter_any():
+                for _, packet in decoder.feed(chunk):
+                    # 思考阶段的文本按开头字节识别，不做完整解码
+                    if frames.is_old_thinking(packet):
+                        has_thinking_stage = True
+                        if reasoning is not None:
+                            reasoning.add(packet)
+                        continue
 
                     try:
-                        data = json.loads(packet.decode('utf-8'))
+                        data = codec.OLD_STREAM_FRAME.decode(packet)
 
                         # 检查是否包含思考阶段
                         if 'textEvent' in data:
@@ -4484,7 +3160,10 @@ class YuewenPlugin(PluginBase):
 
                             content = event.get('text', '')
                             if content:
-                                text_buffer.append(content)
+                                # 规范化器可能暂存整个分块（开头的模型信息、状态标记、空白），只记录确定的输出
+                                normalized = normalizer.feed(content)
+                                if normalized:
+                                    text_buffer.append(normalized)
 
                         # 记录消息ID - 从startEvent中获取
                         if 'startEvent' in data:
@@ -4502,39 +3181,18 @@ class YuewenPlugin(PluginBase):
                         logger.error(f"[Yuewen] 解析数据包失败: {e}")
                         continue
 
+                if text_buffer:
+                    ctx.mark_first_text()
+                    if ctx.on_text is not None and len(text_buffer) > streamed:
+                        ctx.stream_text(''.join(text_buffer[streamed:]))
+                        streamed = len(text_buffer)
+
             # 如果响应未完成，返回错误
             if not is_done:
                 return "响应未完成，请重试"
 
             cost_time = time.time() - start_time
-            # 优化换行格式处理
-            final_text = ''.join(text_buffer)
-
-            # 处理特殊字符和格式
-            final_text = (
-                final_text.replace('\u200b', '')      # 移除零宽空格
-                .replace('\r\n', '\n')                # 统一换行符
-                .replace('\r', '\n')                  # 处理旧版Mac换行
-            )
-
-            # 处理markdown格式的列表
-            final_text = re.sub(r'\n(\d+\.|\-|\*)\s*', r'\n\n\1 ', final_text)
-
-            # 处理连续换行，但保留markdown格式
-            lines = final_text.split('\n')
-            processed_lines = []
-            for i, line in enumerate(lines):
-                if i > 0 and (line.startswith('- ') or line.startswith('* ') or re.match(r'^\d+\.\s', line)):
-                    processed_lines.append('')  # 在列表项前添加空行
-                processed_lines.append(line)
-            final_text = '\n'.join(processed_lines)
-
-            # 清理多余的连续换行
-            while '\n\n\n' in final_text:
-                final_text = final_text.replace('\n\n\n', '\n\n')
-
-            # 保留段落格式但去除首尾空白
-            final_text = final_text.strip()
+            final_text = ''.join(text_buffer) + normalizer.finish()
 
             # 更新最近消息记录
             if self.current_chat_id and user_message_id and ai_message_id:
@@ -4549,11 +3207,9 @@ class YuewenPlugin(PluginBase):
                 }
 
             if final_text:
-                # 获取联网状态
-                network_mode = "联网" if self.config.get('network_mode', False) else "未联网"
                 # 构建状态信息
                 status_info = f"使用{model_name}模型{network_mode}模式回答（耗时{cost_time:.2f}秒）：\n"
-                return f"{status_info}{final_text}\n\n3分钟内发送yw分享获取回答图片"
+                return f"{status_info}{final_text}\n\n{_SHARE_HINT}"
             return f"未收到有效回复（耗时{cost_time:.2f}秒）"
         except Exception as e:
             logger.error(f"[Yuewen] 解析响应失败: {e}")
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""微信消息发送队列
+
+回复不再由处理流程直接调用 bot.send_text_message，而是交给发送队列：
+
+- 每个接收方（wxid）一个有序队列，由独立的任务发送，处理流程不等待发送完成
+- 按配置的速率发送：同一接收方的相邻消息之间、以及全局相邻消息之间都有最小间隔
+- 等待发送期间排队的相邻短文本合并为一条发送
+- 超长文本在段落、换行、句末等安全位置拆分为多条
+- 发送失败时退避重试
+- 图片等其他发送可以通过 call() 进入同一队列，保持与文本的先后顺序
+
+用法::
+
+    outbound = OutboundDispatcher.from_config(config.get('outbound'))
+    outbound.send_text(bot, wxid, "🔄 正在处理图片，请稍候...")
+    result = await outbound.call(wxid, lambda: bot.send_image_message(wxid, data))
+"""
+import asyncio
+import time
+from collections import deque
+
+from loguru import logger
+
+DEFAULT_RATE = 1.0          # 每个接收方每秒最多发送的消息数
+DEFAULT_GLOBAL_RATE = 5.0   # 所有接收方合计每秒最多发送的消息数
+DEFAULT_MAX_LENGTH = 4000   # 单条文本消息的最大字符数
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 1.0
+
+MERGE_SEPARATOR = "\n\n"
+# 记录的接收方发送时间超过该数量时清理已过期的记录
+MAX_TRACKED_RECIPIENTS = 1024
+
+# 拆分超长文本时依次尝试的断点
+_BREAKS = ("\n\n", "\n", "。", "！", "？", ". ", "! ", "? ", "；", "; ", "，", ", ", " ")
+
+
+def split_text(text, limit):
+    """把文本拆分为不超过 limit 个字符的片段，尽量在段落、换行、句末处断开"""
+    parts = []
+    while len(text) > limit:
+        window = text[:limit]
+        cut = 0
+        for separator in _BREAKS:
+            index = window.rfind(separator)
+            # 断点太靠前时片段过短，尝试下一种断点
+            if index >= limit // 2:
+                cut = index + len(separator)
+                break
+        if not cut:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+class _Item:
+    """队列中的一次发送：文本，或按顺序执行的其他发送函数"""
+
+    __slots__ = ('bot', 'text', 'func', 'future')
+
+    def __init__(self, bot=None, text=None, func=None):
+        self.bot = bot
+        self.text = text
+        self.func = func
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class OutboundDispatcher:
+    """按接收方排队、限速、合并与拆分的消息发送器"""
+
+    def __init__(self, rate=DEFAULT_RATE, global_rate=DEFAULT_GLOBAL_RATE, max_length=DEFAULT_MAX_LENGTH,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.max_length = max_length
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self._queues = {}      # wxid -> deque[_Item]
+        self._workers = {}     # wxid -> asyncio.Task
+        self._ready_at = {}    # wxid -> 该接收方下一条消息最早的发送时间
+        self._global_next = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.merged = 0
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            rate=float(config.get('rate', DEFAULT_RATE)),
+            global_rate=float(config.get('global_rate', DEFAULT_GLOBAL_RATE)),
+            max_length=int(config.get('max_length', DEFAULT_MAX_LENGTH)),
+            max_attempts=int(config.get('max_attempts', DEFAULT_MAX_ATTEMPTS)),
+            retry_delay=float(config.get('retry_delay', DEFAULT_RETRY_DELAY)),
+        )
+
+    def send_text(self, bot, wxid, text):
+        """排队发送文本，立即返回 Future，结果为是否发送成功"""
+        return self._enqueue(wxid, _Item(bot, text=str(text)))
+
+    async def call(self, wxid, func):
+        """在接收方的队列中按顺序执行 func()（如发送图片），返回其结果"""
+        return await self._enqueue(wxid, _Item(func=func))
+
+    def _enqueue(self, wxid, item):
+        queue = self._queues.get(wxid)
+        if queue is None:
+            queue = self._queues[wxid] = deque()
+        queue.append(item)
+        if wxid not in self._workers:
+            if len(self._ready_at) > MAX_TRACKED_RECIPIENTS:
+                self._prune_ready_at()
+            self._workers[wxid] = asyncio.create_task(self._drain(wxid, queue))
+        return item.future
+
+    def _prune_ready_at(self):
+        now = time.monotonic()
+        for wxid in [w for w, ready_at in self._ready_at.items() if ready_at <= now]:
+            del self._ready_at[wxid]
+
+    async def _drain(self, wxid, queue):
+        try:
+            while queue:
+                # 等待期间到达的消息可以与队首合并
+                await self._pace(wxid)
+                item = queue.popleft()
+                if item.func is not None:
+                    await self._run_call(wxid, item)
+                    continue
+
+                items = [item]
+                text = item.text
+                while queue and queue[0].func is None and queue[0].bot is item.bot:
+                    merged = text + MERGE_SEPARATOR + queue[0].text
+                    if len(merged) > self.max_length:
+                        break
+                    text = merged
+                    items.append(queue.popleft())
+                if len(items) > 1:
+                    self.merged += len(items) - 1
+
+                success = await self._send_text(item.bot, wxid, text)
+                for sent in items:
+                    if not sent.future.done():
+                        sent.future.set_result(success)
+        finally:
+            # 被取消（如插件关闭）时，未发送的消息一并取消
+            while queue:
+                pending = queue.popleft()
+                if not pending.future.done():
+                    pending.future.cancel()
+            self._queues.pop(wxid, None)
+            self._workers.pop(wxid, None)
+
+    async def _pace(self, wxid):
+        """等待到该接收方和全局都允许发送的时间，并预留全局发送时间"""
+        now = time.monotonic()
+        start = max(now, self._ready_at.get(wxid, 0.0), self._global_next)
+        self._global_next = start + self.global_interval
+        self._ready_at[wxid] = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _run_call(self, wxid, item):
+        try:
+            result = await item.func()
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except Exception as e:
+            item.future.set_exception(e)
+        else:
+            item.future.set_result(result)
+
+    async def _send_text(self, bot, wxid, text):
+        parts = split_text(text, self.max_length) if len(text) > self.max_length else [text]
+        success = True
+        for index, part in enumerate(parts):
+            if index:
+                await self._pace(wxid)
+            success = await self._deliver(bot, wxid, part) and success
+        return success
+
+    async def _deliver(self, bot, wxid, text):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await bot.send_text_message(wxid, text)
+                self.sent += 1
+                return True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"[Yuewen] 发送消息到 {wxid} 失败，已达最大重试次数: {e}")
+                    return False
+                logger.warning(f"[Yuewen] 发送消息到 {wxid} 失败 (尝试 {attempt}/{self.max_attempts}): {e}")
+                await asyncio.sleep(self.retry_delay * attempt)
+        return False
+
+    async def close(self, timeout=10.0):
+        """等待队列中的消息发送完成，超时后取消"""
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"[Yuewen] 关闭发送队列时仍有 {len(pending)} 个接收方的消息未发送")
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""本地分享海报
+
+把最近一次问答渲染为一张长图，不访问上游，新旧两种API都可以使用：
+
+- 支持常见的 Markdown：标题、列表、引用、代码块，行内的 ** 和 ` 标记会被去掉
+- 字体对象和字符宽度缓存，相同内容的海报直接复用渲染结果
+- 渲染在线程池中执行，不阻塞事件循环
+
+Pillow 是可选依赖，未安装或找不到中文字体时 render_poster 抛出 PosterError。
+"""
+import asyncio
+import io
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from loguru import logger
+
+WIDTH = 750
+PADDING = 40
+MAX_HEIGHT = 12000
+RENDER_WORKERS = 2
+CACHE_SIZE = 16
+
+# 依次尝试的字体文件（需要包含中文字形）
+FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+)
+
+# 颜色
+BACKGROUND = (247, 248, 250)
+CARD = (255, 255, 255)
+TEXT = (33, 37, 41)
+MUTED = (134, 142, 150)
+ACCENT = (64, 115, 255)
+CODE_BACKGROUND = (240, 242, 245)
+QUOTE_BAR = (206, 212, 218)
+
+# 字号
+TITLE_SIZE = 34
+HEADING_SIZE = 32
+BODY_SIZE = 28
+CODE_SIZE = 24
+META_SIZE = 22
+
+_INLINE_MARKS = re.compile(r'\*\*(.+?)\*\*|__(.+?)__|`([^`]+)`|\[([^\]]+)\]\([^)]+\)')
+_HEADING = re.compile(r'^(#{1,6})\s+(.*)$')
+_BULLET = re.compile(r'^(\s*)(?:[-*+]|(\d+)[.)])\s+(.*)$')
+
+_executor = None
+_cache = OrderedDict()
+
+
+class PosterError(Exception):
+    """海报无法渲染（如未安装Pillow、没有中文字体）"""
+
+
+# ---- 字体与测量 ----
+
+@lru_cache(maxsize=4)
+def _find_font(preferred=None):
+    """返回可用的中文字体文件，找不到时抛出 PosterError
+
+    Pillow 的默认字体没有中文字形，用它渲染只会得到一片方框，不如直接提示配置字体。
+    """
+    if preferred and not os.path.exists(preferred):
+        logger.warning(f"[Yuewen] 配置的海报字体不存在: {preferred}，尝试系统字体")
+    for path in ((preferred,) if preferred else ()) + FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            return path
+    raise PosterError("未找到中文字体，无法生成分享图片，请在配置中设置 poster_font")
+
+
+@lru_cache(maxsize=16)
+def _font(path, size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError as e:
+        logger.warning(f"[Yuewen] 加载海报字体失败 {path}: {e}")
+        raise PosterError(f"海报字体无法加载: {path}，请在配置中设置 poster_font") from e
+
+
+@lru_cache(maxsize=8192)
+def _char_width(font, ch):
+    return font.getlength(ch)
+
+
+def _wrap(text, font, width):
+    """按像素宽度折行，英文单词尽量不拆开"""
+    lines = []
+    for paragraph in text.split("\n"):
+        line, line_width = "", 0.0
+        for token in re.findall(r'[A-Za-z0-9_\-./:@#%&=?]+|\s|.', paragraph):
+            token_width = sum(_char_width(font, ch) for ch in token)
+            if token_width > width:
+                # 超长的单词（如URL）逐字符折行
+                for ch in token:
+                    ch_width = _char_width(font, ch)
+                    if line and line_width + ch_width > width:
+                        lines.append(line)
+                        line, line_width = "", 0.0
+                    line += ch
+                    line_width += ch_width
+                continue
+            if line and line_width + token_width > width:
+                lines.append(line.rstrip())
+                line, line_width = "", 0.0
+                if token.isspace():
+                    continue
+            line += token
+            line_width += token_width
+        lines.append(line.rstrip())
+    return lines
+
+
+# ---- Markdown 解析 ----
+
+def _strip_inline(text):
+    return _INLINE_MARKS.sub(lambda m: next(g for g in m.groups() if g is not None), text)
+
+
+def parse_markdown(text):
+    """解析为块列表 [(类型, 内容, 附加信息)]，类型为 heading/bullet/quote/code/paragraph/blank"""
+    blocks = []
+    code = None
+    for raw in text.replace("\r\n", "\n").split("\n"):
+        if raw.lstrip().startswith("```"):
+            if code is None:
+                code = []
+            else:
+                blocks.append(("code", "\n".join(code), None))
+                code = None
+            continue
+        if code is not None:
+            code.append(raw.expandtabs(4))
+            continue
+
+        line = raw.strip()
+        if not line:
+            if blocks and blocks[-1][0] != "blank":
+                blocks.append(("blank", "", None))
+            continue
+        heading = _HEADING.match(line)
+        if heading:
+            blocks.append(("heading", _strip_inline(heading.group(2)), len(heading.group(1))))
+            continue
+        bullet = _BULLET.match(raw)
+        if bullet:
+            indent, number, body = bullet.groups()
+            marker = f"{number}." if number else "•"
+            blocks.append(("bullet", _strip_inline(body), (marker, len(indent.expandtabs(4)) // 2)))
+            continue
+        if line.startswith(">"):
+            blocks.append(("quote", _strip_inline(line.lstrip("> ")), None))
+            continue
+        blocks.append(("paragraph", _strip_inline(line), None))
+    if code:
+        blocks.append(("code", "\n".join(code), None))
+    return blocks
+
+
+# ---- 排版与绘制 ----
+
+class _Layout:
+    """两遍绘制：先测量高度，再在确定大小的画布上绘制"""
+
+    def __init__(self, font_path):
+        self.font_path = font_path
+        self.ops = []   # (y, 绘制函数)
+        self.y = 0
+
+    def font(self, size):
+        return _font(self.font_path, size)
+
+    def text_lines(self, lines, font, x, color, line_height):
+        for line in lines:
+            y = self.y
+            self.ops.append(lambda draw, y=y, line=line: draw.text((x, y), line, font=font, fill=color))
+            self.y += line_height
+
+    def rect(self, box_height, x0, x1, color, radius=8):
+        y = self.y
+        self.ops.append(lambda draw, y=y: draw.rounded_rectangle(
+            (x0, y, x1, y + box_height), radius=radius, fill=color))
+
+
+def _layout_blocks(layout, blocks, x, width):
+    body = layout.font(BODY_SIZE)
+    for kind, text, extra in blocks:
+        if kind == "blank":
+            layout.y += BODY_SIZE // 2
+        elif kind == "heading":
+            size = HEADING_SIZE if extra <= 2 else BODY_SIZE
+            layout.text_lines(_wrap(text, layout.font(size), width), layout.font(size), x, TEXT, int(size * 1.6))
+        elif kind == "bullet":
+            marker, level = extra
+            indent = 28 + level * 28
+            marker_y = layout.y
+            layout.ops.append(lambda draw, y=marker_y, m=marker, ix=x + indent - 28: draw.text(
+                (ix, y), m, font=body, fill=ACCENT))
+            layout.text_lines(_wrap(text, body, width - indent), body, x + indent, TEXT, int(BODY_SIZE * 1.6))
+        elif kind == "quote":
+            lines = _wrap(text, body, width - 24)
+            height = len(lines) * int(BODY_SIZE * 1.6)
+            layout.rect(height, x, x + 5, QUOTE_BAR, radius=2)
+            layout.text_lines(lines, body, x + 24, MUTED, int(BODY_SIZE * 1.6))
+        elif kind == "code":
+            code_font = layout.font(CODE_SIZE)
+            lines = _wrap(text, code_font, width - 40)
+            line_height = int(CODE_SIZE * 1.5)
+            layout.rect(len(lines) * line_height + 32, x, x + width, CODE_BACKGROUND)
+            layout.y += 16
+            layout.text_lines(lines, code_font, x + 20, TEXT, line_height)
+            layout.y += 24
+        else:
+            layout.text_lines(_wrap(text, body, width), body, x, TEXT, int(BODY_SIZE * 1.6))
+
+
+def _render(question, answer, title, subtitle, font_path):
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError as e:
+        raise PosterError("未安装Pillow，无法生成分享图片") from e
+
+    layout = _Layout(font_path)
+    content_x = PADDING * 2
+    content_width = WIDTH - PADDING * 4
+
+    # 标题
+    layout.y = PADDING
+    layout.text_lines([title], layout.font(TITLE_SIZE), PADDING, ACCENT, int(TITLE_SIZE * 1.5))
+    if subtitle:
+        layout.text_lines([subtitle], layout.font(META_SIZE), PADDING, MUTED, int(META_SIZE * 1.6))
+    layout.y += PADDING // 2
+
+    # 问题卡片与回答卡片
+    cards = []
+    for label, text, color in (("问", question, ACCENT), ("答", answer, TEXT)):
+        top = layout.y
+        layout.y += PADDING
+        layout.text_lines([label], layout.font(META_SIZE), content_x, color, int(META_SIZE * 1.8))
+        _layout_blocks(layout, parse_markdown(text), content_x, content_width)
+        layout.y += PADDING
+        cards.append((top, layout.y))
+        layout.y += PADDING // 2
+
+    footer = "由跃问AI插件本地生成"
+    layout.text_lines([footer], layout.font(META_SIZE), PADDING, MUTED, int(META_SIZE * 1.6))
+    height = min(layout.y + PADDING, MAX_HEIGHT)
+
+    image = Image.new("RGB", (WIDTH, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    for top, bottom in cards:
+        draw.rounded_rectangle((PADDING, top, WIDTH - PADDING, bottom), radius=16, fill=CARD)
+    for op in layout.ops:
+        op(draw)
+
+    output = io.BytesIO()
+    image.save(output, format="PNG", optimize=False)
+    if layout.y + PADDING > MAX_HEIGHT:
+        logger.info(f"[Yuewen] 分享图片超过最大高度，已截断 ({layout.y + PADDING}px)")
+    return output.getvalue()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="yuewen-poster")
+    return _executor
+
+
+async def render_poster(question, answer, title="跃问AI", subtitle=None, font_path=None):
+    """渲染问答海报，返回PNG数据；相同内容直接返回缓存的结果"""
+    key = (question, answer, title, subtitle, font_path)
+    cached = _cache.get(key)
+    if cached is not None:
+        _cache.move_to_end(key)
+        return cached
+
+    started = time.monotonic()
+    data = await asyncio.get_running_loop().run_in_executor(
+        _get_executor(), _render, question, answer, title, subtitle, _find_font(font_path)
+    )
+    logger.debug(f"[Yuewen] 分享图片渲染完成，耗时{(time.monotonic() - started) * 1000:.0f}毫秒，{len(data)}字节")
+
+    _cache[key] = data
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return data
+
+
+def shutdown():
+    """关闭渲染线程池"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
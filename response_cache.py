@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""新会话首条问题的回答缓存
+
+新会话里的第一条问题没有任何上下文，相同的问题（归一化后）在同一模型、
+同一联网模式下得到的回答可以直接复用，命中时完全不访问网络。
+
+- key: (后端, 归一化的问题, 模型ID, 联网模式)
+- 过期: 联网模式的回答时效性更强，使用更短的TTL
+- 容量: 按条目数和估算的内存占用双重限制，超出时按LRU淘汰
+"""
+import sys
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+DEFAULT_TTL = 3600
+DEFAULT_NETWORK_TTL = 300
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+
+
+def _estimate_size(value):
+    """估算缓存值的内存占用（字节）"""
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_size(k) + _estimate_size(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class ResponseCache:
+    """带TTL和LRU淘汰的回答缓存"""
+
+    def __init__(self, enabled=False, ttl=DEFAULT_TTL, network_ttl=DEFAULT_NETWORK_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.network_ttl = network_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (过期时间, 回答, 估算大小)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(
+            enabled=bool(config.get('enabled', False)),
+            ttl=float(config.get('ttl', DEFAULT_TTL)),
+            network_ttl=float(config.get('network_ttl', DEFAULT_NETWORK_TTL)),
+            max_entries=int(config.get('max_entries', DEFAULT_MAX_ENTRIES)),
+            max_bytes=int(config.get('max_bytes', DEFAULT_MAX_BYTES)),
+        )
+
+    @staticmethod
+    def make_key(backend, prompt, model_id, network_mode):
+        """prompt 需要已经归一化"""
+        return (backend, prompt, model_id, bool(network_mode))
+
+    def get(self, key):
+        """返回缓存的回答，未命中或已过期返回 None"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = entry
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.enabled or value is None:
+            return
+        size = _estimate_size(key) + _estimate_size(value)
+        if size > self.max_bytes:
+            logger.debug(f"[Yuewen] 回答过大({size}字节)，不缓存")
+            return
+        network_mode = key[-1]
+        expires_at = time.monotonic() + (self.network_ttl if network_mode else self.ttl)
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, value, size)
+        self._bytes += size
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        """先清理过期条目，仍超出容量时淘汰最久未使用的条目"""
+        if len(self._entries) <= self.max_entries and self._bytes <= self.max_bytes:
+            return
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _, _) in self._entries.items() if now >= expires_at]:
+            self._remove(key)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
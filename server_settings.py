@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""上游设置同步
+
+旧版API的模型、联网等设置保存在账号上（UserService），与具体会话无关。
+这里记录每个账号最近一次成功应用的设置：
+
+- 同步时只发送与记录不同的设置项，没有变化时不访问网络
+- 有变化的设置项并发发送
+- 同一账号的同步串行进行，避免两次同步交错使记录与服务器不一致
+- 设置失败的项从记录中移除，下次同步时重新发送
+"""
+import asyncio
+
+from loguru import logger
+
+_UNSET = object()
+
+
+class SettingsSync:
+    """按账号记录已应用的上游设置，差量同步"""
+
+    def __init__(self):
+        self._applied = {}  # 账号 -> {设置名: 值}
+        self._locks = {}
+
+    def invalidate(self, account=None):
+        """忘记账号（None 表示全部账号）已应用的设置，如重新登录后"""
+        if account is None:
+            self._applied.clear()
+        else:
+            self._applied.pop(account, None)
+
+    def changes(self, account, desired):
+        """与已应用设置不同的设置项"""
+        applied = self._applied.get(account, {})
+        return {name: value for name, value in desired.items() if applied.get(name, _UNSET) != value}
+
+    async def sync(self, account, desired, appliers):
+        """把账号的设置同步为 desired
+
+        Args:
+            account: 账号名称
+            desired: {设置名: 期望值}
+            appliers: {设置名: async func(值) -> bool}
+
+        Returns:
+            bool: 所有设置项是否都已生效
+        """
+        lock = self._locks.get(account)
+        if lock is None:
+            lock = self._locks[account] = asyncio.Lock()
+
+        async with lock:
+            changes = self.changes(account, desired)
+            if not changes:
+                return True
+
+            names = list(changes)
+            results = await asyncio.gather(
+                *(appliers[name](changes[name]) for name in names), return_exceptions=True
+            )
+            applied = self._applied.setdefault(account, {})
+            success = True
+            for name, result in zip(names, results):
+                if result is True:
+                    applied[name] = changes[name]
+                    continue
+                success = False
+                applied.pop(name, None)
+                if isinstance(result, BaseException):
+                    logger.error(f"[Yuewen] 同步设置 {name} 异常: {result}")
+                else:
+                    logger.warning(f"[Yuewen] 同步设置 {name} 失败: {changes[name]}")
+            return success
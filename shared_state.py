@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""多实例共享状态
+
+多个机器人实例使用同一批账号时，令牌、上游会话、上传缓存和限流状态需要在实例之间
+共享，否则每个实例都会各自刷新令牌（刷新令牌轮换后其他实例手里的令牌随即失效）、
+各自创建会话、重复上传同一张图片。
+
+后端提供相同的接口：
+
+- get / set(ttl) / delete: 带过期时间的键值，值为可JSON编码的对象
+- take: 令牌桶限流，多个实例共享同一个桶
+- lock: 带租期的互斥锁，持有者崩溃后锁在租期结束时自动释放
+
+可用的后端：
+
+- SqliteSharedState: 共享卷上的SQLite文件（默认），适合同一台机器或共享存储上的多个实例
+- LocalSharedState: 进程内实现，与类Redis存储的语义相同，用于单实例或替代外部存储
+
+用法::
+
+    shared = create_shared_state(config.get('shared_state'), base_dir)
+    async with shared.lock(f"token-refresh:{account}") as acquired:
+        ...
+"""
+import asyncio
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from . import codec
+
+DEFAULT_PATH = 'shared_state.db'
+DEFAULT_JOURNAL_MODE = 'wal'
+JOURNAL_MODES = ('wal', 'delete', 'truncate', 'persist')
+DEFAULT_BUSY_TIMEOUT = 5.0
+
+DEFAULT_LOCK_TTL = 60.0       # 锁的租期（秒），持有者崩溃后最长阻塞这么久
+DEFAULT_LOCK_TIMEOUT = 45.0   # 等待锁的最长时间
+LOCK_POLL_INTERVAL = 0.2
+
+# 每写入这么多次清理一次过期的键
+PURGE_EVERY = 256
+
+
+class SharedState:
+    """共享状态接口，子类实现下划线开头的同步操作"""
+
+    # 是否在实例之间共享（进程内实现为False，调用方可以跳过只对多实例有意义的同步）
+    shared = False
+
+    def __init__(self):
+        # 本实例的持有者ID，锁记录中用于区分实例
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+    async def _call(self, func, *args):
+        return func(*args)
+
+    async def get(self, key, default=None):
+        data = await self._call(self._get, key, time.time())
+        return default if data is None else codec.loads(data)
+
+    async def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        await self._call(self._set, key, codec.dumps(value), expires_at)
+
+    async def delete(self, key):
+        await self._call(self._delete, key)
+
+    async def take(self, key, rate, burst=1):
+        """从令牌桶取一个令牌
+
+        Args:
+            rate: 每秒补充的令牌数
+            burst: 桶容量
+
+        Returns:
+            float: 0 表示已取得令牌，否则为需要等待的秒数（此时不消耗令牌）
+        """
+        return await self._call(self._take, key, float(rate), float(max(burst, 1)), time.time())
+
+    async def acquire(self, key, rate, burst=1, timeout=None):
+        """等待令牌桶中的令牌，超过 timeout 仍未取得时返回False"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait = await self.take(key, rate, burst)
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def lock(self, name, ttl=DEFAULT_LOCK_TTL, timeout=DEFAULT_LOCK_TIMEOUT):
+        """互斥锁，async with 的结果为是否取得了锁（等待超时时为False）"""
+        return _Lock(self, name, ttl, timeout)
+
+    async def close(self):
+        pass
+
+    def _get(self, key, now):
+        raise NotImplementedError
+
+    def _set(self, key, data, expires_at):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _take(self, key, rate, burst, now):
+        raise NotImplementedError
+
+    def _try_lock(self, name, owner, expires_at, now):
+        raise NotImplementedError
+
+    def _unlock(self, name, owner):
+        raise NotImplementedError
+
+
+class _Lock:
+    """SharedState.lock() 返回的异步上下文管理器"""
+
+    __slots__ = ('state', 'name', 'ttl', 'timeout', 'token', 'acquired')
+
+    def __init__(self, state, name, ttl, timeout):
+        self.state = state
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+        # 同一实例内的并发持有者也互斥
+        self.token = f"{state.owner}-{uuid.uuid4().hex[:8]}"
+        self.acquired = False
+
+    async def __aenter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.time()
+            if await self.state._call(self.state._try_lock, self.name, self.token, now + self.ttl, now):
+                self.acquired = True
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"[Yuewen] 等待共享锁 {self.name} 超时")
+                return False
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+    async def __aexit__(self, *exc):
+        if self.acquired:
+            self.acquired = False
+            try:
+                await self.state._call(self.state._unlock, self.name, self.token)
+            except Exception as e:
+                # 释放失败时锁在租期结束后自动失效
+                logger.warning(f"[Yuewen] 释放共享锁 {self.name} 失败: {e}")
+
+
+def _refill(tokens, updated_at, rate, burst, now):
+    """令牌桶补充后取一个令牌，返回 (新令牌数, 需要等待的秒数)"""
+    tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate if rate > 0 else float('inf')
+
+
+class LocalSharedState(SharedState):
+    """进程内的共享状态（单实例，或作为类Redis存储的替代）"""
+
+    def __init__(self):
+        super().__init__()
+        self._values = {}   # key -> (JSON数据, 过期时间)
+        self._buckets = {}  # key -> (令牌数, 更新时间)
+        self._locks = {}    # name -> (持有者, 过期时间)
+
+    def _get(self, key, now):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        data, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self._values[key]
+            return None
+        return data
+
+    def _set(self, key, data, expires_at):
+        self._values[key] = (data, expires_at)
+
+    def _delete(self, key):
+        self._values.pop(key, None)
+
+    def _take(self, key, rate, burst, now):
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens, wait = _refill(tokens, updated_at, rate, burst, now)
+        self._buckets[key] = (tokens, now)
+        return wait
+
+    def _try_lock(self, name, owner, expires_at, now):
+        holder = self._locks.get(name)
+        if holder is not None and holder[0] != owner and holder[1] > now:
+            return False
+        self._locks[name] = (owner, expires_at)
+        return True
+
+    def _unlock(self, name, owner):
+        holder = self._locks.get(name)
+        if holder is not None and holder[0] == owner:
+            del self._locks[name]
+
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)",
+    "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)",
+)
+
+
+class SqliteSharedState(SharedState):
+    """保存在SQLite文件中的共享状态
+
+    所有实例打开同一个数据库文件。读写在单独的线程中串行执行，不阻塞事件循环；
+    令牌桶在 IMMEDIATE 事务中读改写，锁用一条带条件的 UPSERT 获取，均为原子操作。
+    时间使用系统时钟，多台机器共享时需要同步时钟。
+    """
+
+    shared = True
+
+    def __init__(self, path, journal_mode=DEFAULT_JOURNAL_MODE, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        super().__init__()
+        if journal_mode.lower() not in JOURNAL_MODES:
+            raise ValueError(f"不支持的journal_mode: {journal_mode}")
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yuewen-shared-state")
+        self._writes = 0
+        self._conn = self._executor.submit(self._connect, journal_mode, busy_timeout).result()
+
+    def _connect(self, journal_mode, busy_timeout):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # isolation_level=None: 自动提交，需要事务时显式 BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        # 网络文件系统不支持WAL，此时应配置 journal_mode = "delete"
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _get(self, key, now):
+        row = self._conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return row[0]
+
+    def _set(self, key, data, expires_at):
+        self._conn.execute(
+            "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, data, expires_at)
+        )
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self._conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def _delete(self, key):
+        self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _take(self, key, rate, burst, now):
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = _refill(*(row or (burst, now)), rate, burst, now)
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens, now)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def _try_lock(self, name, owner, expires_at, now):
+        cursor = self._conn.execute(
+            "INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE locks.expires_at <= ? OR locks.owner = excluded.owner",
+            (name, owner, expires_at, now)
+        )
+        return cursor.rowcount > 0
+
+    def _unlock(self, name, owner):
+        self._conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    async def close(self):
+        # 先排空线程中排队的操作，再关闭连接
+        await self._call(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+
+def create_shared_state(config, base_dir):
+    """按配置创建共享状态后端，未启用时使用进程内实现
+
+    Args:
+        config: [yuewen.shared_state] 配置
+        base_dir: 相对路径的基准目录（插件目录）
+    """
+    config = config or {}
+    if not config.get('enabled', False):
+        return LocalSharedState()
+
+    backend = config.get('backend', 'sqlite')
+    if backend == 'local':
+        return LocalSharedState()
+    if backend != 'sqlite':
+        logger.warning(f"[Yuewen] 未知的共享状态后端 {backend}，使用进程内实现")
+        return LocalSharedState()
+
+    path = os.path.join(base_dir, config.get('path') or DEFAULT_PATH)
+    try:
+        state = SqliteSharedState(
+            path,
+            journal_mode=config.get('journal_mode', DEFAULT_JOURNAL_MODE),
+            busy_timeout=float(config.get('busy_timeout', DEFAULT_BUSY_TIMEOUT)),
+        )
+    except (sqlite3.Error, OSError, ValueError) as e:
+        logger.error(f"[Yuewen] 打开共享状态数据库失败 {path}: {e}，使用进程内实现")
+        return LocalSharedState()
+    logger.info(f"[Yuewen] 共享状态已启用: {path}")
+    return state
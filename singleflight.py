@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""并发请求合并
+
+相同 key 的并发调用只执行一次：第一个调用（leader）发起执行，之后到达的
+相同调用等待并共享它的结果。结果在完成后的短窗口期内仍可被复用，
+覆盖“刚回答完又有人发了同样问题”的情况。
+
+调用在合并器自己的任务中执行，不属于任何一个请求方：某个请求方被取消（如
+被同一会话的新问题取代或"yw停止"）时只是不再等待，只有所有请求方都取消后
+才取消调用本身。
+"""
+import asyncio
+import time
+
+from loguru import logger
+
+
+class Flight:
+    """一次进行中（或刚完成）的调用"""
+
+    __slots__ = ('key', 'task', 'finished_at', 'waiters', '_recipients')
+
+    def __init__(self, key, task):
+        self.key = key
+        self.task = task
+        self.finished_at = None
+        self.waiters = 0
+        self._recipients = set()
+
+    def claim(self, recipient):
+        """登记结果的接收方，返回是否为该接收方的第一次登记
+
+        同一接收方（如同一个群）同时发出的相同请求只需要收到一次结果。
+        """
+        if recipient in self._recipients:
+            return False
+        self._recipients.add(recipient)
+        return True
+
+
+class Ticket:
+    """一个请求方在调用中的位置，SingleFlight.do 的返回值之一"""
+
+    __slots__ = ('flight', 'late')
+
+    def __init__(self, flight, late):
+        self.flight = flight
+        self.late = late  # 调用完成后才加入（复用窗口期内的结果）
+
+    def claim(self, recipient):
+        """返回是否需要向 recipient 发送结果
+
+        调用完成后才到达的请求是用户再次提问，总是发送；进行中合并的请求
+        同一接收方只发送一次。
+        """
+        if self.late:
+            return True
+        return self.flight.claim(recipient)
+
+
+class SingleFlight:
+    """按 key 合并并发调用"""
+
+    def __init__(self, window=5.0):
+        self.window = window  # 完成后结果仍可复用的秒数
+        self._flights = {}
+
+    def _expired(self, flight, now):
+        return flight.finished_at is not None and now - flight.finished_at > self.window
+
+    async def do(self, key, func):
+        """执行 func() 或加入相同 key 的进行中调用
+
+        Returns:
+            tuple: (结果, Ticket)
+        """
+        now = time.monotonic()
+        flight = self._flights.get(key)
+        if flight is not None and not self._expired(flight, now):
+            late = flight.finished_at is not None
+            if not late:
+                logger.info(f"[Yuewen] 合并相同请求，等待进行中的结果 (共{flight.waiters + 1}个请求)")
+        else:
+            self._prune(now)
+            late = False
+            flight = self._flights[key] = Flight(key, asyncio.create_task(func()))
+            flight.task.add_done_callback(lambda task, flight=flight: self._finish(flight))
+
+        flight.waiters += 1
+        try:
+            # shield: 请求方被取消时不影响调用本身
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done():
+                self._leave(flight)
+            raise
+        finally:
+            flight.waiters -= 1
+        return result, Ticket(flight, late)
+
+    def _leave(self, flight):
+        """请求方被取消：没有其他等待方时取消调用（waiters 尚未减去当前请求方）"""
+        if flight.waiters <= 1:
+            logger.info("[Yuewen] 合并请求的所有请求方都已取消，停止上游请求")
+            flight.task.cancel()
+
+    def _finish(self, flight):
+        task = flight.task
+        if task.cancelled() or task.exception() is not None:
+            # 失败的结果不缓存
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            return
+        flight.finished_at = time.monotonic()
+        if self.window <= 0 and self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def _prune(self, now):
+        for key in [k for k, f in self._flights.items() if self._expired(f, now)]:
+            del self._flights[key]
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""单元测试只导入不依赖机器人框架的独立模块，把插件目录加入导入路径"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
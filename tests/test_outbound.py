@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from outbound import MERGE_SEPARATOR, OutboundDispatcher, split_text
+
+
+def test_short_text_is_not_split():
+    assert split_text("短消息", 10) == ["短消息"]
+
+
+def test_split_prefers_paragraph_breaks():
+    text = "第一段内容。\n\n第二段内容。"
+    assert split_text(text, 10) == ["第一段内容。", "第二段内容。"]
+
+
+def test_split_falls_back_to_sentence_end():
+    text = "一二三四五。六七八九十。甲乙丙"
+    assert split_text(text, 8) == ["一二三四五。", "六七八九十。", "甲乙丙"]
+
+
+def test_split_ignores_breaks_too_close_to_the_start():
+    # 断点在前半段时片段过短，直接按长度切分
+    text = "a" + "\n" + "b" * 20
+    parts = split_text(text, 10)
+    assert parts[0] == "a\n" + "b" * 8
+    assert "".join(parts) == text
+
+
+def test_split_parts_respect_limit():
+    text = ("这是一句话，" * 50 + "\n") * 10
+    parts = split_text(text, 100)
+    assert all(len(part) <= 100 for part in parts)
+    assert "".join(parts).replace("\n", "") == text.replace("\n", "")
+
+
+class FakeBot:
+    def __init__(self, failures=0):
+        self.sent = []
+        self.failures = failures
+
+    async def send_text_message(self, wxid, text):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("send failed")
+        self.sent.append((wxid, text))
+
+
+def test_queued_messages_are_merged_in_order():
+    async def run():
+        # 三条消息在发送任务开始之前就已排队，合并为一条发送
+        outbound = OutboundDispatcher(rate=100, global_rate=100)
+        bot = FakeBot()
+        futures = [outbound.send_text(bot, "chat", text) for text in ("一", "二", "三")]
+        assert await asyncio.gather(*futures) == [True, True, True]
+        assert bot.sent == [("chat", MERGE_SEPARATOR.join(["一", "二", "三"]))]
+        assert outbound.merged == 2
+
+    asyncio.run(run())
+
+
+def test_long_text_is_split_when_sent():
+    async def run():
+        outbound = OutboundDispatcher(rate=100, global_rate=100, max_length=10)
+        bot = FakeBot()
+        assert await outbound.send_text(bot, "chat", "第一段内容。\n\n第二段内容。")
+        assert [text for _, text in bot.sent] == ["第一段内容。", "第二段内容。"]
+
+    asyncio.run(run())
+
+
+def test_failed_send_is_retried():
+    async def run():
+        outbound = OutboundDispatcher(rate=100, global_rate=100, max_attempts=3, retry_delay=0)
+        bot = FakeBot(failures=2)
+        assert await outbound.send_text(bot, "chat", "你好")
+        assert bot.sent == [("chat", "你好")]
+        assert outbound.sent == 1
+
+    asyncio.run(run())
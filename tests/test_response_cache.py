@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import response_cache
+from response_cache import ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "monotonic", clock)
+    return clock
+
+
+def key(prompt, network=False):
+    return ResponseCache.make_key("old", prompt, "model", network)
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(enabled=False)
+    cache.put(key("q"), "a")
+    assert cache.get(key("q")) is None
+
+
+def test_none_is_not_cached():
+    cache = ResponseCache(enabled=True)
+    cache.put(key("q"), None)
+    assert cache.stats()["entries"] == 0
+
+
+def test_ttl_depends_on_network_mode(clock):
+    cache = ResponseCache(enabled=True, ttl=100, network_ttl=10)
+    cache.put(key("q"), "offline")
+    cache.put(key("q", network=True), "online")
+    clock.now += 10
+    assert cache.get(key("q", network=True)) is None
+    assert cache.get(key("q")) == "offline"
+    clock.now += 90
+    assert cache.get(key("q")) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_lru_eviction_by_entry_count(clock):
+    cache = ResponseCache(enabled=True, max_entries=2)
+    cache.put(key("a"), "1")
+    cache.put(key("b"), "2")
+    assert cache.get(key("a")) == "1"  # a 变为最近使用
+    cache.put(key("c"), "3")
+    assert cache.get(key("b")) is None
+    assert cache.get(key("a")) == "1"
+    assert cache.get(key("c")) == "3"
+
+
+def test_eviction_by_size(clock):
+    cache = ResponseCache(enabled=True, max_bytes=2000)
+    cache.put(key("big"), "x" * 3000)
+    assert cache.stats()["entries"] == 0
+    cache.put(key("a"), "x" * 800)
+    cache.put(key("b"), "x" * 800)
+    assert cache.get(key("a")) is None
+    assert cache.get(key("b")) is not None
+    assert cache.stats()["bytes"] <= 2000
+
+
+def test_expired_entries_are_evicted_before_live_ones(clock):
+    cache = ResponseCache(enabled=True, ttl=100, network_ttl=10, max_entries=2)
+    cache.put(key("old", network=True), "1")
+    cache.put(key("live"), "2")
+    clock.now += 20
+    cache.put(key("new"), "3")
+    assert cache.get(key("live")) == "2"
+    assert cache.get(key("new")) == "3"
+
+
+def test_put_replaces_existing_entry(clock):
+    cache = ResponseCache(enabled=True)
+    cache.put(key("q"), "first")
+    cache.put(key("q"), "second")
+    assert cache.get(key("q")) == "second"
+    assert cache.stats()["entries"] == 1
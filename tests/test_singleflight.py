@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class Upstream:
+    """可控的上游调用：记录调用次数，等待 release 后返回结果"""
+
+    def __init__(self, result="answer"):
+        self.result = result
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return self.result
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    async def run():
+        coalescer = SingleFlight(window=5)
+        upstream = Upstream()
+        first = asyncio.create_task(coalescer.do("k", upstream))
+        second = asyncio.create_task(coalescer.do("k", upstream))
+        await settle()
+        upstream.release.set()
+        (r1, t1), (r2, t2) = await asyncio.gather(first, second)
+        assert (r1, r2) == ("answer", "answer")
+        assert upstream.calls == 1
+        # 同时进行的相同请求，同一接收方只发送一次
+        assert t1.claim("chat") is True
+        assert t2.claim("chat") is False
+        assert t2.claim("other chat") is True
+
+    asyncio.run(run())
+
+
+def test_cancelled_leader_does_not_drop_joiners():
+    async def run():
+        coalescer = SingleFlight(window=5)
+        upstream = Upstream()
+        leader = asyncio.create_task(coalescer.do("k", upstream))
+        await settle()
+        joiner = asyncio.create_task(coalescer.do("k", upstream))
+        await settle()
+        leader.cancel()
+        await settle()
+        assert upstream.cancelled == 0
+        upstream.release.set()
+        result, _ = await joiner
+        assert result == "answer"
+        assert upstream.calls == 1
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(run())
+
+
+def test_upstream_cancelled_when_every_requester_leaves():
+    async def run():
+        coalescer = SingleFlight(window=5)
+        upstream = Upstream()
+        requests = [asyncio.create_task(coalescer.do("k", upstream)) for _ in range(2)]
+        await settle()
+        requests[0].cancel()
+        await settle()
+        assert upstream.cancelled == 0
+        requests[1].cancel()
+        await settle()
+        assert upstream.cancelled == 1
+        # 取消的调用不会被复用
+        upstream.release.set()
+        result, _ = await coalescer.do("k", upstream)
+        assert result == "answer"
+        assert upstream.calls == 2
+
+    asyncio.run(run())
+
+
+def test_finished_result_is_reused_and_resent_within_window():
+    async def run():
+        coalescer = SingleFlight(window=5)
+        upstream = Upstream()
+        upstream.release.set()
+        _, first = await coalescer.do("k", upstream)
+        assert first.claim("chat") is True
+        # 完成后再问同样的问题：复用结果，但仍然要回复
+        result, again = await coalescer.do("k", upstream)
+        assert result == "answer"
+        assert upstream.calls == 1
+        assert again.claim("chat") is True
+
+    asyncio.run(run())
+
+
+def test_failures_are_not_reused():
+    async def run():
+        coalescer = SingleFlight(window=5)
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            raise RuntimeError("boom")
+
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await coalescer.do("k", failing)
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_zero_window_only_merges_in_flight_calls():
+    async def run():
+        coalescer = SingleFlight(window=0)
+        upstream = Upstream()
+        upstream.release.set()
+        await coalescer.do("k", upstream)
+        await coalescer.do("k", upstream)
+        assert upstream.calls == 2
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from text_normalizer import TextNormalizer, normalize_prompt, normalize_text
+
+SAMPLES = [
+    "使用Step2模型联网模式回答（耗时3.20秒）：\n你好",
+    "第一段\r\n\r\n\r\n第二段\r第三段",
+    "列表：\n- 一\n* 二\n1. 三\n12.不是列表",
+    "前[正在生成图片，请稍候...]后[图片已生成，耗时1.23秒]\n[普通括号]",
+    "零​宽﻿字符 ",
+    "answer\n ",
+    "answer \n\t",
+    "a\n\n  ",
+    "a\n\t\n",
+    "a\n  \nb",
+    "\n \n开头空行",
+    "缩进\n  - 子项",
+]
+
+
+def feed_chunks(text, size):
+    normalizer = TextNormalizer()
+    out = ''.join(normalizer.feed(text[i:i + size]) for i in range(0, len(text), size))
+    return out + normalizer.finish()
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_chunking_does_not_change_output(text):
+    expected = normalize_text(text)
+    for size in range(1, len(text) + 1):
+        assert feed_chunks(text, size) == expected, size
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("使用Step2模型联网模式回答（耗时3.20秒）：\n你好", "你好"),
+    ("第一段\r\n\r\n\r\n第二段\r第三段", "第一段\n\n第二段\n第三段"),
+    ("说明\n- 一", "说明\n\n- 一"),
+    ("说明\n1. 一", "说明\n\n1. 一"),
+    ("说明\n12.不是列表", "说明\n12.不是列表"),
+    ("前[正在生成图片，请稍候...]后", "前后"),
+    ("[普通括号]", "[普通括号]"),
+    ("零​宽﻿", "零宽"),
+    ("answer\n ", "answer"),
+    ("answer \n\t", "answer"),
+    ("a\n\n  ", "a"),
+    ("a\n  \nb", "a\n  \nb"),
+    ("\n \n开头空行", "开头空行"),
+    ("", ""),
+])
+def test_normalize_text(text, expected):
+    assert normalize_text(text) == expected
+
+
+def test_feed_holds_undecided_line_head():
+    normalizer = TextNormalizer()
+    assert normalizer.feed("说明\n") == "说明"
+    # "1" 可能是列表序号，确定之前不输出换行
+    assert normalizer.feed("1") == ""
+    assert normalizer.feed(". 一") == "\n\n1. 一"
+    assert normalizer.finish() == ""
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  Hello​   WORLD \n") == "hello world"
+    assert normalize_prompt("") == ""
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""回复文本规范化
+
+新旧两版API共用的单遍文本后处理器。所有规则在模块加载时编译一次，
+按字符表驱动扫描，整体为线性时间，并支持对流式分块增量处理：
+
+- 移除零宽字符
+- 统一换行符 (\\r\\n / \\r -> \\n)，连续换行最多保留两个
+- markdown列表项 (`- ` / `* ` / `1. `) 前补空行
+- 移除图片生成状态标记和开头的模型信息行
+- 去除首尾多余的空白
+"""
+import re
+
+# 需要直接丢弃的零宽/不可见字符
+_ZERO_WIDTH = frozenset(
+    [chr(c) for c in range(0x200b, 0x2010)]
+    + [chr(c) for c in range(0x2028, 0x2030)]
+    + ['\ufeff']
+)
+
+# 扫描时需要特殊处理的字符，其余字符可以整段直接输出
+_SPECIAL_RE = re.compile('[\u200b-\u200f\u2028-\u202f\ufeff\r\n\\[]')
+
+# 需要移除的状态标记
+_STATUS_MARKER_RE = re.compile(
+    r'\[(?:正在生成图片，请稍候\.\.\.'
+    r'|图片已生成，耗时\d+\.\d+秒'
+    r'|图片生成失败或超时，耗时\d+\.\d+秒)\]'
+)
+_MAX_MARKER_LEN = 32
+
+# 文本开头的模型信息行，例如 "使用Step2模型联网模式回答（耗时1.23秒）："
+_HEADER_RE = re.compile(r'使用.*模型.*模式回答.*秒）：\s*')
+_MAX_HEADER_LEN = 200
+
+_MAX_ORDINAL_DIGITS = 9
+
+# 连续超过两个的换行
+_EXTRA_NEWLINES_RE = re.compile('\n{3,}')
+
+
+def _classify_line_head(head):
+    """判断行首是否为列表项
+
+    Returns:
+        tuple: (是否已能确定, 是否为列表项)
+    """
+    first = head[0]
+    if first in '-*':
+        if len(head) < 2:
+            return False, False
+        return True, head[1] in ' \t'
+    if '0' <= first <= '9':
+        i = 1
+        while i < len(head) and '0' <= head[i] <= '9':
+            i += 1
+        if i > _MAX_ORDINAL_DIGITS:
+            return True, False
+        if i == len(head):
+            return False, False
+        if head[i] != '.':
+            return True, False
+        if i + 1 == len(head):
+            return False, False
+        return True, head[i + 1] in ' \t'
+    return True, False
+
+
+class TextNormalizer:
+    """增量式文本规范化器
+
+    用法::
+
+        normalizer = TextNormalizer()
+        for chunk in chunks:
+            output += normalizer.feed(chunk)
+        output += normalizer.finish()
+
+    feed() 只返回已经可以确定的输出，可能跨分块的内容（换行、行首、
+    状态标记）会暂存到下一次 feed() 或 finish()。
+    """
+
+    def __init__(self):
+        self._out = []
+        self._after_cr = False
+        self._marker = None        # 正在收集的 "[...]" 标记
+        self._header = ''          # 正在收集的首行（用于识别模型信息行）
+        self._header_done = False
+        self._line_head = ''       # 行首暂存；None 表示处于行中
+        self._pending = ''         # 尚未输出的换行（含空白行中的空白）
+        self._held_ws = ''         # 行尾暂存的空白
+        self._has_content = False
+
+    def feed(self, chunk):
+        """处理一个文本分块，返回可以输出的部分"""
+        if chunk:
+            self._scan(chunk)
+        return self._drain()
+
+    def finish(self):
+        """结束输入，返回剩余输出（末尾空白会被丢弃）"""
+        if self._marker is not None:
+            marker, self._marker = self._marker, None
+            self._inline(marker)
+        if not self._header_done:
+            self._release_header()
+        if self._line_head and self._line_head.strip(' \t'):
+            head, self._line_head = self._line_head, None
+            self._flush_newlines(False)
+            self._write(head)
+        self._pending = ''
+        self._held_ws = ''
+        return self._drain()
+
+    # ---- 第一层：字符过滤（零宽字符、回车、状态标记） ----
+
+    def _scan(self, chunk):
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self._marker is not None:
+                c = chunk[i]
+                if c in _ZERO_WIDTH:
+                    i += 1
+                    continue
+                if c == '\r' or c == '\n':
+                    # 标记不会跨行，按普通文本输出后重新处理当前字符
+                    marker, self._marker = self._marker, None
+                    self._inline(marker)
+                    continue
+                i += 1
+                if c == '[':
+                    marker, self._marker = self._marker, '['
+                    self._inline(marker)
+                    continue
+                self._marker += c
+                if c == ']':
+                    marker, self._marker = self._marker, None
+                    if not _STATUS_MARKER_RE.fullmatch(marker):
+                        self._inline(marker)
+                elif len(self._marker) > _MAX_MARKER_LEN:
+                    marker, self._marker = self._marker, None
+                    self._inline(marker)
+                continue
+
+            if self._after_cr:
+                self._after_cr = False
+                if chunk[i] == '\n':
+                    i += 1
+                    continue
+
+            match = _SPECIAL_RE.search(chunk, i)
+            j = match.start() if match else n
+            if j > i:
+                self._inline(chunk[i:j])
+            if not match:
+                break
+            c = chunk[j]
+            i = j + 1
+            if c == '\n':
+                self._newline()
+            elif c == '\r':
+                self._newline()
+                self._after_cr = True
+            elif c == '[':
+                self._marker = '['
+            # 零宽字符直接丢弃
+
+    # ---- 第二层：行整形（首行模型信息、列表空行、换行合并） ----
+
+    def _inline(self, text):
+        """处理一段不含换行的文本"""
+        if not self._header_done:
+            if not self._header and not text.startswith('使'):
+                self._header_done = True
+            else:
+                self._header += text
+                if len(self._header) > _MAX_HEADER_LEN:
+                    self._release_header()
+                return
+
+        if self._line_head is not None:
+            head = self._line_head + text
+            if not head.strip(' \t'):
+                # 只有空白的行首先暂存，末尾的空白行在 finish() 中丢弃
+                self._line_head = head
+                return
+            decided, is_list = _classify_line_head(head)
+            if not decided:
+                self._line_head = head
+                return
+            self._line_head = None
+            self._flush_newlines(is_list)
+            text = head
+        self._write(text)
+
+    def _newline(self):
+        if not self._header_done:
+            header, self._header = self._header, ''
+            self._header_done = True
+            if header and _HEADER_RE.fullmatch(header):
+                # 丢弃模型信息行，后续换行按开头空行处理
+                return
+            if header:
+                self._inline(header)
+
+        head = self._line_head
+        if head and not head.strip(' \t'):
+            # 空白行的空白随换行一起暂存，位于末尾时整体丢弃
+            self._pending += head
+        elif head:
+            self._flush_newlines(False)
+            self._write(head)
+        self._line_head = ''
+        self._pending += '\n'
+
+    def _release_header(self):
+        header, self._header = self._header, ''
+        self._header_done = True
+        if header:
+            self._inline(header)
+
+    def _flush_newlines(self, is_list):
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = ''
+        if not self._has_content:
+            # 开头的空行直接丢弃
+            self._held_ws = ''
+            return
+        text = _EXTRA_NEWLINES_RE.sub('\n\n', self._held_ws + pending)
+        if is_list and not text.endswith('\n\n'):
+            text += '\n'
+        self._out.append(text)
+        self._held_ws = ''
+
+    def _write(self, text):
+        stripped = text.rstrip(' \t')
+        if stripped:
+            self._out.append(self._held_ws + stripped)
+            self._held_ws = text[len(stripped):]
+            self._has_content = True
+        else:
+            self._held_ws += text
+
+    def _drain(self):
+        if not self._out:
+            return ''
+        out = ''.join(self._out)
+        self._out.clear()
+        return out
+
+
+def normalize_text(text):
+    """一次性规范化完整文本"""
+    if not text:
+        return ""
+    normalizer = TextNormalizer()
+    return normalizer.feed(text) + normalizer.finish()
+
+
+def normalize_prompt(text):
+    """归一化用户问题，用作请求合并和回答缓存的key
+
+    去掉零宽字符，合并空白并忽略大小写。
+    """
+    if not text:
+        return ""
+    text = ''.join(ch for ch in text if ch not in _ZERO_WIDTH)
+    return ' '.join(text.split()).casefold()
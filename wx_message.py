@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""微信消息元数据提取
+
+图片消息的 XML 形如::
+
+    <msg><img aeskey="..." cdnmidimgurl="..." md5="..." length="..." .../></msg>
+
+使用 expat 流式解析，遇到 <img> 元素即停止，一次取出全部属性；
+群消息开头的 "wxid:\\n" 前缀会被跳过。XML 不完整时退化为对 <img> 标签的
+单次属性扫描。解析结果按 MsgId 缓存，同一条消息在多个环节使用时不会重复解析。
+"""
+import re
+from collections import OrderedDict
+from typing import NamedTuple
+from xml.parsers import expat
+
+_CACHE_SIZE = 256
+_cache = OrderedDict()  # MsgId -> ImageMeta
+
+_IMG_TAG_RE = re.compile(r'<img\b([^>]*)>', re.IGNORECASE)
+_ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(["\'])(.*?)\2', re.DOTALL)
+
+
+class ImageMeta(NamedTuple):
+    """图片消息元数据"""
+    md5: str = ""
+    aeskey: str = ""
+    cdn_mid_url: str = ""      # cdnmidimgurl，中图（bot.download_image 使用）
+    cdn_big_url: str = ""      # cdnbigimgurl，原图
+    cdn_thumb_url: str = ""    # cdnthumburl，缩略图
+    cdn_thumb_aeskey: str = ""
+    length: int = 0            # 中图字节数
+    hd_length: int = 0         # 原图字节数
+    width: int = 0
+    height: int = 0
+
+    @property
+    def downloadable(self):
+        """是否包含通过 CDN 下载中图所需的参数"""
+        return bool(self.aeskey and self.cdn_mid_url)
+
+
+EMPTY_IMAGE_META = ImageMeta()
+
+
+class _Found(Exception):
+    """找到 <img> 元素后中止解析"""
+
+    def __init__(self, attrs):
+        super().__init__()
+        self.attrs = attrs
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _meta_from_attrs(attrs):
+    return ImageMeta(
+        md5=attrs.get('md5', ''),
+        aeskey=attrs.get('aeskey', ''),
+        cdn_mid_url=attrs.get('cdnmidimgurl', ''),
+        cdn_big_url=attrs.get('cdnbigimgurl', ''),
+        cdn_thumb_url=attrs.get('cdnthumburl', ''),
+        cdn_thumb_aeskey=attrs.get('cdnthumbaeskey', ''),
+        length=_to_int(attrs.get('length')),
+        hd_length=_to_int(attrs.get('hdlength')),
+        width=_to_int(attrs.get('cdnmidwidth')),
+        height=_to_int(attrs.get('cdnmidheight')),
+    )
+
+
+def _on_start_element(name, attrs):
+    if name == 'img':
+        raise _Found(attrs)
+
+
+def _scan_img_attrs(xml):
+    """XML 不完整时的退化路径：只扫描 <img> 标签的属性"""
+    match = _IMG_TAG_RE.search(xml)
+    if not match:
+        return None
+    return {key: value for key, _, value in _ATTR_RE.findall(match.group(1))}
+
+
+def parse_image_xml(xml):
+    """从图片消息 XML 中提取元数据，没有 <img> 元素时返回 EMPTY_IMAGE_META"""
+    if not isinstance(xml, str):
+        return EMPTY_IMAGE_META
+    start = xml.find('<')
+    if start < 0:
+        return EMPTY_IMAGE_META
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = _on_start_element
+    try:
+        parser.Parse(xml[start:], True)
+    except _Found as found:
+        return _meta_from_attrs(found.attrs)
+    except expat.ExpatError:
+        attrs = _scan_img_attrs(xml)
+        if attrs:
+            return _meta_from_attrs(attrs)
+    return EMPTY_IMAGE_META
+
+
+def message_xml(message):
+    """取出消息中的 XML 内容"""
+    return message.get("XML") or message.get("Xml") or message.get("Content") or ""
+
+
+def image_meta(message):
+    """获取图片消息的元数据（按 MsgId 缓存）"""
+    msg_id = message.get("MsgId")
+    if msg_id:
+        meta = _cache.get(msg_id)
+        if meta is not None:
+            _cache.move_to_end(msg_id)
+            return meta
+
+    meta = parse_image_xml(message_xml(message))
+
+    if msg_id:
+        _cache[msg_id] = meta
+        if len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return meta